@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+""" Benchmarks for the versioning filesystem.
+
+    Measures snapshots, restores of old versions, version listings, renames
+    and moves of large trees, walks of the user tree, and the compression
+    ratio against the restore time of each codec. Results are written as
+    JSON so that runs from different commits can be compared:
+
+        python benchmarking/benchmark.py --output before.json
+        python benchmarking/benchmark.py --output after.json \\
+            --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from fs.tempfs import TempFS
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from versioning_fs import VersioningFS  # noqa
+from versioning_fs.backends import BACKENDS, get_backend  # noqa
+from versioning_fs.compression import get_codec  # noqa
+
+
+LOREM_IPSUM = os.path.join(os.path.dirname(__file__), 'loremipsum.txt')
+
+UNITS = {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(size):
+    """Parses a size such as '4K' or '1G' into bytes."""
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def parse_list(value, parse=int):
+    """Parses a comma separated list."""
+    return [parse(item) for item in value.split(',') if item.strip()]
+
+
+def git_revision():
+    """Returns the commit being benchmarked, if it can be found."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_content(fs, path, size, version, take_snapshot=False):
+    """Writes a file of about `size` bytes of text. Each version differs
+       from the previous one by a line near the start of the file.
+    """
+    with open(LOREM_IPSUM, 'rb') as lorem_file:
+        text = lorem_file.read()
+    with fs.open(path, 'wb', take_snapshot=take_snapshot) as f:
+        f.write('version %d\n' % version)
+        written = 0
+        while written < size:
+            chunk = text[:size - written]
+            f.write(chunk)
+            written += len(chunk)
+
+
+class Timer(object):
+    """Collects the durations of a benchmark."""
+    def __init__(self):
+        self.durations = []
+
+    def __enter__(self):
+        self.__start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.durations.append(time.time() - self.__start)
+
+    def summary(self):
+        """Returns min, median, mean and max of the durations."""
+        durations = sorted(self.durations)
+        if not durations:
+            return {}
+        return {'runs': len(durations),
+                'min': durations[0],
+                'median': durations[len(durations) // 2],
+                'mean': sum(durations) / len(durations),
+                'max': durations[-1]}
+
+
+class Benchmark(object):
+    """Runs the benchmarks against fresh versioning filesystems."""
+    def __init__(self, backend, repeat):
+        self.backend = backend
+        self.repeat = repeat
+        self.results = []
+
+    def new_fs(self, **kwargs):
+        """Returns a new versioning filesystem in scratch directories."""
+        rootfs = TempFS()
+        backup = TempFS(temp_dir=rootfs.getsyspath('/'))
+        return VersioningFS(rootfs, backup=backup, tmp=TempFS(),
+                            testing={'time': 1},
+                            backend=get_backend(self.backend), **kwargs)
+
+    def record(self, name, timer, **params):
+        """Records the summary of a timer."""
+        result = dict(benchmark=name, **params)
+        result.update(timer.summary())
+        self.results.append(result)
+        sys.stderr.write("%-16s %-40s %.6fs\n" % (
+            name, json.dumps(params, sort_keys=True),
+            result.get('median', 0)))
+
+    def version_chain(self, size, depth):
+        """Benchmarks snapshots, restores and listings of a file with a
+           given number of versions.
+        """
+        fs = self.new_fs()
+        try:
+            snapshot_timer = Timer()
+            for version in range(1, depth + 1):
+                write_content(fs, 'file.txt', size, version)
+                with snapshot_timer:
+                    fs.snapshot('file.txt')
+            self.record('snapshot', snapshot_timer, size=size, depth=depth)
+
+            # restore versions spread across the chain
+            for version in sorted(set([1, (depth + 1) // 2, depth - 1])):
+                if version < 1 or version == depth:
+                    continue
+                restore_timer = Timer()
+                for _ in range(self.repeat):
+                    with restore_timer:
+                        with fs.open('file.txt', 'rb', version=version) as f:
+                            while f.read(1024 * 1024):
+                                pass
+                self.record('restore', restore_timer, size=size, depth=depth,
+                            version=version)
+
+                range_timer = Timer()
+                for _ in range(self.repeat):
+                    with range_timer:
+                        fs.read_version_range('file.txt', version, size // 2,
+                                              4096)
+                self.record('read_range', range_timer, size=size,
+                            depth=depth, version=version)
+
+            for name, method in [('list_versions', fs.list_versions),
+                                 ('list_sizes', fs.list_sizes)]:
+                timer = Timer()
+                for _ in range(self.repeat):
+                    with timer:
+                        method('file.txt')
+                self.record(name, timer, size=size, depth=depth)
+        finally:
+            fs.close()
+
+    def codec(self, spec, size, depth):
+        """Benchmarks the bytes stored for a version chain with a codec,
+           against the time taken to snapshot and restore it.
+        """
+        codec = get_codec(spec)
+        fs = self.new_fs(codec=codec)
+        try:
+            snapshot_timer = Timer()
+            for version in range(1, depth + 1):
+                write_content(fs, 'file.txt', size, version)
+                with snapshot_timer:
+                    fs.snapshot('file.txt')
+            stored = fs.list_byte_sizes('file.txt')[1].cumulative
+            ratio = float(stored) / (size * depth)
+            self.record('codec_snapshot', snapshot_timer, codec=codec.spec,
+                        size=size, depth=depth, ratio=ratio)
+
+            for version in sorted(set([1, depth - 1])):
+                if version < 1 or version == depth:
+                    continue
+                restore_timer = Timer()
+                for _ in range(self.repeat):
+                    with restore_timer:
+                        with fs.open('file.txt', 'rb', version=version) as f:
+                            while f.read(1024 * 1024):
+                                pass
+                self.record('codec_restore', restore_timer, codec=codec.spec,
+                            size=size, depth=depth, version=version,
+                            ratio=ratio)
+        finally:
+            fs.close()
+
+    def tree(self, files, files_per_dir):
+        """Benchmarks renames, moves and walks of a versioned tree."""
+        fs = self.new_fs()
+        try:
+            paths = []
+            for index in range(files):
+                dir_path = 'tree/dir%d' % (index // files_per_dir)
+                if not fs.exists(dir_path):
+                    fs.makedir(dir_path, recursive=True)
+                path = '%s/file%d.txt' % (dir_path, index)
+                write_content(fs, path, 1024, 1)
+                paths.append(path)
+            fs.snapshot_many(paths, parallelism=4)
+
+            walk_timer = Timer()
+            for _ in range(self.repeat):
+                with walk_timer:
+                    for _ in fs.walkfiles('/'):
+                        pass
+            self.record('walkfiles', walk_timer, files=files)
+
+            rename_timer = Timer()
+            movedir_timer = Timer()
+            for _ in range(self.repeat):
+                with rename_timer:
+                    fs.rename('tree', 'renamed')
+                with movedir_timer:
+                    fs.movedir('renamed', 'tree')
+            self.record('rename', rename_timer, files=files)
+            self.record('movedir', movedir_timer, files=files)
+        finally:
+            fs.close()
+
+
+def compare(results, baseline):
+    """Prints how the medians changed against a baseline run."""
+    def key(result):
+        params = dict((k, v) for k, v in result.items()
+                      if k in ('benchmark', 'size', 'depth', 'version',
+                               'files', 'codec'))
+        return json.dumps(params, sort_keys=True)
+
+    old = dict((key(r), r) for r in baseline['results'])
+    for result in results['results']:
+        before = old.get(key(result))
+        if not before or not before.get('median'):
+            continue
+        ratio = result['median'] / before['median']
+        sys.stdout.write("%-60s %8.3fx\n" % (key(result), ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        default='native')
+    parser.add_argument('--sizes', default='4K,256K',
+                        help="file sizes, e.g. 1K,1M,1G")
+    parser.add_argument('--depths', default='1,10,100',
+                        help="version chain depths, e.g. 1,10,1000")
+    parser.add_argument('--tree-files', type=int, default=500,
+                        help="files in the tree for rename/move/walk")
+    parser.add_argument('--files-per-dir', type=int, default=50)
+    parser.add_argument('--codecs', default='',
+                        help="codecs to compare, e.g. none,zlib,lz4,zstd:9")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="write the JSON results here")
+    parser.add_argument('--compare', help="JSON results of an earlier run")
+    args = parser.parse_args(argv)
+    codecs = parse_list(args.codecs, str)
+    if codecs and not BACKENDS[args.backend].compressible:
+        parser.error("--codecs needs a backend that compresses versions, "
+                     "the %s backend doesn't" % args.backend)
+    for codec in codecs:
+        try:
+            get_codec(codec)
+        except ValueError as error:
+            parser.error(str(error))
+
+    benchmark = Benchmark(args.backend, args.repeat)
+    for size in parse_list(args.sizes, parse_size):
+        for depth in parse_list(args.depths):
+            benchmark.version_chain(size, depth)
+    if args.tree_files:
+        benchmark.tree(args.tree_files, args.files_per_dir)
+    for codec in codecs:
+        for size in parse_list(args.sizes, parse_size):
+            for depth in parse_list(args.depths):
+                benchmark.codec(codec, size, depth)
+
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'backend': args.backend,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': benchmark.results,
+    }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,7 +21,7 @@ setup (
     maintainer_email = 'travcunn@umail.iu.edu',
     url = 'http://github.com/travcunn/file-versioning',
     license = 'MIT',
-    packages = ['versioning_fs'],
+    packages = ['versioning_fs', 'versioning_fs.backends'],
     package_dir = {'versioning_fs' : 'versioning_fs'},
     install_requires = ['fs'],
 )
@@ -1,16 +1,44 @@
+from contextlib import closing
+import hashlib
 import os
 import random
+import sqlite3
 import string
+import threading
+import time
 import unittest
 
-from fs.errors import ResourceNotFoundError
+from fs.errors import DestinationExistsError, ResourceNotFoundError
 from fs.path import relpath
 from fs.tempfs import TempFS
 from fs.tests import FSTestCases
 from fs.tests import ThreadingTestCases
+from StringIO import StringIO
 
 from versioning_fs import VersioningFS
-from versioning_fs.errors import VersionError
+from versioning_fs import chunking
+from versioning_fs import compression
+from versioning_fs import delta
+from versioning_fs import staging
+from versioning_fs.backends import ChunkedBackend, NativeBackend, \
+    PackedBackend, RdiffBackupBackend
+from versioning_fs.backends.packed import SCHEMA as PACK_SCHEMA
+from versioning_fs.cache import PathCache
+from versioning_fs.checkpoints import CheckpointPolicy, restore_cost, \
+    RestoreCost
+from versioning_fs.catalog import IndexedCatalog, open_catalog, \
+    VersionCatalog
+from versioning_fs.compression import CODECS, get_codec
+from versioning_fs.database import create_database
+from versioning_fs.errors import QueueFullError, SnapshotError, VersionError
+from versioning_fs.metrics import MemoryMetrics, NULL_METRICS
+from versioning_fs.migrate import migrate
+from versioning_fs.nodes import INDEX_NAME as NODE_INDEX_NAME, NodeIndex
+from versioning_fs.recompress import recompress
+from versioning_fs.retention import RetentionPolicy
+from versioning_fs.scheduler import SnapshotQueue
+from versioning_fs.transaction import Transaction
+from versioning_fs.version_index import INDEX_NAME as VERSION_INDEX_NAME
 
 
 KB = 1024
@@ -39,33 +67,72 @@ def random_filename(size=20):
 
 
 class BaseTest(unittest.TestCase):
+    """The base class for tests of a VersioningFS. Subclasses pick its
+       backend with backend_factory and its other arguments with fs_kwargs.
+    """
+    backend_factory = None  # the default, rdiff-backup
+    testing = True  # bypass the time settings for rdiff-backup
+
+    def fs_kwargs(self):
+        """Returns more keyword arguments for the VersioningFS."""
+        return {}
+
     def setUp(self):
         rootfs = TempFS()
         backup = TempFS(temp_dir=rootfs.getsyspath('/'))
-        self.fs = VersioningFS(rootfs, backup=backup, tmp=TempFS(),
-                               testing={'time': 1})
+        kwargs = self.fs_kwargs()
+        if self.testing:
+            kwargs['testing'] = {'time': 1}
+        if self.backend_factory is not None:
+            kwargs['backend'] = self.backend_factory()
+        self.fs = VersioningFS(rootfs, backup=backup, tmp=TempFS(), **kwargs)
 
     def tearDown(self):
         self.fs.close()
 
 
-class BaseTimeSensitiveTest(unittest.TestCase):
+class BaseTimeSensitiveTest(BaseTest):
     """The base class for tests that should not bypass the time settings for
        rdiff-backup.
     """
-    def setUp(self):
-        rootfs = TempFS()
-        backup = TempFS(temp_dir=rootfs.getsyspath('/'))
-        self.fs = VersioningFS(rootfs, backup=backup, tmp=TempFS())
+    testing = False
 
-    def tearDown(self):
-        self.fs.close()
+
+class BaseNativeTest(BaseTest):
+    """The base class for tests that use the native delta backend."""
+    backend_factory = NativeBackend
+    testing = True
+
+
+class BasePackedTest(BaseTest):
+    """The base class for tests that use the packed backend."""
+    backend_factory = PackedBackend
+    testing = True
+
+
+class BaseChunkedTest(BaseTest):
+    """The base class for tests that use the chunked backend."""
+    backend_factory = ChunkedBackend
+    testing = True
 
 
 class TestVersioningFS(FSTestCases, ThreadingTestCases, BaseTimeSensitiveTest):
     maxDiff = None
 
 
+class TestNativeVersioningFS(FSTestCases, ThreadingTestCases, BaseNativeTest):
+    maxDiff = None
+
+
+class TestPackedVersioningFS(FSTestCases, ThreadingTestCases, BasePackedTest):
+    maxDiff = None
+
+
+class TestChunkedVersioningFS(FSTestCases, ThreadingTestCases,
+                              BaseChunkedTest):
+    maxDiff = None
+
+
 class TestSnapshotAttributes(BaseTimeSensitiveTest):
     """Test meta data manipulation for the files involved in snapshots."""
     def test_snapshot_file_versions(self):
@@ -345,6 +412,796 @@ class TestRdiffBackupSleep(BaseTimeSensitiveTest):
         self.assertEqual(self.fs.version(file_name), iterations)
 
 
+class TestNativeFileVersions(BaseNativeTest, TestFileVersions):
+    """Test file versions with the native backend."""
+
+
+class TestNativeVersionDeletion(BaseNativeTest, TestVersionDeletion):
+    """Test the deletion of older versions with the native backend."""
+
+
+class TestPackedFileVersions(BasePackedTest, TestFileVersions):
+    """Test file versions with the packed backend."""
+
+
+class TestPackedVersionDeletion(BasePackedTest, TestVersionDeletion):
+    """Test the deletion of older versions with the packed backend."""
+
+
+class TestChunkedFileVersions(BaseChunkedTest, TestFileVersions):
+    """Test file versions with the chunked backend."""
+
+
+class TestChunkedVersionDeletion(BaseChunkedTest, TestVersionDeletion):
+    """Test the deletion of older versions with the chunked backend."""
+
+
+class TestAsyncSnapshots(BaseNativeTest):
+    """Test snapshots taken in the background."""
+    def fs_kwargs(self):
+        return {'async_snapshots': True}
+
+    def test_wait_for_snapshots(self):
+        file_names = [random_filename() for _ in range(5)]
+        for file_name in file_names:
+            with self.fs.open(file_name, 'wb') as f:
+                f.write('smartfile')
+
+        self.assertEqual(self.fs.wait_for_snapshots(), [])
+        for file_name in file_names:
+            self.assertEqual(self.fs.version(file_name), 1)
+
+    def test_identical_writes(self):
+        file_name = random_filename()
+        for _ in range(3):
+            with self.fs.open(file_name, 'wb') as f:
+                f.write('smartfile')
+            self.assertEqual(self.fs.wait_for_snapshots(), [])
+
+        self.assertEqual(self.fs.version(file_name), 1)
+        self.assertEqual(self.fs.latest_digest(file_name),
+                         hashlib.sha256('smartfile').hexdigest())
+
+    def test_identical_queued_writes(self):
+        file_name = random_filename()
+        for _ in range(3):
+            with self.fs.open(file_name, 'wb') as f:
+                f.write('smartfile')
+        self.assertEqual(self.fs.wait_for_snapshots(), [])
+        self.assertEqual(self.fs.version(file_name), 1)
+
+    def test_failed_snapshots(self):
+        self.fs.queue_snapshot('missing.txt')
+        errors = self.fs.flush()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][0], 'missing.txt')
+
+    def test_queue_back_pressure(self):
+        release = threading.Event()
+        queue = SnapshotQueue(lambda path: release.wait(), workers=1,
+                              max_size=1, put_timeout=0.01)
+        queue.put('a')  # taken by the worker
+        # the worker is busy, so the queue fills up
+        with self.assertRaises(QueueFullError):
+            for path in ['b', 'c', 'd']:
+                queue.put(path)
+        release.set()
+        self.assertEqual(queue.wait(), [])
+        queue.close()
+
+
+class BlockingBackend(NativeBackend):
+    """A native backend whose snapshots wait until they are released."""
+    def __init__(self):
+        self.release = threading.Event()
+
+    def snapshot(self, *args, **kwargs):
+        self.release.wait()
+        return super(BlockingBackend, self).snapshot(*args, **kwargs)
+
+
+class TestSnapshotQueueTimeout(BaseNativeTest):
+    """Test closing files while the snapshot queue is full."""
+    backend_factory = BlockingBackend
+
+    def fs_kwargs(self):
+        return {'async_snapshots': True, 'snapshot_workers': 1,
+                'snapshot_queue_size': 1, 'snapshot_put_timeout': 0.01}
+
+    def tearDown(self):
+        # closing the filesystem waits for the queued snapshots
+        self.fs.backend.release.set()
+        super(TestSnapshotQueueTimeout, self).tearDown()
+
+    def test_queue_full(self):
+        # the worker is busy with the first file, so the queue fills up
+        with self.assertRaises(QueueFullError):
+            for file_name in ['a.txt', 'b.txt', 'c.txt', 'd.txt']:
+                with self.fs.open(file_name, 'wb') as f:
+                    f.write(file_name)
+        self.assertEqual(self.fs.getcontents(file_name), file_name)
+
+        self.fs.backend.release.set()
+        self.assertEqual(self.fs.wait_for_snapshots(), [])
+        self.assertEqual(self.fs.version('a.txt'), 1)
+        self.assertEqual(self.fs.version(file_name), 0)
+
+
+class TestProcessPoolSnapshots(TestAsyncSnapshots):
+    """Test snapshots taken in the background by worker processes."""
+    def fs_kwargs(self):
+        return {'async_snapshots': True, 'snapshot_pool': 'process',
+                'metrics': MemoryMetrics()}
+
+    def test_state_stays_in_parent(self):
+        with self.fs.open('a.txt', 'wb') as f:
+            f.write('smartfile')
+        self.assertEqual(self.fs.flush(), [])
+        self.assertTrue(self.fs.snapshot_queue.uses_processes)
+
+        # the backend's timings come back from the worker process
+        summary = self.fs.metrics.summary()
+        self.assertEqual(summary['snapshot.count'], 1)
+        self.assertEqual(summary['snapshot.stage']['count'], 1)
+
+        # renames after the pool started are seen by the next snapshots
+        self.fs.rename('a.txt', 'b.txt')
+        with self.fs.open('a.txt', 'wb') as f:
+            f.write('versioning')
+        self.assertEqual(self.fs.flush(), [])
+        self.assertEqual(self.fs.version('a.txt'), 1)
+        self.assertEqual(self.fs.version('b.txt'), 1)
+
+        # the testing clock is only kept here
+        self.assertEqual(self.fs.snapshot('b.txt').timestamp, 3)
+
+
+class TestCoalescedSnapshots(BaseNativeTest):
+    """Test that quick successive closes share a single snapshot."""
+    def fs_kwargs(self):
+        return {'async_snapshots': True, 'snapshot_window': 0.2}
+
+    def test_bursty_writes(self):
+        file_name = random_filename()
+        for content in ["smartfile", "smartfile versioning",
+                        "smartfile versioning rocks"]:
+            with self.fs.open(file_name, 'wb') as f:
+                f.write(content)
+
+        self.assertEqual(self.fs.wait_for_snapshots(), [])
+        self.assertEqual(self.fs.version(file_name), 1)
+        self.assertEqual(self.fs.snapshot_queue.coalesced, 2)
+        with self.fs.open(file_name, 'rb', version=1) as f:
+            self.assertEqual(f.read(), "smartfile versioning rocks")
+
+    def test_rewrite_while_queued(self):
+        file_name = random_filename()
+        for content in ["smartfile", "versioning", "smartfile", "versioning"]:
+            with self.fs.open(file_name, 'wb') as f:
+                f.write(content)
+            if content == "smartfile":
+                self.assertEqual(self.fs.wait_for_snapshots(), [])
+
+        self.assertEqual(self.fs.wait_for_snapshots(), [])
+        self.assertEqual(self.fs.version(file_name), 2)
+        self.assertEqual(self.fs.latest_digest(file_name),
+                         hashlib.sha256("versioning").hexdigest())
+
+        # the stored content, not the file, is read once it is not latest
+        with self.fs.open(file_name, 'wb') as f:
+            f.write("rocks")
+        self.assertEqual(self.fs.wait_for_snapshots(), [])
+        with self.fs.open(file_name, 'rb', version=2) as f:
+            self.assertEqual(f.read(), "versioning")
+
+    def test_retry_without_sleeping(self):
+        calls = []
+
+        def snapshot(path):
+            calls.append(path)
+            if len(calls) < 3:
+                raise SnapshotError("Time of Last backup is not in the past")
+
+        queue = SnapshotQueue(snapshot, retry_delay=0.01)
+        queue.put('a')
+        self.assertEqual(queue.wait(), [])
+        self.assertEqual(calls, ['a', 'a', 'a'])
+        queue.close()
+
+
+class TestRestoreCache(BaseNativeTest):
+    """Test the cache of restored versions."""
+    def fs_kwargs(self):
+        return {'restore_cache_size': 100}
+
+    def test_repeated_reads(self):
+        file_name = random_filename()
+        contents = ["smartfile", "smartfile versioning",
+                    "smartfile versioning rocks"]
+        for content in contents:
+            with self.fs.open(file_name, 'wb') as f:
+                f.write(content)
+
+        cache = self.fs.restore_cache
+        for _ in range(3):
+            for version in [1, 2]:
+                with self.fs.open(file_name, 'rb', version=version) as f:
+                    self.assertEqual(f.read(), contents[version-1])
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(cache.hits, 4)
+
+        # the snapshots don't move with the file, neither do cached restores
+        new_file_name = random_filename()
+        self.fs.move(file_name, new_file_name)
+        with self.fs.open(new_file_name, 'rb', version=1) as f:
+            self.assertEqual(f.read(), contents[0])
+        self.assertEqual(cache.hits, 5)
+
+    def test_eviction(self):
+        file_name = random_filename()
+        for content in ['a' * 60, 'b' * 60, 'c' * 60]:
+            with self.fs.open(file_name, 'wb') as f:
+                f.write(content)
+
+        for version in [1, 2, 1]:
+            with self.fs.open(file_name, 'rb', version=version) as f:
+                f.read()
+        # only one 60 byte version fits into the 100 byte cache
+        self.assertEqual(self.fs.restore_cache.size, 60)
+        self.assertEqual(self.fs.restore_cache.misses, 3)
+
+
+class TestSnapshotMany(BaseNativeTest):
+    """Test taking snapshots of many files at once."""
+    def test_snapshot_many(self):
+        paths = []
+        for _ in range(10):
+            path = random_filename()
+            with self.fs.open(path, 'wb', take_snapshot=False) as f:
+                f.write(path)
+            paths.append(path)
+
+        results, errors = self.fs.snapshot_many(paths + ['missing.txt'],
+                                                parallelism=3)
+        self.assertEqual(sorted(results.keys()), sorted(paths))
+        self.assertEqual(errors.keys(), ['missing.txt'])
+        for path in paths:
+            self.assertEqual(self.fs.version(path), 1)
+            with self.fs.open(path, 'rb', version=1) as f:
+                self.assertEqual(f.read(), path)
+
+        for path in paths:
+            with self.fs.open(path, 'ab', take_snapshot=False) as f:
+                f.write('changed')
+        results, errors = self.fs.snapshot_many(paths, parallelism=2)
+        self.assertEqual(errors, {})
+        for path in paths:
+            self.assertEqual(self.fs.version(path), 2)
+            with self.fs.open(path, 'rb', version=1) as f:
+                self.assertEqual(f.read(), path)
+            with self.fs.open(path, 'rb', version=2) as f:
+                self.assertEqual(f.read(), path + 'changed')
+        self.assertEqual(len(list(self.fs.iter_versions())), 20)
+
+    def test_missing_paths(self):
+        self.fs.snapshot_many(['missing.txt'])
+        with self.assertRaises(ResourceNotFoundError):
+            self.fs.snapshot('dir/missing.txt')
+
+        # no node was given to paths that could not be read
+        nodes = NodeIndex(os.path.join(self.fs.backup.getsyspath('/'),
+                                       NODE_INDEX_NAME))
+        self.assertEqual(nodes.resolve('missing.txt', 'default'), 'default')
+        self.assertEqual(nodes.resolve('dir/missing.txt', 'default'),
+                         'default')
+
+
+class TestPackedSnapshotMany(BasePackedTest, TestSnapshotMany):
+    """Test snapshots of many files at once with the packed backend."""
+
+
+class TestChunkedSnapshotMany(BaseChunkedTest, TestSnapshotMany):
+    """Test snapshots of many files at once with the chunked backend."""
+
+
+class TestUnchangedContent(BaseNativeTest):
+    """Test that rewriting a file with the same content is not versioned."""
+    def test_identical_rewrite(self):
+        file_name = random_filename()
+        for content in ["smartfile", "smartfile", "smartfile versioning",
+                        "smartfile versioning"]:
+            with self.fs.open(file_name, 'wb') as f:
+                f.write(content)
+
+        self.assertEqual(self.fs.version(file_name), 2)
+        self.assertEqual(self.fs.version_digest(file_name, 1),
+                         hashlib.sha256("smartfile").hexdigest())
+
+    def test_unknown_digest(self):
+        file_name = random_filename()
+        for content in ["smartfile", " versioning"]:
+            with self.fs.open(file_name, 'ab') as f:
+                f.write(content)
+
+        # appended content can't be hashed as it is written
+        self.assertEqual(self.fs.latest_digest(file_name), None)
+        self.assertEqual(self.fs.version_digest(file_name, 2),
+                         hashlib.sha256("smartfile versioning").hexdigest())
+        self.assertEqual(self.fs.version_digest(file_name, 1),
+                         hashlib.sha256("smartfile").hexdigest())
+
+        with self.assertRaises(ResourceNotFoundError):
+            self.fs.version_digest(file_name, 3)
+
+
+class IntervalBackend(NativeBackend):
+    """A native backend that keeps versions a second apart, like
+       rdiff-backup.
+    """
+    min_interval = 1
+
+
+class TestSynchronousSnapshots(BaseTest):
+    """Test snapshots taken when a file is closed, without testing times."""
+    backend_factory = IntervalBackend
+    testing = False
+
+    def fs_kwargs(self):
+        return {'metrics': MemoryMetrics()}
+
+    def write_versions(self, contents):
+        start = time.time()
+        for content in contents:
+            with self.fs.open('file.txt', 'wb') as f:
+                f.write(content)
+        return time.time() - start
+
+    def test_min_interval(self):
+        elapsed = self.write_versions(['smartfile', 'smartfile versioning'])
+        self.assertTrue(elapsed < 1)
+        self.assertEqual(self.fs.wait_for_snapshots(), [])
+        versions = self.fs.list_versions('file.txt')
+        self.assertEqual(len(versions), 2)
+        self.assertTrue(int(versions[1]) - int(versions[0]) >= 1)
+        self.assertNotIn('snapshot.retries', self.fs.metrics.summary())
+
+    def test_burst_within_interval(self):
+        """Closes within the interval return at once and coalesce into one
+           version with the latest content.
+        """
+        self.write_versions(['smartfile'])
+        elapsed = self.write_versions(['smartfile %d' % i for i in range(5)])
+        self.assertTrue(elapsed < 0.5)
+        self.assertEqual(self.fs.wait_for_snapshots(), [])
+        self.assertEqual(self.fs.version('file.txt'), 2)
+        with self.fs.open('file.txt', 'rb', version=1) as f:
+            self.assertEqual(f.read(), 'smartfile')
+        with self.fs.open('file.txt', 'rb', version=2) as f:
+            self.assertEqual(f.read(), 'smartfile 4')
+
+    def test_no_interval(self):
+        self.fs.backend.min_interval = 0
+        elapsed = self.write_versions(['smartfile %d' % i for i in range(5)])
+        self.assertTrue(elapsed < 1)
+        self.assertEqual(self.fs.version('file.txt'), 5)
+
+
+class TestSnapshotStaging(BaseNativeTest):
+    """Test how the content of a file is staged for a snapshot."""
+    def test_native_snapshot_never_hardlinks(self):
+        file_name = random_filename()
+        with self.fs.open(file_name, 'wb', take_snapshot=False) as f:
+            f.write('smartfile')
+
+        result = self.fs.snapshot(file_name)
+        self.assertNotEqual(result.strategy, staging.HARDLINK)
+
+        # the stored version must not change along with the file
+        with self.fs.open(file_name, 'wb') as f:
+            f.write('smartfile versioning')
+        with self.fs.open(file_name, 'rb', version=1) as f:
+            self.assertEqual(f.read(), 'smartfile')
+
+    def test_stage_file(self):
+        tmp_dir = self.fs.tmp.getsyspath('/')
+        src_path = os.path.join(tmp_dir, 'src')
+        with open(src_path, 'wb') as f:
+            f.write('smartfile' * 1000)
+
+        strategy = staging.stage_file(src_path, os.path.join(tmp_dir, 'a'))
+        self.assertEqual(strategy, staging.HARDLINK)
+        strategy = staging.stage_file(src_path, os.path.join(tmp_dir, 'b'),
+                                      allow_hardlink=False)
+        # without a hard link, the data is reflinked where the filesystem
+        # can, and copied otherwise
+        with open(src_path, 'rb') as src, \
+                open(os.path.join(tmp_dir, 'c'), 'wb') as dst:
+            can_reflink = staging.reflink(src, dst)
+        self.assertEqual(strategy, staging.REFLINK if can_reflink
+                         else staging.COPY)
+        for name in ['a', 'b']:
+            with open(os.path.join(tmp_dir, name), 'rb') as f:
+                self.assertEqual(f.read(), 'smartfile' * 1000)
+
+
+class TestStreamingRestore(BaseNativeTest):
+    """Test reading older versions as they are rebuilt."""
+    def setUp(self):
+        super(TestStreamingRestore, self).setUp()
+        self.file_name = random_filename()
+        base = ''.join(random_filename() for _ in range(1000))
+        self.contents = []
+        for number in range(5):
+            content = base[:number * 3000] + 'version %d' % number + \
+                base[number * 3000:]
+            self.contents.append(content)
+            with self.fs.open(self.file_name, 'wb') as f:
+                f.write(content)
+
+    def test_stream_versions(self):
+        for version, content in enumerate(self.contents[:-1]):
+            with self.fs.open(self.file_name, 'rb', version=version + 1,
+                              stream=True) as f:
+                self.assertEqual(f.read(), content)
+
+        # nothing was restored to the scratch directory
+        self.assertEqual(self.fs.tmp.listdir('/'), [])
+
+    def test_stream_seek(self):
+        content = self.contents[0]
+        with self.fs.open(self.file_name, 'rb', version=1,
+                          stream=True) as f:
+            f.seek(8990)
+            self.assertEqual(f.read(30), content[8990:9020])
+            f.seek(0)
+            self.assertEqual(f.read(100), content[:100])
+            f.seek(-50, 2)
+            self.assertEqual(f.read(), content[-50:])
+
+    def test_stream_outlives_snapshots(self):
+        with self.fs.open(self.file_name, 'rb', version=4,
+                          stream=True) as f:
+            with self.fs.open(self.file_name, 'wb') as new_file:
+                new_file.write('smartfile')
+            self.assertEqual(f.read(), self.contents[3])
+
+    def test_read_version_range(self):
+        for version, content in enumerate(self.contents):
+            for offset, length in [(0, 16), (5990, 40), (len(content) - 8,
+                                                         100)]:
+                data = self.fs.read_version_range(self.file_name,
+                                                  version + 1, offset, length)
+                self.assertEqual(data, content[offset:offset + length])
+
+        self.assertEqual(self.fs.read_version_range(self.file_name, 1,
+                                                    10 ** 9, 10), '')
+        with self.assertRaises(ResourceNotFoundError):
+            self.fs.read_version_range(self.file_name, 6, 0, 10)
+
+
+class TestMetrics(BaseNativeTest):
+    """Test the counters and timings recorded by the filesystem."""
+    def setUp(self):
+        self.metrics = MemoryMetrics()
+        super(TestMetrics, self).setUp()
+
+    def fs_kwargs(self):
+        return {'metrics': self.metrics}
+
+    def test_snapshot_phases(self):
+        file_name = random_filename()
+        for content in ["smartfile", "smartfile versioning",
+                        "smartfile versioning"]:
+            with self.fs.open(file_name, 'wb') as f:
+                f.write(content)
+
+        counters = self.metrics.counters
+        histograms = self.metrics.histograms
+        self.assertEqual(counters['snapshot.count'], 2)
+        self.assertEqual(counters['snapshot.unchanged'], 1)
+        self.assertEqual(len(histograms['snapshot']), 2)
+        self.assertEqual(len(histograms['snapshot.stage']), 2)
+        self.assertEqual(len(histograms['snapshot.delta']), 1)
+        self.assertEqual(histograms['snapshot.bytes'], [9, 20])
+
+    def test_restore_and_list(self):
+        file_name = random_filename()
+        for content in ["smartfile", "smartfile versioning"]:
+            with self.fs.open(file_name, 'wb') as f:
+                f.write(content)
+
+        with self.fs.open(file_name, 'rb', version=1) as f:
+            f.read()
+        self.fs.list_sizes(file_name)
+        self.fs.remove_versions_before(file_name, 2)
+
+        summary = self.metrics.summary()
+        for name in ['restore', 'restore.patch', 'list_versions',
+                     'list_sizes', 'prune']:
+            self.assertTrue(summary[name]['count'] >= 1, name)
+
+    def test_no_metrics_by_default(self):
+        rootfs = TempFS()
+        backup = TempFS(temp_dir=rootfs.getsyspath('/'))
+        fs = VersioningFS(rootfs, backup=backup, tmp=TempFS(),
+                          testing={'time': 1}, backend=NativeBackend())
+        try:
+            self.assertTrue(fs.metrics is NULL_METRICS)
+            with fs.metrics.timer('snapshot'):
+                fs.metrics.increment('snapshot.count')
+        finally:
+            fs.close()
+
+
+class TestPathCache(BaseNativeTest):
+    """Test the cache of resolved snapshot directories."""
+    def test_eviction(self):
+        cache = PathCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.hit_rate, 0.5)
+
+        cache.put('c/d', 4)
+        cache.invalidate_tree('c')
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(cache.get('c/d'), None)
+
+        # only paths cached before the tree was forgotten are stale
+        cache = PathCache(10)
+        cache.put('c/d/e', 5)
+        cache.put('cd', 6)
+        cache.invalidate_tree('c/d/')
+        cache.put('c/d/f', 7)
+        self.assertEqual(cache.get('c/d/e'), None)
+        self.assertEqual(cache.get('cd'), 6)
+        self.assertEqual(cache.get('c/d/f'), 7)
+
+    def test_snapshot_paths(self):
+        file_name = random_filename()
+        with self.fs.open(file_name, 'wb') as f:
+            f.write('smartfile')
+
+        hits = self.fs.path_cache.hits
+        snap_dir = self.fs.snapshot_snap_path(file_name)
+        self.assertEqual(self.fs.snapshot_snap_path('/' + file_name),
+                         snap_dir)
+        self.assertTrue(self.fs.path_cache.hits >= hits + 2)
+
+        self.fs.rename(file_name, 'renamed')
+        self.assertFalse(self.fs.has_snapshot(file_name))
+        self.assertEqual(self.fs.version('renamed'), 1)
+        with self.fs.open('renamed', 'rb', version=1) as f:
+            self.assertEqual(f.read(), 'smartfile')
+
+
+class TestHiddenPaths(BaseNativeTest):
+    """Test which paths are hidden from the user."""
+    def test_backup_dir_prefix(self):
+        backup_dir = self.fs.hidden_dirs[0]
+        self.assertNotIn(backup_dir, self.fs.listdir('/'))
+
+        # only the backup directory itself is hidden
+        self.fs.makedir(backup_dir + '2')
+        self.fs.makedir('dir/' + backup_dir, recursive=True)
+        self.assertIn(backup_dir + '2', self.fs.listdir('/'))
+        self.assertIn(backup_dir, self.fs.listdir('dir'))
+        self.assertTrue(self.fs.is_hidden('/' + backup_dir + '/file'))
+        self.assertFalse(self.fs.is_hidden(backup_dir + '2/file'))
+
+    def test_add_and_remove(self):
+        self.fs.makedir('tenant/private', recursive=True)
+        with self.fs.open('tenant/private/file', 'wb') as f:
+            f.write('smartfile')
+
+        self.fs.add_hidden('/tenant/private')
+        self.assertEqual(self.fs.listdir('tenant'), [])
+        self.assertEqual(list(self.fs.walkfiles('/tenant')), [])
+
+        self.fs.remove_hidden('tenant/private')
+        self.assertEqual(self.fs.listdir('tenant'), ['private'])
+        self.assertEqual(list(self.fs.walkfiles('/tenant')),
+                         ['/tenant/private/file'])
+
+    def test_walks_skip_hidden_dirs(self):
+        self.fs.makedir('dir')
+        with self.fs.open('dir/file', 'wb') as f:
+            f.write('smartfile')
+        backup_dir = self.fs.hidden_dirs[0]
+        self.assertNotEqual(self.fs.wrapped_fs.listdir(backup_dir), [])
+
+        listed = []
+        listdir = self.fs.wrapped_fs.listdir
+
+        def recording_listdir(path, *args, **kwargs):
+            listed.append(relpath(path))
+            return listdir(path, *args, **kwargs)
+        self.fs.wrapped_fs.listdir = recording_listdir
+
+        for search in ['breadth', 'depth']:
+            self.assertEqual(list(self.fs.walkfiles('/', search=search)),
+                             ['/dir/file'])
+            self.assertEqual(sorted(self.fs.walkdirs('/', search=search)),
+                             ['/', '/dir'])
+        self.assertEqual(sorted(set(listed)), ['', 'dir'])
+
+
+class TestListDirInfo(BaseNativeTest):
+    """Test listing directories along with the info of their entries."""
+    def test_listdirinfo(self):
+        self.fs.makedir('dir/sub', recursive=True)
+        for content in ['smartfile', 'smartfile versioning']:
+            with self.fs.open('dir/file.txt', 'wb') as f:
+                f.write(content)
+
+        listing = dict(self.fs.listdirinfo('dir'))
+        self.assertEqual(sorted(listing), ['file.txt', 'sub'])
+        self.assertEqual(listing['file.txt']['size'], 20)
+        self.assertEqual(listing['file.txt'],
+                         self.fs.getinfo('dir/file.txt'))
+        self.assertNotIn('versions', listing['file.txt'])
+
+        self.assertEqual(self.fs.listdirinfo('dir', files_only=True,
+                                             full=True)[0][0],
+                         'dir/file.txt')
+        self.assertEqual([n for n, _ in self.fs.listdirinfo(
+            'dir', dirs_only=True)], ['sub'])
+        self.assertEqual(self.fs.listdirinfo('dir', wildcard='*.txt',
+                                             absolute=True)[0][0],
+                         '/dir/file.txt')
+        root = [n for n, _ in self.fs.listdirinfo('/')]
+        self.assertEqual(root, ['dir'])
+
+    def test_version_counts(self):
+        self.fs.makedir('dir/sub', recursive=True)
+        for content in ['smartfile', 'smartfile versioning']:
+            with self.fs.open('dir/file.txt', 'wb') as f:
+                f.write(content)
+        with self.fs.open('dir/other.txt', 'wb', take_snapshot=False) as f:
+            f.write('smartfile')
+
+        listing = dict(self.fs.listdirinfo('dir', versions=True))
+        self.assertEqual(listing['file.txt']['versions'], 2)
+        self.assertEqual(listing['other.txt']['versions'], 0)
+        self.assertNotIn('versions', listing['sub'])
+
+    def test_version_counts_from_index(self):
+        for name in ['a.txt', 'b.txt']:
+            for content in ['smartfile', 'smartfile versioning']:
+                with self.fs.open(name, 'wb') as f:
+                    f.write(content)
+
+        # the counts come from the version index, not file by file
+        version = self.fs.version
+        self.fs.version = None
+        listing = dict(self.fs.listdirinfo('/', versions=True))
+        self.assertEqual(listing['a.txt']['versions'], 2)
+        self.assertEqual(listing['b.txt']['versions'], 2)
+
+        # versions the index doesn't know of are counted from the catalog
+        self.fs.version = version
+        index_path = os.path.join(self.fs.backup.getsyspath('/'),
+                                  VERSION_INDEX_NAME)
+        with closing(sqlite3.connect(index_path)) as db:
+            with db:
+                db.execute("DELETE FROM versions")
+        listing = dict(self.fs.listdirinfo('/', versions=True))
+        self.assertEqual(listing['a.txt']['versions'], 2)
+
+
+class TestDelta(unittest.TestCase):
+    """Test the rsync style deltas used by the native backend."""
+    def assert_round_trip(self, basis, target):
+        sig = delta.signature(StringIO(basis), size=len(basis))
+        delta_file = StringIO()
+        delta.delta(sig, StringIO(target), delta_file)
+        out_file = StringIO()
+        delta.patch(StringIO(basis), StringIO(delta_file.getvalue()),
+                    out_file)
+        self.assertEqual(out_file.getvalue(), target)
+        return len(delta_file.getvalue())
+
+    def test_round_trips(self):
+        basis = ''.join(random_filename() for _ in range(500))
+        self.assert_round_trip('', '')
+        self.assert_round_trip('', basis)
+        self.assert_round_trip(basis, '')
+        self.assert_round_trip(basis, basis[:5000] + 'smartfile' +
+                               basis[5000:])
+        self.assert_round_trip(basis, basis[1000:] + basis[:1000])
+
+    def test_small_delta(self):
+        basis = ''.join(random_filename() for _ in range(500))
+        target = basis[:5000] + 'smartfile' + basis[5000:]
+        self.assertTrue(self.assert_round_trip(basis, target) < 1000)
+
+    def test_patched_file(self):
+        basis = ''.join(random_filename() for _ in range(500))
+        target = basis[1000:5000] + 'smartfile' + basis[:1000] + basis[5000:]
+        sig = delta.signature(StringIO(basis), size=len(basis))
+        delta_file = StringIO()
+        delta.delta(sig, StringIO(target), delta_file)
+
+        patched = delta.PatchedFile(StringIO(basis),
+                                    StringIO(delta_file.getvalue()))
+        self.assertEqual(patched.size, len(target))
+        self.assertEqual(patched.read(), target)
+        for offset, length in [(0, 10), (3995, 20), (4005, 2000),
+                               (len(target) - 5, 100)]:
+            patched.seek(offset)
+            self.assertEqual(patched.read(length),
+                             target[offset:offset + length])
+        patched.seek(-9, 2)
+        self.assertEqual(patched.read(), target[-9:])
+        patched.close()
+
+
+class TestVersionCatalog(BaseTest):
+    """Test the version catalog kept next to each snapshot directory."""
+    def catalog(self, snap_dir):
+        return VersionCatalog(snap_dir)
+
+    def test_catalog_entries(self):
+        snap_dir = os.path.join(self.fs.tmp.getsyspath('/'), 'abcdef')
+        catalog = self.catalog(snap_dir)
+        self.assertFalse(catalog.exists())
+
+        for timestamp in [3, 1, 2]:
+            catalog.add(timestamp)
+        self.assertEqual(catalog.timestamps(), ['1', '2', '3'])
+
+        # the most recent version is never forgotten
+        catalog.remove_before(10)
+        self.assertEqual(catalog.timestamps(), ['3'])
+
+        new_snap_dir = os.path.join(self.fs.tmp.getsyspath('/'), '123456')
+        catalog.move(new_snap_dir)
+        self.assertEqual(self.catalog(new_snap_dir).timestamps(), ['3'])
+        self.assertFalse(self.catalog(snap_dir).exists())
+
+    def test_catalog_follows_snapshots(self):
+        file_name = random_filename()
+        for content in ["smartfile", "smartfile versioning"]:
+            with self.fs.open(file_name, 'wb') as f:
+                f.write(content)
+
+        catalog = self.fs.version_catalog(file_name)
+        self.assertTrue(catalog.exists())
+        self.assertEqual(len(catalog.timestamps()), 2)
+
+        # rebuilding from the rdiff-backup data gives the same versions
+        versions = self.fs.list_versions(file_name)
+        catalog.remove()
+        self.fs.rebuild_catalog()
+        self.assertEqual(self.fs.list_versions(file_name), versions)
+
+        self.fs.remove(file_name)
+        self.assertFalse(catalog.exists())
+
+
+class TestPackedVersionCatalog(BasePackedTest, TestVersionCatalog):
+    """Test the version catalog kept in the index of the packed backend."""
+    def catalog(self, snap_dir):
+        db_path = os.path.join(self.fs.tmp.getsyspath('/'), 'index.sqlite')
+        create_database(db_path, PACK_SCHEMA)
+        return IndexedCatalog(snap_dir, db_path, os.path.basename(snap_dir))
+
+    def test_catalog_added_to_old_index(self):
+        """An index created before it kept the catalogs gets the table."""
+        backup_dir = self.fs.tmp.getsyspath('/')
+        os.mkdir(os.path.join(backup_dir, '.packs'))
+        db_path = os.path.join(backup_dir, '.packs', 'index.sqlite')
+        create_database(db_path, PACK_SCHEMA + "DROP TABLE catalog;")
+
+        snap_dir = os.path.join(backup_dir, 'abcdef')
+        catalog = open_catalog(snap_dir, PackedBackend())
+        catalog.add(1)
+        self.assertEqual(catalog.timestamps(), ['1'])
+
+
 class TestFileOperations(BaseTest):
     """Test fs.move, fs.movedir, fs.remove, and fs.removedir"""
     def test_move_single_file(self):
@@ -498,5 +1355,718 @@ class TestFileOperations(BaseTest):
             self.assertTrue(not self.fs.has_snapshot(path))
 
 
+class TestNativeFileOperations(BaseNativeTest, TestFileOperations):
+    """Test file operations with the native backend."""
+
+
+class TestVersionIndex(BaseNativeTest):
+    """Test queries of the versions of every file."""
+    def setUp(self):
+        super(TestVersionIndex, self).setUp()
+        self.fs.makedir('dir')
+        # timestamps 1 and 2 for small.txt, 3 to 5 for dir/large.txt
+        for content in ['a', 'ab']:
+            with self.fs.open('small.txt', 'wb') as f:
+                f.write(content)
+        for content in ['a' * 100, 'b' * 200, 'c' * 300]:
+            with self.fs.open('dir/large.txt', 'wb') as f:
+                f.write(content)
+
+    def test_changed_since(self):
+        self.assertEqual(self.fs.changed_since(2),
+                         [('/small.txt', 2), ('/dir/large.txt', 5)])
+        self.assertEqual(self.fs.changed_since(3), [('/dir/large.txt', 5)])
+        self.assertEqual(self.fs.changed_since(6), [])
+
+    def test_top_by_size(self):
+        # the bytes stored for every version of each file
+        large = self.fs.list_byte_sizes('dir/large.txt')[1].cumulative
+        small = self.fs.list_byte_sizes('small.txt')[1].cumulative
+        self.assertEqual(self.fs.top_by_size(),
+                         [('/dir/large.txt', large), ('/small.txt', small)])
+        self.assertEqual(self.fs.top_by_size(1), [('/dir/large.txt', large)])
+
+    def test_iter_versions(self):
+        records = list(self.fs.iter_versions(since=2, until=4))
+        self.assertEqual([(r.path, r.version, r.timestamp, r.size)
+                          for r in records],
+                         [('/small.txt', 2, 2, 2),
+                          ('/dir/large.txt', 1, 3, 100),
+                          ('/dir/large.txt', 2, 4, 200)])
+
+    def test_maintained_by_file_operations(self):
+        self.fs.rename('dir', 'renamed')
+        self.fs.remove_versions_before('renamed/large.txt', 2)
+        self.assertEqual([(r.path, r.version)
+                          for r in self.fs.iter_versions(since=3)],
+                         [('/renamed/large.txt', 1),
+                          ('/renamed/large.txt', 2)])
+
+        self.fs.remove('small.txt')
+        self.fs.removedir('renamed', force=True)
+        self.assertEqual(list(self.fs.iter_versions()), [])
+
+    def test_invalid_time(self):
+        with self.assertRaises(VersionError):
+            self.fs.changed_since('yesterday')
+
+    def test_rebuild_before_node_index(self):
+        backup = self.fs.backup
+        for name in [NODE_INDEX_NAME, '.versions.sqlite']:
+            os.remove(os.path.join(backup.getsyspath('/'), name))
+        fs = VersioningFS(self.fs.fs, backup=backup, tmp=TempFS(),
+                          testing={'time': 100}, backend=NativeBackend())
+        self.assertEqual(fs.changed_since(1), [])
+
+        fs.rebuild_version_index()
+        self.assertEqual(fs.changed_since(2),
+                         [('/small.txt', 2), ('/dir/large.txt', 5)])
+        self.assertEqual([path for path, _ in fs.top_by_size()],
+                         ['/dir/large.txt', '/small.txt'])
+        self.assertEqual([(r.path, r.version) for r in fs.iter_versions()],
+                         [('/small.txt', 1), ('/small.txt', 2),
+                          ('/dir/large.txt', 1), ('/dir/large.txt', 2),
+                          ('/dir/large.txt', 3)])
+
+    def test_list_byte_sizes(self):
+        sizes = self.fs.list_byte_sizes('dir/large.txt')
+        self.assertEqual(sorted(sizes), [1, 2, 3])
+        # the newest version is stored in full
+        self.assertEqual(sizes[3], (300, 300))
+        self.assertEqual(sizes[2].cumulative, sizes[2].size + 300)
+        self.assertEqual(sizes[1].cumulative,
+                         sizes[1].size + sizes[2].cumulative)
+
+        # recorded in the catalog, updated as versions are added
+        snap_dir = self.fs.snapshot_snap_path('dir/large.txt')
+        self.assertEqual([entry['stored'] for entry in
+                          self.fs.version_catalog('dir/large.txt').load()],
+                         [size for _, size in
+                          self.fs.backend.list_byte_sizes(snap_dir)])
+        self.assertEqual(self.fs.list_sizes('dir/large.txt')[3],
+                         '300 bytes')
+
+
+class TestPackedFileOperations(BasePackedTest, TestFileOperations):
+    """Test file operations with the packed backend."""
+
+
+class TestChunkedFileOperations(BaseChunkedTest, TestFileOperations):
+    """Test file operations with the chunked backend."""
+
+
+class TestPackedStore(BasePackedTest):
+    """Test the pack files and index of the packed backend."""
+    def test_no_snapshot_dirs(self):
+        for content in ['smartfile', 'smartfile versioning', 'packed']:
+            with self.fs.open('file.txt', 'wb') as f:
+                f.write(content)
+
+        backup_dir = self.fs.backup.getsyspath('/')
+        self.assertEqual([name for name in os.listdir(backup_dir)
+                          if os.path.isdir(os.path.join(backup_dir, name))],
+                         ['.packs'])
+        # the catalog is kept in the index, not in a file per file
+        self.assertEqual([name for name in os.listdir(backup_dir)
+                          if name.endswith('.versions')], [])
+        self.assertEqual(self.fs.latest_digest('file.txt'),
+                         hashlib.sha256('packed').hexdigest())
+        self.assertEqual(self.fs.version('file.txt'), 3)
+        with self.fs.open('file.txt', 'rb', version=1, stream=True) as f:
+            self.assertEqual(f.read(), 'smartfile')
+
+    def test_compact(self):
+        for content in ['smartfile' * 1000, 'versioning' * 1000]:
+            with self.fs.open('file.txt', 'wb') as f:
+                f.write(content)
+        self.fs.remove('file.txt')
+
+        backend = self.fs.backend
+        backup_dir = self.fs.backup.getsyspath('/')
+        self.assertTrue(backend.compact(backup_dir) > 0)
+        self.assertEqual(backend.compact(backup_dir), 0)
+
+    def test_migrate_from_native(self):
+        native_fs = VersioningFS(TempFS(), backup=TempFS(), tmp=TempFS(),
+                                 testing={'time': 1},
+                                 backend=NativeBackend())
+        for content in ['smartfile', 'smartfile versioning', 'native']:
+            with native_fs.open('file.txt', 'wb') as f:
+                f.write(content)
+
+        backup_dir = native_fs.backup.getsyspath('/')
+        tmp_dir = native_fs.tmp.getsyspath('/')
+        packed = PackedBackend()
+        self.assertEqual(
+            migrate(backup_dir, NativeBackend(), packed, tmp_dir), 1)
+
+        snap_dir = native_fs.snapshot_snap_path('file.txt')
+        self.assertFalse(os.path.exists(snap_dir))
+        self.assertEqual(len(packed.list_versions(snap_dir)), 3)
+        # the catalog moves into the index, with the recorded digests
+        self.assertFalse(VersionCatalog(snap_dir).exists())
+        self.assertEqual(open_catalog(snap_dir, packed).load()[-1]['digest'],
+                         hashlib.sha256('native').hexdigest())
+        with packed.open_version(
+                snap_dir, packed.list_versions(snap_dir)[0]) as f:
+            self.assertEqual(f.read(), 'smartfile')
+        native_fs.close()
+
+    def test_migrate_from_rdiff_backup(self):
+        rdiff_fs = VersioningFS(TempFS(), backup=TempFS(), tmp=TempFS(),
+                                testing={'time': 1})
+        contents = ['smartfile', 'smartfile versioning', 'rdiff-backup']
+        for content in contents:
+            with rdiff_fs.open('file.txt', 'wb') as f:
+                f.write(content)
+
+        backup_dir = rdiff_fs.backup.getsyspath('/')
+        tmp_dir = rdiff_fs.tmp.getsyspath('/')
+        packed = PackedBackend()
+        self.assertEqual(
+            migrate(backup_dir, RdiffBackupBackend(), packed, tmp_dir), 1)
+
+        snap_dir = rdiff_fs.snapshot_snap_path('file.txt')
+        self.assertFalse(os.path.exists(snap_dir))
+        for version, content in zip(packed.list_versions(snap_dir),
+                                    contents):
+            with packed.open_version(snap_dir, version) as f:
+                self.assertEqual(f.read(), content)
+        rdiff_fs.close()
+
+
+class TestRetention(BaseNativeTest):
+    """Test removing versions and applying retention policies."""
+    contents = ['smartfile %d ' % i * 100 for i in range(5)]
+
+    def write_versions(self):
+        # timestamps 1 to 5
+        for content in self.contents:
+            with self.fs.open('file.txt', 'wb') as f:
+                f.write(content)
+
+    def assertContents(self, contents):
+        self.assertEqual(self.fs.version('file.txt'), len(contents))
+        for version, content in enumerate(contents, 1):
+            with self.fs.open('file.txt', 'rb', version=version) as f:
+                self.assertEqual(f.read(), content)
+
+    def test_remove_versions(self):
+        self.write_versions()
+        self.fs.remove_versions('file.txt', [2, 4, 5])
+        c = self.contents
+        self.assertContents([c[0], c[2], c[4]])
+        self.assertEqual([r.timestamp for r in self.fs.iter_versions()],
+                         [1, 3, 5])
+
+        # the catalog records the sizes of the rewritten deltas
+        snap_dir = self.fs.snapshot_snap_path('file.txt')
+        self.assertEqual(
+            [size.size for _, size in
+             sorted(self.fs.list_byte_sizes('file.txt').items())],
+            [size for _, size in self.fs.backend.list_byte_sizes(snap_dir)])
+
+    def test_select(self):
+        policy = RetentionPolicy(tiers=[(10, 100)])
+        versions = [(t, 1) for t in [5, 101, 102, 111, 115, 190]]
+        self.assertEqual(policy.select(versions, now=200), [5, 101, 111])
+
+        policy = RetentionPolicy(max_versions=2)
+        self.assertEqual(policy.select(versions, now=200), [5, 101, 102, 111])
+
+        policy = RetentionPolicy(max_bytes=1)
+        self.assertEqual(policy.select([(1, 5), (2, 5)], now=200), [1])
+
+    def test_apply_retention(self):
+        self.write_versions()
+        with self.fs.open('other.txt', 'wb') as f:
+            f.write('other')
+        policy = RetentionPolicy(max_versions=2)
+
+        report = self.fs.apply_retention(policy, dry_run=True)
+        self.assertEqual((report.files, report.files_pruned,
+                          report.versions_removed), (2, 1, 3))
+        self.assertTrue(report.bytes_reclaimed > 0)
+        self.assertEqual(self.fs.version('file.txt'), 5)
+
+        report = self.fs.apply_retention(policy, workers=2,
+                                         files_per_second=100)
+        self.assertEqual(report.versions_removed, 3)
+        self.assertEqual(report.errors, {})
+        self.assertTrue(report.bytes_reclaimed > 0)
+        self.assertContents(self.contents[3:])
+        self.assertEqual(self.fs.version('other.txt'), 1)
+
+
+class TestPackedRetention(BasePackedTest, TestRetention):
+    """Test retention policies with the packed backend."""
+
+
+class TestChunkedRetention(BaseChunkedTest, TestRetention):
+    """Test retention policies with the chunked backend."""
+
+
+class TestCompression(BaseNativeTest):
+    """Test storing versions with a codec."""
+    contents = ['smartfile versioning %d\n' % i * 1000 for i in range(4)]
+
+    def write_versions(self):
+        for content in self.contents:
+            with self.fs.open('file.txt', 'wb') as f:
+                f.write(content)
+
+    def assertContents(self):
+        for version, content in enumerate(self.contents, 1):
+            with self.fs.open('file.txt', 'rb', version=version) as f:
+                self.assertEqual(f.read(), content)
+
+    def test_codecs(self):
+        for name, codec_class in CODECS.items():
+            if not codec_class.available:
+                continue
+            for data in ['', 'smartfile' * 1000,
+                         compression.BLOCK_MAGIC + 'x']:
+                stored = StringIO()
+                compression.encode(StringIO(data), stored, get_codec(name))
+                stored.seek(0)
+                self.assertEqual(compression.open_stored(stored).read(), data)
+        with self.assertRaises(ValueError):
+            get_codec('gzip')
+
+    def test_seek_stored(self):
+        data = ''.join(random_filename() for _ in range(5000))
+        stored = StringIO()
+        compression.encode(StringIO(data), stored, get_codec('zlib'),
+                           block_size=1000)
+        stored.seek(0)
+        with compression.open_stored(stored) as f:
+            for offset in [5000, 100, 0, len(data) - 10, 2500]:
+                f.seek(offset)
+                self.assertEqual(f.read(1500), data[offset:offset + 1500])
+            f.seek(0, 2)
+            self.assertEqual(f.tell(), len(data))
+            f.seek(0)
+            self.assertEqual(f.read(), data)
+
+    def test_range_decompresses_blocks(self):
+        self.fs.backend.codec = get_codec('zlib')
+        base = ''.join(random_filename() for _ in range(100000))
+        for number in [1000, 500000, 1500000, 1900000]:
+            with self.fs.open('file.txt', 'wb') as f:
+                f.write(base[:number] + 'version' + base[number:])
+
+        decompressed = []
+        decompressor = compression.ZlibCodec.decompressor
+
+        class CountingDecompressor(object):
+            def __init__(self, codec):
+                self.__decompressor = decompressor(codec)
+
+            def decompress(self, data):
+                data = self.__decompressor.decompress(data)
+                decompressed.append(len(data))
+                return data
+
+            def flush(self):
+                return self.__decompressor.flush()
+
+        compression.ZlibCodec.decompressor = lambda codec: \
+            CountingDecompressor(codec)
+        try:
+            data = self.fs.read_version_range('file.txt', 1, 1200000, 100)
+        finally:
+            compression.ZlibCodec.decompressor = decompressor
+        self.assertEqual(data, base[1199993:1200093])
+        # a block of the full copy and the deltas, not whole versions
+        self.assertTrue(0 < sum(decompressed) < len(base) / 4)
+
+    def test_compressed_versions(self):
+        self.fs.backend.codec = get_codec('zlib:9')
+        self.write_versions()
+        self.assertContents()
+        self.assertEqual(self.fs.list_codecs('file.txt'),
+                         {1: 'zlib', 2: 'zlib', 3: 'zlib', 4: 'zlib'})
+        sizes = self.fs.list_byte_sizes('file.txt')
+        self.assertTrue(sizes[4].size < len(self.contents[3]) / 10)
+
+    def test_recompress(self):
+        self.write_versions()
+        self.assertEqual(set(self.fs.list_codecs('file.txt').values()),
+                         set(['none']))
+        before = self.fs.list_byte_sizes('file.txt')[1].cumulative
+
+        backup_dir = self.fs.backup.getsyspath('/')
+        tmp_dir = self.fs.tmp.getsyspath('/')
+        self.assertEqual(recompress(backup_dir, self.fs.backend, 'zlib',
+                                    tmp_dir), 4)
+        self.assertEqual(recompress(backup_dir, self.fs.backend, 'zlib',
+                                    tmp_dir), 0)
+        self.assertEqual(set(self.fs.list_codecs('file.txt').values()),
+                         set(['zlib']))
+        self.assertTrue(
+            self.fs.list_byte_sizes('file.txt')[1].cumulative < before)
+        self.assertContents()
+
+    def test_shared_backend(self):
+        backend = type(self.fs.backend)()
+        filesystems = []
+        for codec in ['zlib', 'none']:
+            rootfs = TempFS()
+            backup = TempFS(temp_dir=rootfs.getsyspath('/'))
+            filesystems.append(VersioningFS(
+                rootfs, backup=backup, tmp=TempFS(), testing={'time': 1},
+                backend=backend, codec=codec))
+        for fs in filesystems:
+            with fs.open('file.txt', 'wb') as f:
+                f.write(self.contents[0])
+
+        # each filesystem keeps its codec, the backend passed is left as is
+        self.assertEqual([fs.list_codecs('file.txt') for fs in filesystems],
+                         [{1: 'zlib'}, {1: 'none'}])
+        self.assertEqual(backend.codec.name, 'none')
+        for fs in filesystems:
+            fs.close()
+
+    def test_backend_without_codecs(self):
+        with self.assertRaises(ValueError):
+            VersioningFS(TempFS(), backup=TempFS(), tmp=TempFS(),
+                         backend=RdiffBackupBackend(), codec='zlib')
+
+
+class TestPackedCompression(BasePackedTest, TestCompression):
+    """Test codecs with the packed backend."""
+
+
+class TestCheckpoints(BaseNativeTest):
+    """Test keeping versions in full to bound restores."""
+    contents = ['smartfile versioning %d\n' % i * 1000 for i in range(10)]
+
+    def write_versions(self):
+        for content in self.contents:
+            with self.fs.open('file.txt', 'wb') as f:
+                f.write(content)
+
+    def assertContents(self):
+        for version, content in enumerate(self.contents, 1):
+            with self.fs.open('file.txt', 'rb', version=version) as f:
+                self.assertEqual(f.read(), content)
+
+    def full_versions(self):
+        snap_dir = self.fs.snapshot_snap_path('file.txt')
+        return [number for number, (_, full, _) in
+                enumerate(self.fs.backend.list_chain(snap_dir), 1) if full]
+
+    def test_plan(self):
+        chain = [(str(t), False, 10) for t in range(1, 10)] + \
+            [('10', True, 100)]
+        self.assertEqual(CheckpointPolicy(every=3).plan(chain),
+                         ['2', '6'])
+        self.assertEqual(CheckpointPolicy(max_delta_bytes=40).plan(chain),
+                         ['5'])
+        self.assertEqual(CheckpointPolicy().plan(chain), [])
+
+    def test_snapshots_keep_checkpoints(self):
+        self.fs.backend.checkpoints = CheckpointPolicy(every=3)
+        self.write_versions()
+        self.assertEqual(self.full_versions(), [4, 8, 10])
+        self.assertEqual(self.fs.restore_cost('file.txt').deltas, 3)
+        self.assertContents()
+
+    def test_max_delta_bytes(self):
+        self.write_versions()
+        snap_dir = self.fs.snapshot_snap_path('file.txt')
+        delta_bytes = self.fs.backend.list_chain(snap_dir)[0][2]
+        self.fs.remove('file.txt')
+        self.fs.backend.checkpoints = CheckpointPolicy(
+            max_delta_bytes=delta_bytes * 2)
+        self.write_versions()
+        self.assertTrue(len(self.full_versions()) > 1)
+        self.assertContents()
+
+    def test_add_checkpoints(self):
+        self.write_versions()
+        cost = self.fs.restore_cost('file.txt')
+        self.assertEqual(cost.deltas, 9)
+        self.assertEqual(self.fs.restore_costs(), [('/file.txt', cost)])
+
+        self.assertEqual(self.fs.add_checkpoints(CheckpointPolicy(every=3)),
+                         2)
+        self.assertEqual(self.fs.add_checkpoints(CheckpointPolicy(every=3)),
+                         0)
+        self.assertEqual(self.full_versions(), [2, 6, 10])
+        self.assertEqual(self.fs.restore_cost('file.txt').deltas, 3)
+        self.assertTrue(self.fs.restore_cost('file.txt') < cost)
+        self.assertContents()
+
+    def test_prune_checkpoint(self):
+        self.fs.backend.checkpoints = CheckpointPolicy(every=3)
+        self.write_versions()
+        timestamps = self.fs.list_versions('file.txt')
+        self.fs.remove_versions('file.txt', [timestamps[3]])
+        self.contents = self.contents[:3] + self.contents[4:]
+        self.assertContents()
+
+    def test_prune_keeps_restore_cost(self):
+        self.fs.backend.checkpoints = CheckpointPolicy(every=2)
+        self.write_versions()
+        self.assertEqual(self.fs.restore_cost('file.txt').deltas, 2)
+
+        # the checkpoints are removed, the prune keeps others in full
+        timestamps = self.fs.list_versions('file.txt')
+        full = self.full_versions()[:-1]
+        self.fs.remove_versions('file.txt',
+                                [timestamps[number - 1] for number in full])
+        self.contents = [content for number, content in
+                         enumerate(self.contents, 1) if number not in full]
+        self.assertTrue(self.fs.restore_cost('file.txt').deltas <= 2)
+        self.assertContents()
+
+    def test_restore_cost(self):
+        self.assertEqual(RestoreCost(0, 0), restore_cost([]))
+        chain = [('1', False, 10), ('2', True, 100), ('3', False, 20),
+                 ('4', True, 200)]
+        self.assertEqual(restore_cost(chain), RestoreCost(1, 220))
+
+    def test_backend_without_chains(self):
+        with self.assertRaises(ValueError):
+            VersioningFS(TempFS(), backup=TempFS(), tmp=TempFS(),
+                         backend=RdiffBackupBackend(),
+                         checkpoints=CheckpointPolicy(every=10))
+
+
+class TestPackedCheckpoints(BasePackedTest, TestCheckpoints):
+    """Test checkpoints with the packed backend."""
+
+
+class TestChunking(unittest.TestCase):
+    """Test content-defined chunk boundaries."""
+    def setUp(self):
+        generator = random.Random(1)
+        self.data = ''.join(chr(generator.randrange(256))
+                            for _ in range(512 * KB))
+
+    def test_chunks(self):
+        chunks = list(chunking.iter_chunks(StringIO(self.data)))
+        self.assertEqual(''.join(chunks), self.data)
+        self.assertTrue(all(len(chunk) <= chunking.MAX_SIZE
+                            for chunk in chunks))
+        self.assertTrue(all(len(chunk) >= chunking.MIN_SIZE
+                            for chunk in chunks[:-1]))
+
+    def test_insertion_moves_few_boundaries(self):
+        chunks = list(chunking.iter_chunks(StringIO(self.data)))
+        edited = self.data[:1000] + 'smartfile' + self.data[1000:]
+        edited_chunks = list(chunking.iter_chunks(StringIO(edited)))
+        self.assertEqual(len(set(chunks) - set(edited_chunks)), 1)
+
+
+class TestChunkStore(BaseChunkedTest):
+    """Test the chunk store shared by every file."""
+    def setUp(self):
+        super(TestChunkStore, self).setUp()
+        self.store_dir = os.path.join(self.fs.backup.getsyspath('/'),
+                                      '.chunks')
+        generator = random.Random(1)
+        self.data = ''.join(chr(generator.randrange(256))
+                            for _ in range(256 * KB))
+
+    def chunk_files(self):
+        return set(name for _, _, names in os.walk(self.store_dir)
+                   for name in names if len(name) == 64)
+
+    def test_copy_stores_no_new_chunks(self):
+        self.fs.makedir('dir')
+        with self.fs.open('dir/file.txt', 'wb') as f:
+            f.write(self.data)
+        chunks = self.chunk_files()
+
+        self.fs.copy('dir/file.txt', 'copy.txt')
+        self.fs.copydir('dir', 'dir copy')
+        self.assertEqual(self.chunk_files(), chunks)
+        self.assertEqual(self.fs.version('copy.txt'), 1)
+        self.assertEqual(self.fs.version('dir copy/file.txt'), 1)
+        with self.fs.open('copy.txt', 'rb', version=1) as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_copy_changed_and_unversioned(self):
+        with self.fs.open('file.txt', 'wb') as f:
+            f.write(self.data)
+        with self.fs.open('file.txt', 'ab', take_snapshot=False) as f:
+            f.write('changed')
+        with self.fs.open('unversioned.txt', 'wb', take_snapshot=False) as f:
+            f.write(self.data)
+
+        # a copy whose content has no version is snapshotted, with the
+        # digest it was compared with, a copy of an unversioned file gets
+        # no version
+        self.fs.copy('file.txt', 'copy.txt')
+        self.fs.copy('unversioned.txt', 'unversioned copy.txt')
+        self.assertEqual(self.fs.version('copy.txt'), 1)
+        self.assertEqual(self.fs.latest_digest('copy.txt'),
+                         hashlib.sha256(self.data + 'changed').hexdigest())
+        with self.fs.open('copy.txt', 'rb', version=1) as f:
+            self.assertEqual(f.read(), self.data + 'changed')
+        self.assertFalse(self.fs.has_snapshot('unversioned copy.txt'))
+
+    def test_shared_chunks_are_kept(self):
+        for path in ['a.txt', 'b.txt']:
+            with self.fs.open(path, 'wb') as f:
+                f.write(self.data)
+        chunks = self.chunk_files()
+        self.fs.remove('a.txt')
+        self.assertEqual(self.chunk_files(), chunks)
+        self.fs.remove('b.txt')
+        self.assertEqual(self.chunk_files(), set())
+
+    def test_versions_share_chunks(self):
+        with self.fs.open('file.txt', 'wb') as f:
+            f.write(self.data)
+        chunks = self.chunk_files()
+        with self.fs.open('file.txt', 'wb') as f:
+            f.write('smartfile' + self.data)
+        self.assertTrue(len(self.chunk_files() - chunks) <= 2)
+
+        sizes = self.fs.list_byte_sizes('file.txt')
+        self.assertEqual(sizes[2].size, len(self.data) + len('smartfile'))
+        self.assertTrue(sizes[1].size < len(self.data) / 4)
+
+    def test_read_while_removed(self):
+        for content in [self.data, self.data[::-1]]:
+            with self.fs.open('file.txt', 'wb') as f:
+                f.write(content)
+        chunks = self.chunk_files()
+
+        f = self.fs.open('file.txt', 'rb', version=1, stream=True)
+        self.fs.remove_versions('file.txt',
+                                [int(self.fs.list_versions('file.txt')[0])])
+        self.assertEqual(f.read(), self.data)
+        f.close()
+        self.assertTrue(len(self.chunk_files()) < len(chunks))
+        self.assertEqual(os.listdir(os.path.join(self.store_dir, 'pins')),
+                         [])
+
+    def test_collect_garbage(self):
+        with self.fs.open('file.txt', 'wb') as f:
+            f.write(self.data)
+        orphan_dir = os.path.join(self.store_dir, '00')
+        os.makedirs(orphan_dir)
+        with open(os.path.join(orphan_dir, '0' * 64), 'wb') as f:
+            f.write('orphan')
+
+        backup_dir = self.fs.backup.getsyspath('/')
+        self.assertEqual(self.fs.backend.collect_garbage(backup_dir), 6)
+        self.assertEqual(self.fs.backend.collect_garbage(backup_dir), 0)
+        with self.fs.open('file.txt', 'rb', version=1) as f:
+            self.assertEqual(f.read(), self.data)
+
+
+class TestSnapshotMaintenance(BaseNativeTest):
+    """Test moving and removing the snapshots of whole directories."""
+    def setUp(self):
+        super(TestSnapshotMaintenance, self).setUp()
+        self.fs.makedir('dir')
+        self.paths = ['dir/%s' % random_filename() for _ in range(20)]
+        for path in self.paths:
+            for content in ['smartfile', 'smartfile versioning']:
+                with self.fs.open(path, 'wb') as f:
+                    f.write(content)
+
+    def test_rename_with_progress(self):
+        progress = []
+        self.fs.rename('dir', 'renamed',
+                       progress=lambda done, total: progress.append(
+                           (done, total)))
+
+        # a single node is moved for the whole directory
+        self.assertEqual(progress, [(1, 1)])
+        for path in self.paths:
+            new_path = path.replace('dir', 'renamed')
+            self.assertFalse(self.fs.has_snapshot(path))
+            with self.fs.open(new_path, 'rb', version=1) as f:
+                self.assertEqual(f.read(), 'smartfile')
+
+    def test_movedir_rollback(self):
+        self.fs.makedir('existing')
+        with self.assertRaises(DestinationExistsError):
+            self.fs.movedir('dir', 'existing')
+
+        # the snapshots stay with the files that were not moved
+        for path in self.paths:
+            self.assertEqual(self.fs.version(path), 2)
+            self.assertFalse(self.fs.has_snapshot(
+                path.replace('dir', 'existing')))
+
+    def test_removedir(self):
+        self.fs.removedir('dir', force=True)
+        for path in self.paths:
+            self.assertFalse(self.fs.has_snapshot(path))
+            self.assertFalse(self.fs.version_catalog(path).exists())
+        backup_dir = self.fs.backup.getsyspath('/')
+        self.assertFalse([name for name in os.listdir(backup_dir)
+                          if name.startswith('.trash')])
+
+    def test_removedir_unversioned_files(self):
+        for _ in range(5):
+            with self.fs.open('dir/%s' % random_filename(), 'wb',
+                              take_snapshot=False) as f:
+                f.write('unversioned')
+        progress = []
+        self.fs.removedir('dir', force=True,
+                          progress=lambda done, total: progress.append(
+                              (done, total)))
+
+        # a deletion for each file with snapshots, and the node of the dir
+        self.assertEqual(progress[-1], (21, 21))
+
+    def test_rename_keeps_snapshot_dirs(self):
+        backup_dir = self.fs.backup.getsyspath('/')
+        before = sorted(os.listdir(backup_dir))
+        self.fs.rename('dir', 'renamed')
+        self.assertEqual(sorted(os.listdir(backup_dir)), before)
+
+        # a new file at an old path starts without versions
+        self.fs.makedir('dir')
+        with self.fs.open(self.paths[0], 'wb') as f:
+            f.write('new file')
+        self.assertEqual(self.fs.version(self.paths[0]), 1)
+        new_path = self.paths[0].replace('dir', 'renamed')
+        self.assertEqual(self.fs.version(new_path), 2)
+
+    def test_snapshots_before_node_index(self):
+        backup = self.fs.backup
+        os.remove(os.path.join(backup.getsyspath('/'), '.nodes.sqlite'))
+        fs = VersioningFS(self.fs.fs, backup=backup, tmp=TempFS(),
+                          testing={'time': 100}, backend=NativeBackend())
+
+        fs.rename('dir', 'renamed')
+        for path in self.paths:
+            new_path = path.replace('dir', 'renamed')
+            self.assertFalse(fs.has_snapshot(path))
+            with fs.open(new_path, 'rb', version=1) as f:
+                self.assertEqual(f.read(), 'smartfile')
+
+    def test_transaction_rollback(self):
+        class Operation(object):
+            def __init__(self, fail=False):
+                self.fail = fail
+                self.state = 'new'
+
+            def apply(self):
+                if self.fail:
+                    raise IOError("failed")
+                self.state = 'applied'
+
+            def revert(self):
+                self.state = 'reverted'
+
+        operations = [Operation() for _ in range(10)] + [Operation(True)]
+        transaction = Transaction(workers=3)
+        for operation in operations:
+            transaction.add(operation)
+        with self.assertRaises(IOError):
+            transaction.apply()
+        self.assertFalse([o for o in operations if o.state == 'applied'])
+
+
 if __name__ == "__main__":
     unittest.main()
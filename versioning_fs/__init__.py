@@ -1,28 +1,49 @@
 """ Filesystem wrapper that provides versioning capabilities through
-    rdiff-backup.
+    rdiff-backup or the native delta backend.
 """
 from collections import namedtuple
+import copy
 import hashlib
 import os
 import random
 import shutil
-from StringIO import StringIO
-from subprocess import Popen, PIPE
+import stat
+import threading
 import time
 
 from fs.filelike import FileWrapper
 from fs.errors import OperationFailedError, ResourceNotFoundError
-from fs.path import relpath
-from fs.tempfs import TempFS
-
-from versioning_fs.errors import SnapshotError, VersionError
+from fs.path import basename, pathjoin, relpath
+
+from versioning_fs.backends import DATAFILE, RdiffBackupBackend, \
+    SnapshotRequest
+from versioning_fs.backends.base import byte_summary
+from versioning_fs.cache import PathCache, RestoreCache
+from versioning_fs.catalog import open_catalog, rebuild_catalogs
+from versioning_fs import checkpoints as checkpointing
+from versioning_fs.compression import get_codec, NO_CODEC
+from versioning_fs.errors import VersionError
 from versioning_fs.hidefs import HideFS
+from versioning_fs.metrics import MemoryMetrics, NULL_METRICS
+from versioning_fs.nodes import INDEX_NAME, new_file_id, NodeIndex
+from versioning_fs.retention import apply_policy
+from versioning_fs.scheduler import SnapshotQueue
+from versioning_fs.staging import HashingReader
+from versioning_fs.transaction import DeleteSnapshot, MoveNode, \
+    RemoveNode, Transaction
+from versioning_fs import version_index
 
 
 hasher = hashlib.sha256  # hashing function to use with backup paths
 
 VersionInfo = namedtuple('VersionInfo', ['timestamp',  'size'])
 
+VersionSize = namedtuple('VersionSize', ['size', 'cumulative'])
+
+RESTORE_CACHE_DIR = 'restore-cache'  # restore cache dir inside tmp
+READ_SIZE = 1024 * 1024  # bytes per read when hashing a version
+SNAPSHOT_BATCH = 100  # files snapshot_many() hands the backend at once
+
 
 def hash_path(path):
     """Returns a hash of a given path."""
@@ -31,6 +52,11 @@ def hash_path(path):
     return dest_hash
 
 
+def parse_time_format(timestamp):
+    """Convert a timestamp in rdiff-backup format into Unix time."""
+    return int(time.mktime(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')))
+
+
 def is_valid_time_format(timestamp):
     """Verify a timestamp format for compatibility with rdiff-backup."""
     try:
@@ -40,32 +66,56 @@ def is_valid_time_format(timestamp):
         return False
 
 
+def parse_time(timestamp):
+    """Returns the Unix time of a Unix time or of a time in rdiff-backup
+       format.
+    """
+    if isinstance(timestamp, basestring):
+        if not is_valid_time_format(timestamp):
+            raise VersionError("Invalid time format.")
+        return parse_time_format(timestamp)
+    return int(timestamp)
+
+
+def _store_in_process(backend, snap_dir, timestamp, tmp_dir, source_path,
+                      hashed=False):
+    """Stores a version of a file, given by its system path, inside a
+       snapshot process pool worker. Returns the SnapshotResult, the
+       metrics the backend recorded, to be replayed by the parent process,
+       and with hashed set, the digest of the content stored.
+    """
+    metrics = MemoryMetrics()
+    backend.metrics = metrics
+    with open(source_path, 'rb') as source_file:
+        if not hashed:
+            result = backend.snapshot(source_file, snap_dir, timestamp,
+                                      tmp_dir, source_path=source_path)
+            return result, metrics, None
+        reader = HashingReader(source_file, hasher)
+        result = backend.snapshot(reader, snap_dir, timestamp, tmp_dir)
+    return result, metrics, reader.hexdigest()
+
+
 class VersionInfoMixIn(object):
     """MixIn that provides versioning information for a filesystem.
     """
 
     def has_snapshot(self, path):
         """Returns if a path has a snapshot."""
-        if os.path.exists(self.snapshot_snap_path(path)):
+        if self.backend.has_versions(self.snapshot_snap_path(path)):
             return True
         return False
 
     def list_versions(self, path):
         """Returns a list of the versions for a file."""
-        snap_dir = self.snapshot_snap_path(path)
-        command = ['rdiff-backup',
-                   '--parsable-output',
-                   '-l', snap_dir]
-        process = Popen(command, stdout=PIPE, stderr=PIPE)
-        stdout = process.communicate()[0]
-
-        versions = []
-        listing_file = StringIO(stdout)
-        for line in listing_file:
-            version_number, _ = line.split()
-            versions.append(version_number)
-
-        return sorted(versions)
+        with self.metrics.timer('list_versions'):
+            catalog = self.version_catalog(path)
+            if not catalog.exists():
+                if not self.has_snapshot(path):
+                    return []
+                # snapshots taken before the catalog existed
+                catalog.rebuild(self.backend)
+            return catalog.timestamps()
 
     def version(self, path):
         """Returns the version of a path."""
@@ -87,31 +137,55 @@ class VersionInfoMixIn(object):
     def list_sizes(self, path):
         """Returns a dictionary containing sizes for each version of a path.
         """
-        snap_dir = self.snapshot_snap_path(path)
-        command = ['rdiff-backup',
-                   '--parsable-output',
-                   '--list-increment-sizes',
-                   snap_dir]
-        process = Popen(command, stdout=PIPE, stderr=PIPE)
-        stdout = process.communicate()[0]
-
-        listing_file = StringIO(stdout)
-        if len(listing_file.readlines()) < 3:
-            return {}
-
-        listing_file.seek(0)
-
-        # skip the first two lines of output
-        for _ in range(2):
-            next(listing_file)
-
-        # generate a dictionary
-        sizes = dict()
-        for version, line in enumerate(reversed(listing_file.readlines())):
-            size = "%s %s" % (line.split()[5], line.split()[6])
-            sizes[version+1] = size
-
-        return sizes
+        return dict((number, byte_summary(size.size))
+                    for number, size in self.list_byte_sizes(path).items())
+
+    def list_byte_sizes(self, path):
+        """Returns a dictionary containing a VersionSize for each version of
+           a path: the bytes stored for the version, and the cumulative bytes
+           stored for it and every newer version, which is what restoring it
+           reads.
+        """
+        with self.metrics.timer('list_sizes'):
+            catalog = self.version_catalog(path)
+            if not catalog.exists():
+                if not self.has_snapshot(path):
+                    return {}
+                # snapshots taken before the catalog existed
+                catalog.rebuild(self.backend)
+            entries = catalog.load()
+            if [entry for entry in entries if 'stored' not in entry]:
+                # versions recorded before their sizes were
+                snap_dir = self.snapshot_snap_path(path)
+                catalog.record_sizes(self.backend.list_byte_sizes(snap_dir))
+                entries = catalog.load()
+
+            sizes = {}
+            cumulative = 0
+            for number in reversed(range(len(entries))):
+                stored = entries[number].get('stored', 0)
+                cumulative += stored
+                sizes[number + 1] = VersionSize(stored, cumulative)
+            return sizes
+
+    def list_codecs(self, path):
+        """Returns a dictionary with the name of the codec each version of a
+           path is stored with.
+        """
+        catalog = self.version_catalog(path)
+        if not catalog.exists():
+            if not self.has_snapshot(path):
+                return {}
+            # snapshots taken before the catalog existed
+            catalog.rebuild(self.backend)
+        entries = catalog.load()
+        if [entry for entry in entries if 'codec' not in entry]:
+            # versions recorded before their codecs were
+            snap_dir = self.snapshot_snap_path(path)
+            catalog.record_codecs(self.backend.list_codecs(snap_dir))
+            entries = catalog.load()
+        return dict((number + 1, entry.get('codec', NO_CODEC.name))
+                    for number, entry in enumerate(entries))
 
 
 class VersioningFS(VersionInfoMixIn, HideFS):
@@ -119,7 +193,13 @@ class VersioningFS(VersionInfoMixIn, HideFS):
 
         This wraps other filesystems, such as OSFS.
     """
-    def __init__(self, fs, backup, tmp, testing=False):
+    def __init__(self, fs, backup, tmp, testing=False, backend=None,
+                 async_snapshots=False, snapshot_workers=2,
+                 snapshot_queue_size=1000, snapshot_pool='thread',
+                 snapshot_window=0, snapshot_put_timeout=None,
+                 restore_cache_size=0, metrics=None,
+                 path_cache_size=100000, maintenance_workers=4,
+                 codec=None, checkpoints=None):
         """
         Parameters
           fs (FS): A filesystem object to be wrapped.
@@ -129,6 +209,49 @@ class VersioningFS(VersionInfoMixIn, HideFS):
           testing (boolean) (default=False): When testing, it's handy to set
                 this to true, since rdiff-backup will prevent the tests
                 from taking quick snapshots of a single file.
+          backend (SnapshotBackend) (optional): Stores the versions of each
+                file. Defaults to RdiffBackupBackend. The codec, checkpoints
+                and metrics are set on a copy of it.
+          async_snapshots (boolean) (default=False): Take snapshots in the
+                background instead of when a modified file is closed.
+          snapshot_workers (int) (default=2): The number of background
+                snapshots taken at the same time.
+          snapshot_queue_size (int) (default=1000): The number of files
+                waiting for a background snapshot before closing a modified
+                file blocks.
+          snapshot_pool (str) (default='thread'): Take background snapshots
+                in a 'thread' or a 'process' pool. With a process pool, the
+                backend stores the versions of files that have a system path
+                in the worker processes; the rest of each snapshot happens
+                in this one.
+          snapshot_window (float) (default=0): Seconds a background snapshot
+                waits after a file is closed. Closing the same file again
+                within the window does not take another snapshot; the
+                single snapshot captures the latest content.
+          snapshot_put_timeout (float) (optional): Seconds closing a
+                modified file waits for room on a full snapshot queue
+                before raising QueueFullError. The file is closed and
+                written, only its snapshot is not queued. Waits as long as
+                it takes if None.
+          restore_cache_size (int) (default=0): Bytes of restored versions
+                kept in the scratch directory, so reading the same version
+                again does not restore it again. Set to 0 to disable.
+          metrics (Metrics) (optional): Receives counters and timings of
+                snapshots, restores, listings and pruning, including the
+                backend's phases. Nothing is recorded by default.
+          path_cache_size (int) (default=100000): The number of paths whose
+                snapshot directory is remembered.
+          maintenance_workers (int) (default=4): The number of snapshots
+                moved or removed at the same time when a directory is
+                renamed, moved or removed.
+          codec (str) (optional): Compresses the versions stored from now
+                on with 'none', 'zlib', 'lz4' or 'zstd', optionally at a
+                level such as 'zstd:9'. Versions stored before keep their
+                codec until they are recompressed. Needs a compressible
+                backend.
+          checkpoints (CheckpointPolicy) (optional): Keeps versions in full
+                among the deltas, so restoring any version applies a bounded
+                number of deltas. Needs a chained backend.
         """
         hide_abs_path = os.path.split(backup.getsyspath('/'))[0]
         # make sure the backups directory is hidden from the user
@@ -138,7 +261,71 @@ class VersioningFS(VersionInfoMixIn, HideFS):
         self.__fs = fs
         self.__backup = backup
         self.__tmp = tmp
+        self.__backup_dir = backup.getsyspath('/')
+        self.__tmp_dir = tmp.getsyspath('/')
+        self.__path_cache = PathCache(path_cache_size)
+        self.__maintenance_workers = maintenance_workers
         self.__testing = testing
+        if backend is None:
+            backend = RdiffBackupBackend()
+        elif codec is not None or checkpoints is not None or \
+                metrics is not None:
+            # the settings are this filesystem's, another one sharing the
+            # backend keeps its own
+            backend = copy.copy(backend)
+        self.__backend = backend
+        if codec is not None:
+            if not backend.compressible:
+                raise ValueError("The %s backend can't compress versions." %
+                                 backend.name)
+            backend.codec = get_codec(codec)
+        if checkpoints is not None:
+            if not backend.chained:
+                raise ValueError("The %s backend doesn't chain versions." %
+                                 backend.name)
+            backend.checkpoints = checkpoints
+        if metrics is None:
+            metrics = NULL_METRICS
+        else:
+            backend.metrics = metrics
+        self.__metrics = metrics
+        self.__catalog_lock = threading.RLock()
+
+        node_index_path = os.path.join(self.__backup_dir, INDEX_NAME)
+        new_index = not os.path.exists(node_index_path)
+        self.__nodes = NodeIndex(node_index_path)
+        if new_index and not backend.list_snap_dirs(self.__backup_dir):
+            # nothing was versioned before the index, every file gets a node
+            self.__nodes.mark_complete()
+        self.__versions = version_index.VersionIndex(
+            os.path.join(self.__backup_dir, version_index.INDEX_NAME),
+            node_index_path)
+
+        self.__async_snapshots = async_snapshots
+        self.__snapshot_queue = None
+        self.__snapshot_queue_options = dict(
+            workers=snapshot_workers, max_size=snapshot_queue_size,
+            pool=snapshot_pool, window=snapshot_window,
+            put_timeout=snapshot_put_timeout,
+            min_interval=backend.min_interval, key=hash_path,
+            metrics=metrics)
+
+        self.__restore_cache = None
+        if restore_cache_size:
+            cache_dir = os.path.join(self.__tmp_dir, RESTORE_CACHE_DIR)
+            self.__restore_cache = RestoreCache(cache_dir, restore_cache_size)
+
+    def __getstate__(self):
+        #  Locks can't be pickled, they are created again when unpickling.
+        state = super(VersioningFS, self).__getstate__()
+        del state['_VersioningFS__catalog_lock']
+        # the snapshot workers are started again when they are needed
+        state['_VersioningFS__snapshot_queue'] = None
+        return state
+
+    def __setstate__(self, state):
+        super(VersioningFS, self).__setstate__(state)
+        self.__catalog_lock = threading.RLock()
 
     @property
     def fs(self):
@@ -155,7 +342,78 @@ class VersioningFS(VersionInfoMixIn, HideFS):
         """Returns the FS object for the scratch directory."""
         return self.__tmp
 
+    @property
+    def backend(self):
+        """Returns the backend that stores the versions."""
+        return self.__backend
+
+    @property
+    def metrics(self):
+        """Returns the sink of the counters and timings."""
+        return self.__metrics
+
+    @property
+    def path_cache(self):
+        """Returns the cache of resolved snapshot directories."""
+        return self.__path_cache
+
+    @property
+    def restore_cache(self):
+        """Returns the cache of restored versions, or None."""
+        return self.__restore_cache
+
+    @property
+    def async_snapshots(self):
+        """Returns if snapshots are taken in the background."""
+        return self.__async_snapshots
+
+    @property
+    def snapshot_queue(self):
+        """Returns the queue of background snapshots."""
+        with self.__catalog_lock:
+            if self.__snapshot_queue is None:
+                self.__snapshot_queue = SnapshotQueue(
+                    self.__queued_snapshot, context=self.backend,
+                    **self.__snapshot_queue_options)
+        return self.__snapshot_queue
+
+    def queue_snapshot(self, path, digest=None, not_before=None):
+        """Queues a snapshot of a path to be taken in the background. Blocks
+           while the snapshot queue is full, and raises QueueFullError if
+           it still is after snapshot_put_timeout seconds.
+
+           The SHA-256 digest of the content can be passed when it is known.
+           It is recorded with the version, and no version is taken if it is
+           the digest of the latest version by then. With not_before, a Unix
+           time, the snapshot is not taken before then.
+        """
+        self.snapshot_queue.put(relpath(path), not_before=not_before,
+                                digest=digest)
+
+    def snapshot_pending(self, path):
+        """Returns if a background snapshot of a path has not finished
+           yet, in which case its latest version is not the latest content.
+        """
+        if self.__snapshot_queue is None:
+            return False
+        return self.__snapshot_queue.is_pending(relpath(path))
+
+    def wait_for_snapshots(self, timeout=None):
+        """Blocks until the queued snapshots have been taken. Returns a list
+           of (path, error) tuples for the snapshots that failed.
+        """
+        if self.__snapshot_queue is None:
+            return []
+        return self.__snapshot_queue.wait(timeout)
+
+    def flush(self):
+        """Takes every queued snapshot before returning."""
+        return self.wait_for_snapshots()
+
     def close(self, *args, **kwargs):
+        if self.__snapshot_queue is not None:
+            self.__snapshot_queue.close()
+            self.__snapshot_queue = None
         self.__fs.close()
         self.__backup.close()
         self.__tmp.close()
@@ -163,7 +421,7 @@ class VersioningFS(VersionInfoMixIn, HideFS):
 
     def open(self, path, mode='r', buffering=-1, encoding=None, errors=None,
              newline=None, line_buffering=False, version=None,
-             take_snapshot=True, **kwargs):
+             take_snapshot=True, stream=False, **kwargs):
         """
         Returns a file-object. The file-object is wrapped with VersionedFile,
             which will notify VersioningFS to make a snapshot whenever
@@ -177,6 +435,10 @@ class VersioningFS(VersionInfoMixIn, HideFS):
             will be returned.
           snapshot (bool): Set to False to avoid taking a snapshot. Defaults
             to True.
+          stream (bool): Set to True to rebuild an older version as it is
+            read, instead of restoring all of it to the scratch directory
+            first. Backends that can't stream restore the version as usual.
+            Defaults to False.
         """
         path = relpath(path)
         if version is None:
@@ -212,135 +474,568 @@ class VersioningFS(VersionInfoMixIn, HideFS):
 
             requested_version = sorted_versions[version-1]
             if mode == "r" or mode == "rb":
+                if stream and self.backend.streaming:
+                    return self.__open_stream(snap_dir, requested_version,
+                                              path, mode)
+                if self.__restore_cache is not None:
+                    return self.__open_cached(snap_dir, requested_version,
+                                              mode)
+
                 temp_name = '%020x' % random.randrange(16**30)
-                dest_path = os.path.join(self.tmp.getsyspath('/'), temp_name)
-                command = ['rdiff-backup',
-                           '--restore-as-of', requested_version,
-                           snap_dir, dest_path]
-                process = Popen(command, stdout=PIPE, stderr=PIPE)
-                process.communicate()
-
-                file_path = os.path.join(temp_name, 'datafile')
+                tmp_dir = self.__tmp_dir
+                dest_path = os.path.join(tmp_dir, temp_name)
+                with self.metrics.timer('restore'):
+                    self.backend.restore(snap_dir, requested_version,
+                                         dest_path, tmp_dir)
+
+                file_path = os.path.join(temp_name, DATAFILE)
                 open_file = self.tmp.open(file_path, mode=mode)
                 return VersionedFile(fs=self, file_object=open_file,
                                      mode=mode, temp_file=True,
                                      path=file_path, remove=dest_path)
 
+    def __open_stream(self, snap_dir, timestamp, path, mode):
+        """Opens a version that is rebuilt as it is read."""
+        with self.metrics.timer('restore.stream'):
+            version_file = self.backend.open_version(snap_dir, timestamp)
+        return VersionedFile(fs=self, file_object=version_file, mode=mode,
+                             path=path, take_snapshot=False)
+
+    def __open_cached(self, snap_dir, timestamp, mode):
+        """Opens a restored version through the restore cache."""
+        key = os.path.basename(snap_dir)
+        cached_path = self.__restore_cache.get(key, timestamp)
+        if cached_path is None:
+            self.metrics.increment('restore.cache_misses')
+            temp_name = '%020x' % random.randrange(16**30)
+            tmp_dir = self.__tmp_dir
+            dest_path = os.path.join(tmp_dir, temp_name)
+            with self.metrics.timer('restore'):
+                self.backend.restore(snap_dir, timestamp, dest_path, tmp_dir)
+            cached_path = self.__restore_cache.put(
+                key, timestamp, os.path.join(dest_path, DATAFILE))
+            shutil.rmtree(dest_path)
+        else:
+            self.metrics.increment('restore.cache_hits')
+
+        file_path = os.path.relpath(cached_path, self.__tmp_dir)
+        try:
+            open_file = self.tmp.open(file_path, mode=mode)
+        except ResourceNotFoundError:
+            # evicted by another reader in the meantime
+            return self.__open_cached(snap_dir, timestamp, mode)
+        return VersionedFile(fs=self, file_object=open_file, mode=mode,
+                             path=file_path, take_snapshot=False)
+
+    def __invalidate_restores(self, path):
+        """Forgets the cached restores of a path."""
+        if self.__restore_cache is not None:
+            self.__restore_cache.invalidate(self.__file_id(path))
+
+    def listdirinfo(self, path="/", wildcard=None, full=False,
+                    absolute=False, dirs_only=False, files_only=False,
+                    versions=False):
+        """Returns a list of (name, info) tuples for the contents of a
+           directory. With versions set, the info of each file also holds
+           the number of versions it has as 'versions'.
+        """
+        entries = super(VersioningFS, self).listdirinfo(
+            path, wildcard=wildcard, full=full, absolute=absolute,
+            dirs_only=dirs_only, files_only=files_only)
+        if versions:
+            files = []
+            for name, info in entries:
+                entry_path = name
+                if not (full or absolute):
+                    entry_path = pathjoin(path, name)
+                if 'st_mode' in info:
+                    is_file = stat.S_ISREG(info['st_mode'])
+                else:
+                    is_file = self.isfile(entry_path)
+                if is_file:
+                    files.append((entry_path, info))
+            self.__count_versions(path, files)
+        return entries
+
+    def __count_versions(self, path, files):
+        """Adds the number of versions of each of a list of (path, info)
+           files inside a directory to the info, as 'versions'.
+
+           The numbers come from the version index in one query. Files it
+           holds no versions of, snapshotted before it existed, are counted
+           one at a time from their catalogs.
+        """
+        if not files:
+            return
+        file_ids = self.__nodes.list_files(path)
+        counts = self.__versions.count_versions(file_ids.values())
+        complete = self.__nodes.complete
+        for entry_path, info in files:
+            file_id = file_ids.get(basename(entry_path))
+            if file_id in counts:
+                info['versions'] = counts[file_id]
+            elif file_id is None and complete:
+                info['versions'] = 0  # never snapshotted
+            else:
+                info['versions'] = self.version(entry_path)
+
     def remove(self, path):
         """Remove a file from the filesystem."""
         super(VersioningFS, self).remove(path)
         self.__delete_snapshot(path)
 
-    def removedir(self, path, recursive=False, force=False):
+    def removedir(self, path, recursive=False, force=False, progress=None):
+        """Remove a directory and the snapshots of the files inside it.
+
+           The snapshots are removed on the maintenance worker threads, and
+           are all kept if the directory can't be removed. progress is called
+           as progress(done, total) as they are removed.
+        """
+        transaction = self.__transaction(progress)
         if self.fs.isdirempty(path) or force:
             rel_path = relpath(path)
             for filename in self.fs.walkfiles(rel_path):
-                self.__delete_snapshot(filename)
-
-        super(VersioningFS, self).removedir(path, recursive, force)
+                self.__invalidate_restores(filename)
+                if not self.has_snapshot(filename):
+                    continue
+                snap_dir = self.snapshot_snap_path(filename)
+                transaction.add(DeleteSnapshot(self.backend, snap_dir,
+                                               self.__backup_dir,
+                                               self.__versions))
+            transaction.add(RemoveNode(self.__nodes, rel_path))
+
+        instance = super(VersioningFS, self)
+        try:
+            self.__run_transaction(transaction, instance.removedir, path,
+                                   recursive, force)
+        finally:
+            self.__path_cache.invalidate_tree(relpath(path))
 
     def __delete_snapshot(self, path):
         """Deletes a snapshot for a given path."""
+        self.__invalidate_restores(path)
         if self.has_snapshot(path):
             snap_dest_dir = self.snapshot_snap_path(path)
-            shutil.rmtree(snap_dest_dir)
+            self.backend.remove(snap_dest_dir)
+        self.version_catalog(path).remove()
+        self.__versions.remove(self.__file_id(path))
+        self.__nodes.remove(path)
+        # the path is gone, don't let it take up room in the cache
+        self.__path_cache.invalidate(relpath(path))
+
+    def copy(self, src, dst, *args, **kwargs):
+        """Copy a file. With a backend that deduplicates, the copy of a
+           versioned file gets a version, see __version_copies().
+        """
+        super(VersioningFS, self).copy(src, dst, *args, **kwargs)
+        if self.backend.deduplicates:
+            self.__version_copies([(relpath(src), relpath(dst))])
+
+    def copydir(self, src, dst, *args, **kwargs):
+        """Copy a directory. With a backend that deduplicates, the copies of
+           versioned files get a version, see __version_copies().
+        """
+        copies = []
+        if self.backend.deduplicates:
+            rel_src = relpath(src)
+            copies = [(relpath(path),
+                       relpath(path).replace(rel_src, relpath(dst), 1))
+                      for path in self.fs.walkfiles(rel_src)]
+        super(VersioningFS, self).copydir(src, dst, *args, **kwargs)
+        self.__version_copies(copies)
+
+    def __version_copies(self, copies):
+        """Gives the copies of versioned files, (source, copy) pairs, a
+           version. A copy with the content of the latest version of its
+           source gets that version, which the backend stores without
+           reading the copy; the others are snapshotted, in the background
+           with async_snapshots. Copies of files without versions get none.
+        """
+        shared = []
+        for src, dst in copies:
+            if not self.fs.isfile(dst) or not self.has_snapshot(src):
+                continue
+            src_digest = self.latest_digest(src)
+            digest = None
+            if src_digest is not None:
+                digest = self.__file_digest(dst)
+            if digest is not None and digest == src_digest:
+                shared.append((src, dst, digest))
+            elif self.__async_snapshots:
+                self.queue_snapshot(dst, digest=digest)
+            else:
+                self.snapshot(dst, digest=digest)
+        if not shared:
+            return
+
+        file_ids = self.__nodes.assign_many(
+            [(dst, hash_path(dst)) for _, dst, _ in shared])
+        records = []
+        for (src, dst, digest), file_id in zip(shared, file_ids):
+            dest_dir = os.path.join(self.__backup_dir, file_id)
+            self.__path_cache.put(dst, dest_dir)
+            is_new = not self.backend.has_versions(dest_dir)
+            src_dir = self.snapshot_snap_path(src)
+            result = self.backend.copy_version(
+                src_dir, self.backend.list_versions(src_dir)[-1], dest_dir,
+                self.__next_timestamp())
+            self.metrics.increment('snapshot.count')
+            records.append(self.__record_snapshot(dst, is_new, result,
+                                                  digest))
+        self.__versions.add_many(records)
+
+    def __file_digest(self, path):
+        """Returns the SHA-256 hex digest of the content of a file."""
+        digest = hasher()
+        with self.fs.open(path, 'rb') as user_file:
+            for data in iter(lambda: user_file.read(READ_SIZE), ''):
+                digest.update(data)
+        return digest.hexdigest()
 
     def move(self, src, dst, *args, **kwargs):
         """Move a file from one place to another."""
-
-        # move the file
-        super(VersioningFS, self).move(src, dst, *args, **kwargs)
-        self.__move_snapshot(src, dst)
+        transaction = self.__transaction()
+        self.__add_node_move(transaction, src, dst)
+        try:
+            self.__run_transaction(transaction, super(VersioningFS, self).move,
+                                   src, dst, *args, **kwargs)
+        finally:
+            self.__forget_paths(src, dst)
 
     def movedir(self, src, dst, *args, **kwargs):
-        """Move a directory from one place to another."""
+        """Move a directory from one place to another.
+
+           The snapshots of the files stay where they are, only the node of
+           the directory moves, unless it is merged into an existing
+           directory with overwrite set. Then the node of each file is moved
+           on the maintenance worker threads, and they are all moved back if
+           the directory can't be moved. A progress callable can be passed as
+           a keyword argument, it is called as progress(done, total) as they
+           are moved.
+        """
+        transaction = self.__transaction(kwargs.pop('progress', None))
+        overwrite = kwargs.get('overwrite', args[0] if args else False)
 
-        # first, move the backups
         rel_src = relpath(src)
         rel_dst = relpath(dst)
-        for path in self.fs.walkfiles(rel_src):
-            if self.has_snapshot(path):
-                new_path = path.replace(rel_src, rel_dst)
-
-                old_abs_path = self.snapshot_snap_path(path)
-                new_abs_path = self.snapshot_snap_path(new_path)
-
-                os.rename(old_abs_path, new_abs_path)
-
-        super(VersioningFS, self).movedir(src, dst, *args, **kwargs)
-
-    def rename(self, src, dst):
-        """Rename a file."""
-
-        # collect a list of paths
-        paths = []
-        if super(VersioningFS, self).isdir(src):
-            for path in super(VersioningFS, self).walkfiles(src):
-                paths.append(path)
+        if overwrite and self.fs.exists(rel_dst):
+            for path in self.fs.walkfiles(rel_src):
+                new_path = relpath(path).replace(rel_src, rel_dst, 1)
+                self.__add_node_move(transaction, path, new_path)
         else:
-            paths = [src]
-
-        # rename the file
-        super(VersioningFS, self).rename(src, dst)
-
-        # move versions under the path
+            self.__add_node_move(transaction, rel_src, rel_dst)
+
+        try:
+            self.__run_transaction(transaction,
+                                   super(VersioningFS, self).movedir,
+                                   src, dst, *args, **kwargs)
+        finally:
+            self.__forget_paths(src, dst, tree=True)
+
+    def rename(self, src, dst, progress=None):
+        """Rename a file or a directory, along with the snapshots of the
+           files it holds. Only the node of the path moves, so this takes
+           the same time however many files are under it.
+        """
+        transaction = self.__transaction(progress)
+        self.__add_node_move(transaction, src, dst)
+        is_dir = self.fs.isdir(src)
+        try:
+            self.__run_transaction(transaction,
+                                   super(VersioningFS, self).rename, src, dst)
+        finally:
+            self.__forget_paths(src, dst, tree=is_dir)
+
+    def __transaction(self, progress=None):
+        """Returns a new transaction for snapshot maintenance."""
+        return Transaction(workers=self.__maintenance_workers,
+                           progress=progress)
+
+    def __run_transaction(self, transaction, operation, *args, **kwargs):
+        """Applies a transaction and then calls a filesystem operation. The
+           transaction is rolled back if the operation fails.
+        """
+        transaction.apply()
+        try:
+            result = operation(*args, **kwargs)
+        except Exception:
+            transaction.rollback()
+            raise
+        transaction.commit()
+        return result
+
+    def __add_node_move(self, transaction, src, dst):
+        """Adds moving the node of a path, and with it the snapshots of the
+           files under it, to a transaction.
+        """
+        self.__index_files(src)
+        # a file that is replaced loses its snapshots
+        self.__invalidate_restores(dst)
+        transaction.add(MoveNode(self.__nodes, self.backend, relpath(src),
+                                 relpath(dst), self.__backup_dir,
+                                 self.__versions))
+
+    def __forget_paths(self, src, dst, tree=False):
+        """Forgets what the source and the destination of a move resolve to,
+           and with tree set, the paths under them.
+        """
+        for path in (src, dst):
+            if tree:
+                self.__path_cache.invalidate_tree(relpath(path))
+            else:
+                self.__path_cache.invalidate(relpath(path))
+
+    def index_files(self, path='/'):
+        """Adds the files under a path that were snapshotted before the node
+           index existed to the index. Renames do this as needed, indexing
+           the whole tree once makes them take the same time for any path.
+        """
+        self.__index_files(path, force=True)
+        if not relpath(path):
+            self.__nodes.mark_complete()
+
+    def __index_files(self, path, force=False):
+        if self.__nodes.complete and not force:
+            return
+        if self.fs.isdir(path):
+            paths = self.fs.walkfiles(path)
+        else:
+            paths = [path]
+        self.__nodes.assign_many([(file_path, hash_path(file_path))
+                                  for file_path in paths
+                                  if self.has_snapshot(file_path)])
+
+    def snapshot(self, path, digest=None):
+        """Takes a snapshot of an individual file. Returns a SnapshotResult
+           with the timestamp of the new version and the strategy used to
+           stage the file: 'hardlink', 'reflink' or 'copy'.
+
+           The SHA-256 digest of the content can be passed when it is already
+           known, it is recorded with the version.
+
+           Versions of a path are kept the backend's min_interval apart, like
+           the background queue keeps them: a snapshot that comes sooner, or
+           while a background snapshot of the path is pending, is queued to
+           be taken once the interval has passed, and None is returned.
+           Snapshots queued that way coalesce, and their errors are returned
+           by wait_for_snapshots().
+        """
+        not_before = self.__interval_end(path)
+        if not_before is not None or self.snapshot_pending(path):
+            self.queue_snapshot(path, digest=digest, not_before=not_before)
+            return None
+        return self.__snapshot(path, digest)
+
+    def __interval_end(self, path):
+        """Returns when the backend's min_interval since the latest version
+           of a path ends, or None if it has.
+        """
+        if not self.backend.min_interval or self.__testing:
+            return None
+        versions = self.list_versions(path)
+        if versions:
+            end = int(versions[-1]) + self.backend.min_interval
+            if end > time.time():
+                return end
+        return None
+
+    def __queued_snapshot(self, path, digest=None):
+        """Takes a snapshot from the snapshot queue."""
+        if digest is not None and digest == self.latest_digest(path):
+            # a snapshot queued earlier stored the same content
+            self.metrics.increment('snapshot.unchanged')
+            return None
+        return self.__snapshot(path, digest, queue=self.__snapshot_queue)
+
+    def __snapshot(self, path, digest=None, queue=None):
+        """Takes a snapshot of a file. With a queue that uses a process
+           pool, only storing the version happens in a worker process, so
+           the node index, the caches and the metrics stay in this one.
+
+           A background snapshot reads the file some time after the digest
+           was taken, so when one is passed, the content is hashed as it is
+           stored and that digest is recorded instead.
+        """
+        path = relpath(path)
+        hashed = queue is not None and digest is not None
+        try:
+            with self.metrics.timer('snapshot'):
+                with self.fs.open(path, 'rb') as source_file:
+                    (request, is_new), = self.__snapshot_requests(
+                        [(path, source_file)])
+                    if queue is not None and queue.uses_processes and \
+                            request.source_path is not None:
+                        result, metrics, stored_digest = queue.run(
+                            _store_in_process, request.snap_dir,
+                            request.timestamp, self.__tmp_dir,
+                            request.source_path, hashed)
+                        metrics.replay(self.metrics)
+                    elif hashed:
+                        # staged through Python, to hash what is stored
+                        reader = HashingReader(source_file, hasher)
+                        result = self.backend.snapshot(
+                            reader, request.snap_dir, request.timestamp,
+                            self.__tmp_dir)
+                        stored_digest = reader.hexdigest()
+                    else:
+                        result = self.backend.snapshot(
+                            source_file, request.snap_dir, request.timestamp,
+                            self.__tmp_dir,
+                            source_path=request.source_path)
+        except Exception:
+            self.metrics.increment('snapshot.errors')
+            raise
+
+        if hashed:
+            digest = stored_digest
+        self.metrics.increment('snapshot.count')
+        self.__versions.add_many(
+            [self.__record_snapshot(path, is_new, result, digest)])
+        return result
+
+    def snapshot_many(self, paths, parallelism=1):
+        """Takes a snapshot of each of a list of files.
+
+           The paths are split into at most `parallelism` groups that are
+           snapshotted at the same time. Each group is handed to the backend
+           in batches of SNAPSHOT_BATCH files, and every batch updates the
+           node index and the version index in one transaction each. Returns
+           a tuple of two dictionaries: the SnapshotResult of each path that
+           was snapshotted and the error of each path that was not.
+        """
+        unique_paths = []
         for path in paths:
-            dst_path = path.replace(src, dst)
-            self.__move_snapshot(path, dst_path)
-
-    def __move_snapshot(self, src, dst):
-        """Move the snapshot associated with a file."""
-        if self.has_snapshot(src):
-            src_snapshot = self.snapshot_snap_path(src)
-            dst_snapshot = self.snapshot_snap_path(dst)
-            if os.path.exists(dst_snapshot):
-                shutil.rmtree(dst_snapshot)
-            shutil.move(src_snapshot, dst_snapshot)
-
-    def snapshot(self, path):
-        """Takes a snapshot of an individual file."""
-
-        # try grabbing the temp filesystem system path
-        temp_dir = None
-        temp_dir = self.tmp.getsyspath('/')
-
-        # Create a temp file system to be snapshotted
-        temp_snapshot_fs = TempFS(temp_dir=temp_dir)
-        src_path = temp_snapshot_fs.getsyspath('/')
-
-        with self.fs.open(path, 'rb') as source_file:
-            with temp_snapshot_fs.open('datafile', 'wb') as temp_file:
-                shutil.copyfileobj(source_file, temp_file)
-
-        # snapshot destination directory
-        dest_dir = self.snapshot_snap_path(path)
-
-        command = ['rdiff-backup',
-                   '--parsable-output',
-                   '--no-eas',
-                   '--no-file-statistics',
-                   '--no-acls',
-                   '--tempdir', self.tmp.getsyspath('/'),
-                   src_path, dest_dir]
-
+            path = relpath(path)
+            if path not in unique_paths:
+                unique_paths.append(path)
+
+        parallelism = max(1, min(parallelism, len(unique_paths)))
+        groups = [unique_paths[i::parallelism] for i in range(parallelism)]
+        results = {}
+        errors = {}
+
+        def take_snapshots(group):
+            for start in range(0, len(group), SNAPSHOT_BATCH):
+                batch = group[start:start + SNAPSHOT_BATCH]
+                try:
+                    self.__snapshot_batch(batch, results, errors)
+                except Exception as error:
+                    for path in batch:
+                        if path not in results:
+                            errors.setdefault(path, error)
+
+        threads = [threading.Thread(target=take_snapshots, args=(group,))
+                   for group in groups]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results, errors
+
+    def __snapshot_batch(self, paths, results, errors):
+        """Takes a snapshot of a batch of files for snapshot_many()."""
+        sources = []
+        try:
+            for path in paths:
+                try:
+                    sources.append((path, self.fs.open(path, 'rb')))
+                except Exception as error:
+                    self.metrics.increment('snapshot.errors')
+                    errors[path] = error
+            if not sources:
+                return
+
+            requests = self.__snapshot_requests(sources)
+            outcomes = self.backend.snapshot_many(
+                [request for request, _ in requests], self.__tmp_dir)
+        finally:
+            for _, source_file in sources:
+                source_file.close()
+
+        records = []
+        for (path, _), (_, is_new), outcome in zip(sources, requests,
+                                                   outcomes):
+            if isinstance(outcome, Exception):
+                self.metrics.increment('snapshot.errors')
+                errors[path] = outcome
+                continue
+            self.metrics.increment('snapshot.count')
+            try:
+                records.append(self.__record_snapshot(path, is_new, outcome))
+            except Exception as error:
+                errors[path] = error
+            else:
+                results[path] = outcome
+        self.__versions.add_many(records)
+
+    def __snapshot_requests(self, sources):
+        """Returns a (SnapshotRequest, is new) pair for each of a list of
+           (path, open source file) pairs, is new telling if the path has no
+           snapshot yet.
+
+           The paths are given their file IDs, in one transaction, only now
+           that their sources are open, so a path that can't be read is
+           left without a node.
+        """
+        file_ids = self.__nodes.assign_many(
+            [(path, hash_path(path)) for path, _ in sources])
+        requests = []
+        for (path, source_file), file_id in zip(sources, file_ids):
+            # snapshot destination directory, kept if the file is renamed
+            dest_dir = os.path.join(self.__backup_dir, file_id)
+            self.__path_cache.put(path, dest_dir)
+            is_new = not self.backend.has_versions(dest_dir)
+            source_path = self.fs.getsyspath(path, allow_none=True)
+            request = SnapshotRequest(lambda source_file=source_file:
+                                      source_file, dest_dir,
+                                      self.__next_timestamp(), source_path)
+            requests.append((request, is_new))
+        return requests
+
+    def __next_timestamp(self):
+        """Returns the timestamp of a new version."""
         # speed up the tests
         if self.__testing:
-            command.insert(5, '--current-time')
-            command.insert(6, str(self.__testing['time']))
-            self.__testing['time'] += 1
-
-        process = Popen(command, stdout=PIPE, stderr=PIPE)
-        stderr = process.communicate()[1]
-
-        ignore = [lambda x: x.startswith("Warning: could not determine case")]
-
-        if len(stderr) is not 0:
-            for rule in ignore:
-                if not rule(stderr):
-                    raise SnapshotError(stderr)
-
-        # close the temp snapshot filesystem
-        temp_snapshot_fs.close()
+            with self.__catalog_lock:
+                timestamp = self.__testing['time']
+                self.__testing['time'] += 1
+            return timestamp
+        return int(time.time())
+
+    def __record_snapshot(self, path, is_new, result, digest=None):
+        """Records a new version of a path in its catalog. Returns its
+           record for VersionIndex.add_many().
+        """
+        snap_dir = self.snapshot_snap_path(path)
+        file_id = os.path.basename(snap_dir)
+        try:
+            size = self.fs.getsize(path)
+        except ResourceNotFoundError:
+            size = None  # removed since
+        # storing a version can change how the previous one is stored
+        stored = self.backend.list_byte_sizes(snap_dir, newest=2)
+        codecs = []
+        if self.backend.compressible:
+            codecs = self.backend.list_codecs(snap_dir, newest=2)
+
+        with self.__catalog_lock:
+            catalog = self.version_catalog(path)
+            if is_new or catalog.exists():
+                if digest is None:
+                    catalog.add(result.timestamp)
+                else:
+                    catalog.add(result.timestamp, digest=digest)
+                catalog.record_sizes(stored)
+                if codecs:
+                    catalog.record_codecs(codecs)
+            else:
+                # snapshots taken before the catalog existed
+                catalog.rebuild(self.backend)
+                self.__versions.replace(
+                    file_id, [(entry['timestamp'], None, entry.get('stored'))
+                              for entry in catalog.load()])
+        return file_id, result.timestamp, size, stored
 
     def remove_versions_before(self, path, version):
         """Removes snapshots before a specified version.
@@ -363,40 +1058,246 @@ class VersioningFS(VersionInfoMixIn, HideFS):
                 raise VersionError("Invalid version.")
 
         if isinstance(version, int):
-            current_version = self.version(path)
+            sorted_versions = self.list_versions(path)
+            current_version = len(sorted_versions)
             # Versions can't be deleted before version 1 or after the current
             if version > current_version or version <= 1:
                 raise VersionError("Invalid version.")
 
-            date_to_delete = self.list_info(path)[version]
+            time_to_delete = int(sorted_versions[version-1])
         else:
             # check for an invalid timestamp string
             if not is_valid_time_format(version):
                 raise VersionError("Invalid time format.")
 
-            date_to_delete = version
+            time_to_delete = parse_time_format(version)
 
         snap_dir = self.snapshot_snap_path(path)
-        command = ['rdiff-backup',
-                   '--parsable-output',
-                   '--force',
-                   '--remove-older-than', str(date_to_delete),
-                   '--tempdir', self.tmp.getsyspath('/'),
-                   snap_dir]
-        process = Popen(command, stdout=PIPE, stderr=PIPE)
-        stderr = process.communicate()[1]
-
-        if len(stderr) > 0:
+        self.__invalidate_restores(path)
+        try:
+            with self.metrics.timer('prune'):
+                self.backend.remove_older_than(snap_dir, time_to_delete,
+                                               self.__tmp_dir)
+        except OperationFailedError:
             raise OperationFailedError(path)
 
+        with self.__catalog_lock:
+            self.version_catalog(path).remove_before(time_to_delete)
+        self.__versions.remove_before(self.__file_id(path), time_to_delete)
+
+    def remove_versions(self, path, timestamps):
+        """Removes the versions of a path taken at the given times (int).
+           The latest version is always kept. Backends without
+           selective_prune can only remove the oldest versions, and raise
+           VersionError otherwise.
+        """
+        if not self.has_snapshot(path):
+            raise ResourceNotFoundError(path)
+
+        snap_dir = self.snapshot_snap_path(path)
+        self.__invalidate_restores(path)
+        with self.metrics.timer('prune'):
+            self.backend.remove_versions(snap_dir, timestamps,
+                                         self.__tmp_dir)
+
+        # rewritten deltas change the bytes stored for the kept versions
+        sizes = self.backend.list_byte_sizes(snap_dir)
+        kept = set(timestamp for timestamp, _ in sizes)
+        removed = [t for t in timestamps if str(t) not in kept]
+        file_id = os.path.basename(snap_dir)
+        with self.__catalog_lock:
+            catalog = self.version_catalog(path)
+            catalog.remove_versions(removed)
+            catalog.record_sizes(sizes)
+            if self.backend.compressible:
+                catalog.record_codecs(self.backend.list_codecs(snap_dir))
+        self.__versions.remove_versions(file_id, removed)
+        self.__versions.record_sizes(file_id, sizes)
+
+    def apply_retention(self, policy, path='/', workers=None, dry_run=False,
+                        files_per_second=None, bytes_per_second=None,
+                        now=None):
+        """Applies a RetentionPolicy to every file under a path, on a pool
+           of worker threads, and returns a RetentionReport.
+
+           Files are found through the version index, so snapshots taken
+           before it existed need rebuild_version_index() first. See
+           retention.apply_policy() for the parameters.
+        """
+        if workers is None:
+            workers = self.__maintenance_workers
+        with self.metrics.timer('retention'):
+            return apply_policy(self, policy, self.__versions.iter_files(),
+                                workers=workers, dry_run=dry_run,
+                                files_per_second=files_per_second,
+                                bytes_per_second=bytes_per_second, now=now,
+                                path=path)
+
+    def add_checkpoints(self, policy=None):
+        """Stores in full the versions a CheckpointPolicy asks for in every
+           file, the backend's policy if none is given, so existing long
+           chains of deltas get the bound new snapshots get. Returns the
+           number of versions stored in full.
+        """
+        if policy is None:
+            policy = self.backend.checkpoints
+        if policy is None:
+            raise ValueError("No checkpoint policy.")
+        with self.metrics.timer('checkpoints'):
+            return checkpointing.add_checkpoints(
+                self.__backup_dir, self.backend, policy, self.__tmp_dir)
+
+    def restore_cost(self, path):
+        """Returns the RestoreCost, the deltas applied and the bytes read,
+           of the version of a path that is the most expensive to restore.
+        """
+        if not self.has_snapshot(path):
+            raise ResourceNotFoundError(path)
+        return checkpointing.restore_cost(
+            self.backend.list_chain(self.snapshot_snap_path(path)))
+
+    def restore_costs(self):
+        """Returns (path, RestoreCost) of the most expensive version to
+           restore of every file, the most expensive first. Files are found
+           through the version index, see rebuild_version_index().
+        """
+        paths = dict(self.__versions.iter_paths())
+        return [(paths[os.path.basename(snap_dir)], cost)
+                for snap_dir, cost in checkpointing.restore_costs(
+                    self.__backup_dir, self.backend)
+                if os.path.basename(snap_dir) in paths]
+
+    def latest_digest(self, path):
+        """Returns the recorded SHA-256 digest of the latest version of a
+           path, or None if it is not known.
+        """
+        entries = self.version_catalog(path).load()
+        if not entries:
+            return None
+        return entries[-1].get('digest')
+
+    def version_digest(self, path, version):
+        """Returns the SHA-256 hex digest of a version of a path. Digests
+           that were not recorded when the version was taken are computed
+           and recorded.
+        """
+        sorted_versions = self.list_versions(path)
+        if version < 1 or version > len(sorted_versions):
+            raise ResourceNotFoundError("Version %s not found" % (version))
+
+        timestamp = sorted_versions[version-1]
+        catalog = self.version_catalog(path)
+        for entry in catalog.load():
+            if entry['timestamp'] == timestamp and 'digest' in entry:
+                return entry['digest']
+
+        digest = hasher()
+        with self.open(path, 'rb', version=version) as version_file:
+            for data in iter(lambda: version_file.read(READ_SIZE), ''):
+                digest.update(data)
+        digest = digest.hexdigest()
+
+        with self.__catalog_lock:
+            catalog.update(timestamp, digest=digest)
+        return digest
+
+    def read_version_range(self, path, version, offset, length):
+        """Returns up to `length` bytes of a version of a path, starting at
+           `offset`.
+
+           With a backend that streams versions, only the parts of the
+           deltas that cover the range are read. Otherwise the version is
+           restored first.
+        """
+        path = relpath(path)
+        sorted_versions = self.list_versions(path)
+        if version < 1 or version > len(sorted_versions):
+            raise ResourceNotFoundError("Version %s not found" % (version))
+
+        with self.metrics.timer('restore.range'):
+            if version == len(sorted_versions):
+                version_file = self.fs.open(path, 'rb')
+            elif self.backend.streaming:
+                snap_dir = self.snapshot_snap_path(path)
+                version_file = self.backend.open_version(
+                    snap_dir, sorted_versions[version-1])
+            else:
+                version_file = self.open(path, 'rb', version=version)
+
+            with version_file:
+                version_file.seek(offset)
+                return version_file.read(length)
+
+    def rebuild_catalog(self, path=None):
+        """Rebuilds the version catalog of a path from the backend data. If
+           no path is given, every snapshot directory in the backup tree is
+           rebuilt.
+        """
+        with self.__catalog_lock:
+            if path is None:
+                rebuild_catalogs(self.__backup_dir, self.backend)
+            elif self.has_snapshot(path):
+                self.version_catalog(path).rebuild(self.backend)
+
+    def rebuild_version_index(self):
+        """Rebuilds the version index from the backend data, for snapshots
+           taken before it existed. The content sizes of those versions are
+           not known, only the bytes stored for them.
+
+           The index finds the paths of the versions through the node index,
+           so the files snapshotted before that existed are indexed first,
+           see index_files().
+        """
+        self.index_files()
+        for snap_dir in self.backend.list_snap_dirs(self.__backup_dir):
+            versions = self.backend.list_versions(snap_dir)
+            sizes = dict(self.backend.list_byte_sizes(snap_dir))
+            self.__versions.replace(os.path.basename(snap_dir),
+                                    [(timestamp, None, sizes.get(timestamp))
+                                     for timestamp in versions])
+
+    def changed_since(self, timestamp):
+        """Returns (path, timestamp) of the files with a version taken at or
+           after a time, with the time of their latest version, oldest
+           first.
+
+           The time can be Unix time (int) or a time (str) in the following
+           format: '%Y-%m-%dT%H:%M:%S'
+        """
+        return self.__versions.changed_since(parse_time(timestamp))
+
+    def top_by_size(self, count=10):
+        """Returns (path, bytes) of the count files whose versions take up
+           the most bytes in the backup store, largest first.
+        """
+        return self.__versions.top_by_size(count)
+
+    def iter_versions(self, since=None, until=None):
+        """Yields a VersionRecord (path, version, timestamp, size, stored)
+           for every version of every file taken between two times, both
+           included, oldest first. See changed_since() for the time formats.
+        """
+        if since is not None:
+            since = parse_time(since)
+        if until is not None:
+            until = parse_time(until)
+        return self.__versions.iter_versions(since, until)
+
+    def version_catalog(self, path):
+        """Returns the version catalog for a given path."""
+        return open_catalog(self.snapshot_snap_path(path), self.backend)
+
+    def __file_id(self, path):
+        """Returns the ID the snapshots of a path are stored under."""
+        return os.path.basename(self.snapshot_snap_path(path))
+
     def snapshot_info_path(self, path):
         """Returns the snapshot info file path for a given path."""
 
-        path = relpath(path)
         # find where the snapshot info file should be
-        dest_hash = hash_path(path)
+        dest_hash = os.path.basename(self.snapshot_snap_path(path))
         info_filename = "%s.info" % (dest_hash)
-        info_path = os.path.join(self.__tmp.getsyspath('/'), info_filename)
+        info_path = os.path.join(self.__tmp_dir, info_filename)
 
         return info_path
 
@@ -404,16 +1305,24 @@ class VersioningFS(VersionInfoMixIn, HideFS):
         """Returns the dir containing the snapshots for a given path."""
 
         path = relpath(path)
-        dest_hash = hash_path(path)
-
-        backup_dir = self.backup.getsyspath('/')
-        save_snap_dir = os.path.join(backup_dir, dest_hash)
+        save_snap_dir = self.__path_cache.get(path)
+        if save_snap_dir is None:
+            file_id = self.__nodes.resolve(path, hash_path(path))
+            if file_id is None:
+                # nothing is stored for the path yet
+                return os.path.join(self.__backup_dir, new_file_id())
+            save_snap_dir = os.path.join(self.__backup_dir, file_id)
+            self.__path_cache.put(path, save_snap_dir)
         return save_snap_dir
 
 
 class VersionedFile(FileWrapper):
     """File wrapper that notifies the versioning filesystem to take a
        snapshot if the file has been modified.
+
+       When a file is written sequentially from the start, a digest of its
+       content is kept as it is written. If it matches the digest of the
+       latest version, no snapshot is taken.
     """
     def __init__(self, file_object, mode, fs, path, temp_file=False,
                  remove=None, take_snapshot=True):
@@ -428,9 +1337,25 @@ class VersionedFile(FileWrapper):
         self.__remove = remove
         self.__version_created = False
 
-    def _write(self, *args, **kwargs):
+        # only a truncated file can be hashed as it is written
+        self.__digest = None
+        if 'w' in mode and take_snapshot and not temp_file:
+            self.__digest = hasher()
+
+    def _write(self, string, *args, **kwargs):
         self.__is_modified = True
-        return super(VersionedFile, self)._write(*args, **kwargs)
+        if self.__digest is not None:
+            self.__digest.update(string)
+        return super(VersionedFile, self)._write(string, *args, **kwargs)
+
+    def _seek(self, *args, **kwargs):
+        # the content is no longer written in order
+        self.__digest = None
+        return super(VersionedFile, self)._seek(*args, **kwargs)
+
+    def _truncate(self, *args, **kwargs):
+        self.__digest = None
+        return super(VersionedFile, self)._truncate(*args, **kwargs)
 
     def writelines(self, *args, **kwargs):
         self.__is_modified = True
@@ -438,6 +1363,10 @@ class VersionedFile(FileWrapper):
 
     def close(self):
         """Close the file and make a snapshot if the file was modified.
+
+           With background snapshots, raises QueueFullError if the snapshot
+           queue stays full for snapshot_put_timeout seconds. The file is
+           closed by then, only its snapshot is not taken.
         """
         super(VersionedFile, self).close()
 
@@ -447,14 +1376,21 @@ class VersionedFile(FileWrapper):
 
         if not self.__version_created and self.__take_snapshot and \
                 self.__is_modified:
-            max_tries = 3  # limit the amount of tries to make a snapshot
-
-            for _ in range(max_tries):
-                try:
-                    self.__fs.snapshot(self.__path)
-                    self.__version_created = True
-                except SnapshotError:
-                    # rdiff-backup must wait 1 second between the same file.
-                    time.sleep(1)
-                else:
-                    break
+            digest = None
+            if self.__digest is not None:
+                digest = self.__digest.hexdigest()
+                # a pending background snapshot will store newer content
+                # than the latest version, which can't be compared with
+                if not self.__fs.snapshot_pending(self.__path) and \
+                        digest == self.__fs.latest_digest(self.__path):
+                    # the same content as the latest version
+                    self.__fs.metrics.increment('snapshot.unchanged')
+                    return
+
+            if self.__fs.async_snapshots:
+                self.__fs.queue_snapshot(self.__path, digest=digest)
+                self.__version_created = True
+                return
+
+            self.__fs.snapshot(self.__path, digest=digest)
+            self.__version_created = True
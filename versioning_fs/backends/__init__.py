@@ -0,0 +1,29 @@
+""" Storage backends that keep the versions of snapshotted files.
+"""
+from versioning_fs.backends.base import DATAFILE, SnapshotBackend, \
+    SnapshotRequest, SnapshotResult
+from versioning_fs.backends.chunked import ChunkedBackend
+from versioning_fs.backends.native import NativeBackend
+from versioning_fs.backends.packed import PackedBackend
+from versioning_fs.backends.rdiff import RdiffBackupBackend
+
+
+BACKENDS = {
+    ChunkedBackend.name: ChunkedBackend,
+    NativeBackend.name: NativeBackend,
+    PackedBackend.name: PackedBackend,
+    RdiffBackupBackend.name: RdiffBackupBackend,
+}
+
+
+def get_backend(name):
+    """Returns a new backend instance for a backend name."""
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError("Unknown backend: %s" % name)
+
+
+__all__ = ['BACKENDS', 'ChunkedBackend', 'DATAFILE', 'get_backend',
+           'NativeBackend', 'PackedBackend', 'RdiffBackupBackend',
+           'SnapshotBackend', 'SnapshotRequest', 'SnapshotResult']
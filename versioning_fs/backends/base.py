@@ -0,0 +1,212 @@
+""" Interface shared by the snapshot storage backends.
+"""
+from collections import namedtuple
+import os
+import shutil
+
+from versioning_fs.compression import NO_CODEC
+from versioning_fs.errors import VersionError
+from versioning_fs.metrics import NULL_METRICS
+
+
+SnapshotResult = namedtuple('SnapshotResult', ['timestamp', 'strategy'])
+
+# a file to snapshot: open() returns the source file object
+SnapshotRequest = namedtuple('SnapshotRequest', ['open', 'snap_dir',
+                                                 'timestamp', 'source_path'])
+
+DATAFILE = 'datafile'  # name of a restored file inside its directory
+
+
+def byte_summary(byte_count):
+    """Returns a human readable byte count in the style of rdiff-backup."""
+    abbreviations = [(1024 ** 4, 'TB'), (1024 ** 3, 'GB'),
+                     (1024 ** 2, 'MB'), (1024, 'KB')]
+    for abbrev_bytes, abbrev_string in abbreviations:
+        if byte_count >= abbrev_bytes:
+            abbrev_count = float(byte_count) / abbrev_bytes
+            if abbrev_count >= 100:
+                precision = 0
+            elif abbrev_count >= 10:
+                precision = 1
+            else:
+                precision = 2
+            return "%.*f %s" % (precision, abbrev_count, abbrev_string)
+    if byte_count == 1:
+        return "1 byte"
+    return "%d bytes" % byte_count
+
+
+class SnapshotBackend(object):
+    """Stores the versions of a single file inside a snapshot directory.
+
+    Timestamps are Unix times. Versions are identified by their timestamp,
+    formatted as a string when they are listed.
+    """
+    name = None
+    min_interval = 0  # seconds required between two versions of a file
+    metrics = NULL_METRICS  # receives the timings of each phase
+    streaming = False  # if versions can be read without restoring them
+    selective_prune = False  # if any version can be removed, not only the
+    #                          oldest ones
+    compressible = False  # if versions can be stored with a codec
+    deduplicates = False  # if data is stored once however many files hold it
+    chained = False  # if versions are deltas rebuilt from newer versions
+    checkpoints = None  # a CheckpointPolicy keeping some versions of a chain
+    #                     in full
+    codec = NO_CODEC  # compresses the versions stored from now on
+
+    def snapshot(self, source_file, snap_dir, timestamp, tmp_dir,
+                 source_path=None):
+        """Stores the content of an open file object as a new version. When
+           the file has a system path, it can be passed as source_path to
+           avoid copying the data through Python.
+
+           Returns a SnapshotResult with the timestamp the version was
+           stored under and the staging strategy used to read the file.
+        """
+        raise NotImplementedError
+
+    def snapshot_many(self, requests, tmp_dir):
+        """Stores a new version for each of a list of SnapshotRequests.
+           Returns a list with a SnapshotResult, or the error raised, for
+           each request in order.
+
+           Backends that can store several files at once override this.
+        """
+        outcomes = []
+        for request in requests:
+            try:
+                with request.open() as source_file:
+                    outcome = self.snapshot(source_file, request.snap_dir,
+                                            request.timestamp, tmp_dir,
+                                            source_path=request.source_path)
+            except Exception as error:
+                outcome = error
+            outcomes.append(outcome)
+        return outcomes
+
+    def restore(self, snap_dir, timestamp, dest_dir, tmp_dir):
+        """Restores the newest version not newer than a timestamp into
+           DATAFILE inside a new directory.
+        """
+        raise NotImplementedError
+
+    def open_version(self, snap_dir, timestamp):
+        """Returns a read-only, seekable file object with the newest version
+           not newer than a timestamp, rebuilt as it is read. Only backends
+           that set streaming implement this.
+        """
+        raise NotImplementedError
+
+    def copy_version(self, src_dir, timestamp, dst_dir, new_timestamp):
+        """Stores a version of a snapshot directory as a new version of
+           another one, without reading its content. Only backends that set
+           deduplicates implement this.
+        """
+        raise NotImplementedError
+
+    def remove_older_than(self, snap_dir, timestamp, tmp_dir):
+        """Removes the versions older than a timestamp. The most recent
+           version is always kept.
+        """
+        raise NotImplementedError
+
+    def remove_versions(self, snap_dir, timestamps, tmp_dir):
+        """Removes the versions with the given timestamps. The most recent
+           version is always kept. Backends without selective_prune can only
+           remove the oldest versions, and raise VersionError otherwise.
+        """
+        versions = self.list_versions(snap_dir)
+        removed = set(str(t) for t in timestamps) & set(versions[:-1])
+        if not removed:
+            return
+        if removed != set(versions[:len(removed)]):
+            raise VersionError("Only the oldest versions can be removed.")
+        self.remove_older_than(snap_dir, int(versions[len(removed)]),
+                               tmp_dir)
+
+    def has_versions(self, snap_dir):
+        """Returns if a snapshot directory holds any version."""
+        return os.path.exists(snap_dir)
+
+    def move(self, src_dir, dst_dir):
+        """Moves the versions of a snapshot directory to another one,
+           replacing the versions that were there.
+        """
+        if os.path.exists(dst_dir):
+            shutil.rmtree(dst_dir)
+        if os.path.exists(src_dir):
+            os.rename(src_dir, dst_dir)
+
+    def remove(self, snap_dir):
+        """Deletes every version of a snapshot directory."""
+        if os.path.exists(snap_dir):
+            shutil.rmtree(snap_dir)
+
+    def catalog_index(self, snap_dir):
+        """Returns (database path, key) of the SQLite database that keeps
+           the version catalog of a snapshot directory, or None to keep it
+           in a file next to the directory.
+        """
+        return None
+
+    def list_snap_dirs(self, backup_dir):
+        """Returns the snapshot directories of a backup directory. Names
+           starting with a dot are not snapshot directories.
+        """
+        snap_dirs = []
+        for name in os.listdir(backup_dir):
+            snap_dir = os.path.join(backup_dir, name)
+            if not name.startswith('.') and os.path.isdir(snap_dir):
+                snap_dirs.append(snap_dir)
+        return snap_dirs
+
+    def list_versions(self, snap_dir):
+        """Returns the sorted version timestamps of a snapshot directory."""
+        raise NotImplementedError
+
+    def list_byte_sizes(self, snap_dir, newest=None):
+        """Returns (timestamp, bytes stored) for each version, oldest first.
+           With newest set, only for that many of the newest versions.
+        """
+        raise NotImplementedError
+
+    def list_codecs(self, snap_dir, newest=None):
+        """Returns (timestamp, codec name) for each version, oldest first.
+           With newest set, only for that many of the newest versions.
+        """
+        versions = self.list_versions(snap_dir)
+        if newest is not None:
+            versions = versions[-newest:]
+        return [(version, NO_CODEC.name) for version in versions]
+
+    def recompress(self, snap_dir, codec, tmp_dir):
+        """Stores the versions that are not stored with a codec again with
+           it. Returns the timestamps of the versions stored again. Only
+           backends that set compressible implement this, and it must not
+           run at the same time as a prune of the same snapshot directory.
+        """
+        raise NotImplementedError
+
+    def list_chain(self, snap_dir):
+        """Returns (timestamp, is full, bytes stored) for each version,
+           oldest first. Only backends that set chained implement this.
+        """
+        raise NotImplementedError
+
+    def add_checkpoints(self, snap_dir, policy, tmp_dir):
+        """Stores in full the versions a CheckpointPolicy asks for, so that
+           restoring any version applies fewer deltas. Returns the
+           timestamps of the versions stored in full. Only backends that set
+           chained implement this, and it must not run at the same time as a
+           prune of the same snapshot directory.
+        """
+        raise NotImplementedError
+
+    def list_sizes(self, snap_dir):
+        """Returns a dictionary of human readable sizes for each version,
+           the oldest version being 1.
+        """
+        return dict((number + 1, byte_summary(size)) for number, (_, size)
+                    in enumerate(self.list_byte_sizes(snap_dir)))
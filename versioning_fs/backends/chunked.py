@@ -0,0 +1,559 @@
+""" Snapshot backend that stores every version as a list of content-defined
+    chunks, shared by all the files of a backup directory.
+"""
+from collections import namedtuple
+from contextlib import closing, contextmanager
+import bisect
+import binascii
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from versioning_fs.backends.base import DATAFILE, SnapshotBackend, \
+    SnapshotResult
+from versioning_fs import chunking
+from versioning_fs.database import connect, create_database
+from versioning_fs.errors import VersionError
+from versioning_fs.staging import BUFFER_SIZE, COPY
+
+
+STORE_DIR = '.chunks'  # inside the backup directory
+INDEX_NAME = 'index.sqlite'
+LOCK_NAME = 'lock'
+PIN_DIR = 'pins'  # inside the store, the chunks of the versions being read
+TEMP_EXTENSION = '.tmp'
+TEMP_GRACE = 60 * 60  # seconds before a chunk being written is abandoned
+ID_SIZE = chunking.chunk_hasher().digest_size
+SHARED = 'shared'  # the strategy of a version copied from another one
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id TEXT PRIMARY KEY,
+    length INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    key TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    recipe BLOB NOT NULL,
+    PRIMARY KEY (key, timestamp)
+);
+"""
+
+# the chunks of a version in order: their IDs and lengths
+Recipe = namedtuple('Recipe', ['ids', 'lengths'])
+
+
+def pack_recipe(ids):
+    """Returns the binary form of a list of chunk IDs."""
+    return sqlite3.Binary(''.join(binascii.unhexlify(i) for i in ids))
+
+
+def unpack_recipe(blob):
+    """Returns the list of chunk IDs of a binary recipe."""
+    blob = str(blob)
+    return [binascii.hexlify(blob[i:i + ID_SIZE])
+            for i in range(0, len(blob), ID_SIZE)]
+
+
+class ChunkedFile(object):
+    """A read-only file object with the content of a version, read from its
+       chunk files as needed. A pin directory holding links to the chunk
+       files is removed when the file is closed.
+    """
+    def __init__(self, chunk_paths, lengths, pin_dir=None):
+        self.__paths = chunk_paths
+        self.__pin_dir = pin_dir
+        self.__starts = []  # offset in the version of each chunk
+        self.__size = 0
+        for length in lengths:
+            self.__starts.append(self.__size)
+            self.__size += length
+        self.__lengths = lengths
+        self.__position = 0
+        self.__current = None  # (index, open chunk file)
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self):
+        """Returns the size of the version."""
+        return self.__size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.__size - self.__position
+        end = min(self.__position + size, self.__size)
+        chunks = []
+        index = bisect.bisect_right(self.__starts, self.__position) - 1
+        while self.__position < end:
+            skip = self.__position - self.__starts[index]
+            count = min(self.__lengths[index] - skip, end - self.__position)
+            chunk_file = self.__open(index)
+            chunk_file.seek(skip)
+            data = chunk_file.read(count)
+            if len(data) != count:
+                raise ValueError("Unexpected end of chunk.")
+            chunks.append(data)
+            self.__position += count
+            index += 1
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.__position
+        elif whence == 2:
+            offset += self.__size
+        if offset < 0:
+            raise IOError("Invalid offset: %s" % offset)
+        self.__position = offset
+
+    def tell(self):
+        return self.__position
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.__current is not None:
+                self.__current[1].close()
+                self.__current = None
+            if self.__pin_dir is not None:
+                shutil.rmtree(self.__pin_dir, ignore_errors=True)
+
+    def __open(self, index):
+        if self.__current is None or self.__current[0] != index:
+            if self.__current is not None:
+                self.__current[1].close()
+            self.__current = (index, open(self.__paths[index], 'rb'))
+        return self.__current[1]
+
+
+class ChunkedBackend(SnapshotBackend):
+    """Stores the versions of every file of a backup directory as chunks in
+       a content-addressed store, so data shared by versions or by files is
+       stored once.
+
+    Content is cut into chunks where a rolling hash of it says so, and each
+    chunk is stored in '.chunks' inside the backup directory under the
+    SHA-256 of its content. An SQLite index keeps the list of chunks of
+    every version, and how many versions refer to each chunk; a chunk is
+    deleted when the last version that refers to it is removed. A snapshot
+    only writes the chunks the store doesn't have, so a copy of a versioned
+    file takes almost no space. Versions don't depend on each other, so any
+    of them can be removed, even while they are read: a version being read
+    pins its chunks with hard links in 'pins' inside the store.
+    """
+    name = 'chunked'
+    streaming = True
+    selective_prune = True
+    deduplicates = True
+
+    def __init__(self, min_size=chunking.MIN_SIZE, avg_size=chunking.AVG_SIZE,
+                 max_size=chunking.MAX_SIZE):
+        """
+        Parameters
+          min_size (int): The smallest chunk, in bytes, but for the last
+                chunk of a file.
+          avg_size (int): The size chunks tend to.
+          max_size (int): The largest chunk.
+        """
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.__lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_ChunkedBackend__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def snapshot(self, source_file, snap_dir, timestamp, tmp_dir,
+                 source_path=None):
+        store_dir, key = self.__store(snap_dir)
+        self.__create_store(store_dir)
+        while True:
+            # new chunks are written without holding the store lock
+            with self.metrics.timer('snapshot.chunk'):
+                ids, lengths = self.__write_chunks(store_dir, source_file)
+            self.metrics.observe('snapshot.bytes', sum(lengths))
+
+            with self.__write_lock(store_dir):
+                # a chunk removed meanwhile is written again
+                if [i for i in set(ids)
+                        if not os.path.exists(self.__chunk_path(store_dir,
+                                                                i))]:
+                    source_file.seek(0)
+                    continue
+                with closing(self.__connect(store_dir)) as db:
+                    with db:
+                        latest = db.execute(
+                            "SELECT MAX(timestamp) FROM versions WHERE "
+                            "key = ?", (key,)).fetchone()[0]
+                        if latest is not None and timestamp <= latest:
+                            # versions are named by their time, keep order
+                            timestamp = latest + 1
+                        self.__add_refs(db, ids, lengths)
+                        db.execute("INSERT INTO versions VALUES (?, ?, ?, ?)",
+                                   (key, timestamp, sum(lengths),
+                                    pack_recipe(ids)))
+            break
+        return SnapshotResult(timestamp, COPY)
+
+    def copy_version(self, src_dir, timestamp, dst_dir, new_timestamp):
+        """Gives the new version the recipe of the copied one, which only
+           updates the index: no chunk is read or written.
+        """
+        store_dir, src_key = self.__store(src_dir)
+        _, key = self.__store(dst_dir)
+        if not self.__exists(store_dir):
+            raise VersionError("Invalid version.")
+        with self.__write_lock(store_dir):
+            with closing(self.__connect(store_dir)) as db:
+                with db:
+                    row = db.execute("SELECT size, recipe FROM versions "
+                                     "WHERE key = ? AND timestamp = ?",
+                                     (src_key, int(timestamp))).fetchone()
+                    if row is None:
+                        raise VersionError("Invalid version.")
+                    size, blob = row
+                    latest = db.execute(
+                        "SELECT MAX(timestamp) FROM versions WHERE key = ?",
+                        (key,)).fetchone()[0]
+                    if latest is not None and new_timestamp <= latest:
+                        # versions are named by their time, keep order
+                        new_timestamp = latest + 1
+                    recipe = self.__load_recipe(db, blob)
+                    self.__add_refs(db, recipe.ids, recipe.lengths)
+                    db.execute("INSERT INTO versions VALUES (?, ?, ?, ?)",
+                               (key, new_timestamp, size, blob))
+        return SnapshotResult(new_timestamp, SHARED)
+
+    def restore(self, snap_dir, timestamp, dest_dir, tmp_dir):
+        version_file = self.open_version(snap_dir, timestamp)
+        os.makedirs(dest_dir)
+        with self.metrics.timer('restore.patch'):
+            with version_file, \
+                    open(os.path.join(dest_dir, DATAFILE), 'wb') as dest_file:
+                shutil.copyfileobj(version_file, dest_file, BUFFER_SIZE)
+
+    def open_version(self, snap_dir, timestamp):
+        """Returns the version as a ChunkedFile. Every chunk of the version
+           is pinned when it is opened, by a hard link in a directory of its
+           own, so removing versions while it is read can't take chunks
+           away from it.
+        """
+        store_dir, key = self.__store(snap_dir)
+        if not self.__exists(store_dir):
+            raise VersionError("Invalid version.")
+        with self.__write_lock(store_dir):
+            with closing(self.__connect(store_dir)) as db:
+                row = db.execute("SELECT recipe FROM versions WHERE key = ? "
+                                 "AND timestamp <= ? ORDER BY timestamp "
+                                 "DESC LIMIT 1",
+                                 (key, int(timestamp))).fetchone()
+                if row is None:
+                    raise VersionError("Invalid version.")
+                recipe = self.__load_recipe(db, row[0])
+            pin_dir = self.__pin_chunks(store_dir, set(recipe.ids))
+        return ChunkedFile([os.path.join(pin_dir, i) for i in recipe.ids],
+                           recipe.lengths, pin_dir)
+
+    def remove_older_than(self, snap_dir, timestamp, tmp_dir):
+        versions = self.list_versions(snap_dir)
+        self.remove_versions(snap_dir, [v for v in versions[:-1]
+                                        if int(v) < int(timestamp)], tmp_dir)
+
+    def remove_versions(self, snap_dir, timestamps, tmp_dir):
+        store_dir, key = self.__store(snap_dir)
+        if not self.__exists(store_dir):
+            return
+        timestamps = set(int(t) for t in timestamps)
+        with self.__write_lock(store_dir):
+            with closing(self.__connect(store_dir)) as db:
+                with db:
+                    rows = db.execute("SELECT timestamp, recipe FROM versions "
+                                      "WHERE key = ? ORDER BY timestamp",
+                                      (key,)).fetchall()
+                    removed = [(t, recipe) for t, recipe in rows[:-1]
+                               if t in timestamps]
+                    db.executemany("DELETE FROM versions WHERE key = ? AND "
+                                   "timestamp = ?",
+                                   [(key, t) for t, _ in removed])
+                    garbage = self.__drop_refs(
+                        db, [recipe for _, recipe in removed])
+            self.__delete_chunks(store_dir, garbage)
+
+    def list_versions(self, snap_dir):
+        store_dir, key = self.__store(snap_dir)
+        if not self.__exists(store_dir):
+            return []
+        with closing(self.__connect(store_dir)) as db:
+            return [str(t) for t, in db.execute(
+                "SELECT timestamp FROM versions WHERE key = ? ORDER BY "
+                "timestamp", (key,))]
+
+    def list_byte_sizes(self, snap_dir, newest=None):
+        """Returns (timestamp, bytes) for each version: the bytes of the
+           chunks of the newest version, and for older versions the bytes of
+           the chunks the next newer version doesn't have. Chunks shared
+           with other files are counted for each of them.
+        """
+        store_dir, key = self.__store(snap_dir)
+        if not self.__exists(store_dir):
+            return []
+        query = ("SELECT timestamp, recipe FROM versions WHERE key = ? "
+                 "ORDER BY timestamp DESC")
+        params = (key,)
+        if newest is not None:
+            query += " LIMIT ?"
+            params = (key, newest)
+        with closing(self.__connect(store_dir)) as db:
+            sizes = []
+            newer = set()
+            for timestamp, recipe in db.execute(query, params).fetchall():
+                recipe = self.__load_recipe(db, recipe)
+                chunks = dict(zip(recipe.ids, recipe.lengths))
+                sizes.append((str(timestamp),
+                              sum(length for i, length in chunks.items()
+                                  if i not in newer)))
+                newer = set(chunks)
+        sizes.reverse()
+        return sizes
+
+    def has_versions(self, snap_dir):
+        return bool(self.list_versions(snap_dir))
+
+    def move(self, src_dir, dst_dir):
+        store_dir, src_key = self.__store(src_dir)
+        dst_store_dir, dst_key = self.__store(dst_dir)
+        if store_dir != dst_store_dir:
+            raise ValueError("Can't move versions to another store: %s" %
+                             dst_dir)
+        if not self.__exists(store_dir):
+            return
+        with self.__write_lock(store_dir):
+            with closing(self.__connect(store_dir)) as db:
+                with db:
+                    garbage = self.__delete_key(db, dst_key)
+                    db.execute("UPDATE versions SET key = ? WHERE key = ?",
+                               (dst_key, src_key))
+            self.__delete_chunks(store_dir, garbage)
+
+    def remove(self, snap_dir):
+        store_dir, key = self.__store(snap_dir)
+        if not self.__exists(store_dir):
+            return
+        with self.__write_lock(store_dir):
+            with closing(self.__connect(store_dir)) as db:
+                with db:
+                    garbage = self.__delete_key(db, key)
+            self.__delete_chunks(store_dir, garbage)
+
+    def list_snap_dirs(self, backup_dir):
+        store_dir = os.path.join(backup_dir, STORE_DIR)
+        if not self.__exists(store_dir):
+            return []
+        with closing(self.__connect(store_dir)) as db:
+            keys = [key for key, in
+                    db.execute("SELECT DISTINCT key FROM versions")]
+        return [os.path.join(backup_dir, key) for key in keys
+                if not key.startswith('.')]
+
+    def collect_garbage(self, backup_dir):
+        """Deletes the chunk files no version refers to, left behind by
+           snapshots that failed, and the pins of readers that were not
+           closed for TEMP_GRACE. Returns the number of bytes reclaimed. A
+           snapshot that loses a chunk this way writes it again.
+        """
+        store_dir = os.path.join(backup_dir, STORE_DIR)
+        if not self.__exists(store_dir):
+            return 0
+        reclaimed = 0
+        with self.__write_lock(store_dir):
+            pins_dir = os.path.join(store_dir, PIN_DIR)
+            if os.path.isdir(pins_dir):
+                for name in os.listdir(pins_dir):
+                    pin_dir = os.path.join(pins_dir, name)
+                    if time.time() - os.path.getmtime(pin_dir) >= \
+                            TEMP_GRACE:
+                        shutil.rmtree(pin_dir, ignore_errors=True)
+
+            with closing(self.__connect(store_dir)) as db:
+                for prefix in os.listdir(store_dir):
+                    prefix_dir = os.path.join(store_dir, prefix)
+                    if prefix == PIN_DIR or not os.path.isdir(prefix_dir):
+                        continue
+                    for name in os.listdir(prefix_dir):
+                        path = os.path.join(prefix_dir, name)
+                        if name.endswith(TEMP_EXTENSION):
+                            if time.time() - os.path.getmtime(path) < \
+                                    TEMP_GRACE:
+                                continue
+                        elif db.execute("SELECT 1 FROM chunks WHERE id = ?",
+                                        (name,)).fetchone() is not None:
+                            continue
+                        reclaimed += os.path.getsize(path)
+                        os.remove(path)
+        return reclaimed
+
+    def __store(self, snap_dir):
+        """Returns the store directory and the index key of a snapshot
+           directory.
+        """
+        snap_dir = snap_dir.rstrip(os.sep)
+        backup_dir, key = os.path.split(snap_dir)
+        return os.path.join(backup_dir, STORE_DIR), key
+
+    def __create_store(self, store_dir):
+        if not os.path.isdir(store_dir):
+            try:
+                os.makedirs(store_dir)
+            except OSError:
+                if not os.path.isdir(store_dir):
+                    raise
+        create_database(os.path.join(store_dir, INDEX_NAME), SCHEMA)
+
+    def __connect(self, store_dir):
+        return connect(os.path.join(store_dir, INDEX_NAME))
+
+    def __exists(self, store_dir):
+        return os.path.exists(os.path.join(store_dir, INDEX_NAME))
+
+    @contextmanager
+    def __write_lock(self, store_dir):
+        """Serializes changes to the references of a store between threads
+           and processes.
+        """
+        with self.__lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(store_dir, LOCK_NAME), 'ab') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def __chunk_path(self, store_dir, chunk_id):
+        return os.path.join(store_dir, chunk_id[:2], chunk_id)
+
+    def __pin_chunks(self, store_dir, chunk_ids):
+        """Links chunk files into a new pin directory and returns it. Chunks
+           are copied where they can't be linked. Must be called with the
+           write lock held.
+        """
+        pins_dir = os.path.join(store_dir, PIN_DIR)
+        if not os.path.isdir(pins_dir):
+            os.makedirs(pins_dir)
+        pin_dir = tempfile.mkdtemp(dir=pins_dir)
+        try:
+            for chunk_id in chunk_ids:
+                path = self.__chunk_path(store_dir, chunk_id)
+                pin_path = os.path.join(pin_dir, chunk_id)
+                try:
+                    os.link(path, pin_path)
+                except (AttributeError, OSError):
+                    shutil.copyfile(path, pin_path)
+        except Exception:
+            shutil.rmtree(pin_dir, ignore_errors=True)
+            raise
+        return pin_dir
+
+    def __write_chunks(self, store_dir, source_file):
+        """Cuts the content of a file into chunks and writes the ones the
+           store doesn't have. Returns the IDs and lengths of the chunks.
+        """
+        ids = []
+        lengths = []
+        for data in chunking.iter_chunks(source_file, self.min_size,
+                                         self.avg_size, self.max_size):
+            chunk_id = chunking.chunk_id(data)
+            ids.append(chunk_id)
+            lengths.append(len(data))
+            path = self.__chunk_path(store_dir, chunk_id)
+            if os.path.exists(path):
+                self.metrics.increment('snapshot.chunks_shared')
+                continue
+            self.metrics.increment('snapshot.chunks_written')
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(path)):
+                        raise
+            temp_path = '%s.%d.%d%s' % (path, os.getpid(),
+                                        threading.current_thread().ident,
+                                        TEMP_EXTENSION)
+            with open(temp_path, 'wb') as chunk_file:
+                chunk_file.write(data)
+            os.rename(temp_path, path)
+        return ids, lengths
+
+    def __add_refs(self, db, ids, lengths):
+        """Adds a reference to each distinct chunk of a version."""
+        chunks = dict(zip(ids, lengths))
+        db.executemany("INSERT OR IGNORE INTO chunks VALUES (?, ?, 0)",
+                       chunks.items())
+        db.executemany("UPDATE chunks SET refs = refs + 1 WHERE id = ?",
+                       [(i,) for i in chunks])
+
+    def __drop_refs(self, db, recipes):
+        """Drops the references of removed versions. Returns the IDs of the
+           chunks no version refers to anymore, which are forgotten.
+        """
+        counts = {}
+        for recipe in recipes:
+            for chunk_id in set(unpack_recipe(recipe)):
+                counts[chunk_id] = counts.get(chunk_id, 0) + 1
+        db.executemany("UPDATE chunks SET refs = refs - ? WHERE id = ?",
+                       [(count, i) for i, count in counts.items()])
+        garbage = [i for i, in db.execute("SELECT id FROM chunks WHERE "
+                                          "refs <= 0")]
+        db.execute("DELETE FROM chunks WHERE refs <= 0")
+        return garbage
+
+    def __delete_key(self, db, key):
+        recipes = [recipe for recipe, in db.execute(
+            "SELECT recipe FROM versions WHERE key = ?", (key,))]
+        db.execute("DELETE FROM versions WHERE key = ?", (key,))
+        return self.__drop_refs(db, recipes)
+
+    def __delete_chunks(self, store_dir, chunk_ids):
+        """Deletes the files of forgotten chunks. Must be called with the
+           write lock held.
+        """
+        for chunk_id in chunk_ids:
+            path = self.__chunk_path(store_dir, chunk_id)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __load_recipe(self, db, blob):
+        ids = unpack_recipe(blob)
+        lengths = {}
+        distinct = list(set(ids))
+        # the number of variables of a query is limited
+        for start in range(0, len(distinct), 500):
+            batch = distinct[start:start + 500]
+            lengths.update(db.execute(
+                "SELECT id, length FROM chunks WHERE id IN (%s)" %
+                ','.join('?' * len(batch)), batch))
+        return Recipe(ids, [lengths[i] for i in ids])
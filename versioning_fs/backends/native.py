@@ -0,0 +1,479 @@
+""" Snapshot backend that stores reverse deltas without any external tool.
+"""
+import os
+import shutil
+import tempfile
+
+from versioning_fs.backends.base import DATAFILE, SnapshotBackend, \
+    SnapshotResult
+from versioning_fs import delta
+from versioning_fs.compression import encode_in_place, NO_CODEC, open_path, \
+    read_header
+from versioning_fs.errors import VersionError
+from versioning_fs.staging import copy_file_object, stage_file
+
+
+FULL_EXTENSION = '.full'
+DELTA_EXTENSION = '.delta'
+TEMP_EXTENSION = '.tmp'
+RECOMPRESS_EXTENSION = '.recompress'
+NEW_EXTENSION = '.new'  # a file rewritten by a prune, until it is committed
+
+
+class NativeBackend(SnapshotBackend):
+    """Stores versions in-process, in the same spirit as rdiff-backup.
+
+    The newest version of a file is kept in full as '<timestamp>.full' and
+    every older version is kept as a reverse delta, '<timestamp>.delta',
+    that rebuilds it from the next newer version, unless the checkpoint
+    policy keeps it in full too. Both are compressed with the backend's
+    codec.
+    """
+    name = 'native'
+    streaming = True
+    selective_prune = True
+    compressible = True
+    chained = True
+
+    def snapshot(self, source_file, snap_dir, timestamp, tmp_dir,
+                 source_path=None):
+        staged = self.__stage(source_file, snap_dir, timestamp, source_path)
+        return self.__add_version(snap_dir, *staged)
+
+    def snapshot_many(self, requests, tmp_dir):
+        """Stages every file of a batch before storing any of them, so the
+           versions capture the files as close together in time as the
+           copies allow. The deltas are written afterwards.
+        """
+        outcomes = [None] * len(requests)
+        staged = [None] * len(requests)
+        for index, request in enumerate(requests):
+            try:
+                with request.open() as source_file:
+                    staged[index] = self.__stage(
+                        source_file, request.snap_dir, request.timestamp,
+                        request.source_path)
+            except Exception as error:
+                outcomes[index] = error
+
+        for index, request in enumerate(requests):
+            if staged[index] is None:
+                continue
+            try:
+                outcomes[index] = self.__add_version(request.snap_dir,
+                                                     *staged[index])
+            except Exception as error:
+                outcomes[index] = error
+                temp_full_path = self.__path(
+                    request.snap_dir, staged[index][1],
+                    FULL_EXTENSION) + TEMP_EXTENSION
+                if os.path.exists(temp_full_path):
+                    os.remove(temp_full_path)
+        return outcomes
+
+    def __stage(self, source_file, snap_dir, timestamp, source_path):
+        """Copies a file next to the versions of its snapshot directory.
+           Returns the versions, the timestamp of the new one and the
+           strategy used to stage it.
+        """
+        if not os.path.isdir(snap_dir):
+            os.makedirs(snap_dir)
+
+        versions = self.list_versions(snap_dir)
+        if versions and timestamp <= int(versions[-1]):
+            # versions are named by their time, keep them in order
+            timestamp = int(versions[-1]) + 1
+
+        temp_full_path = self.__path(snap_dir, timestamp, FULL_EXTENSION) + \
+            TEMP_EXTENSION
+        with self.metrics.timer('snapshot.stage'):
+            if source_path is not None:
+                # a hard link would change along with the user's file
+                strategy = stage_file(source_path, temp_full_path,
+                                      allow_hardlink=False)
+            else:
+                with open(temp_full_path, 'wb') as full_file:
+                    strategy = copy_file_object(source_file, full_file)
+        self.metrics.observe('snapshot.bytes',
+                             os.path.getsize(temp_full_path))
+        return versions, timestamp, strategy
+
+    def __add_version(self, snap_dir, versions, timestamp, strategy):
+        """Turns a staged file into the newest version."""
+        full_path = self.__path(snap_dir, timestamp, FULL_EXTENSION)
+        temp_full_path = full_path + TEMP_EXTENSION
+
+        # the previous version becomes a delta against the new one, unless
+        # it is kept in full as a checkpoint
+        delta_previous = bool(versions) and \
+            not self.__needs_checkpoint(snap_dir, versions)
+        if delta_previous:
+            previous = versions[-1]
+            previous_path = self.__path(snap_dir, previous, FULL_EXTENSION)
+            delta_path = self.__path(snap_dir, previous, DELTA_EXTENSION)
+            with self.metrics.timer('snapshot.delta'):
+                write_delta(temp_full_path, previous_path, delta_path,
+                            self.codec)
+            self.metrics.observe('snapshot.delta_bytes',
+                                 os.path.getsize(delta_path))
+
+        with self.metrics.timer('snapshot.encode'):
+            encode_in_place(temp_full_path, self.codec)
+        os.rename(temp_full_path, full_path)
+
+        if delta_previous:
+            os.remove(previous_path)
+
+        return SnapshotResult(timestamp, strategy)
+
+    def restore(self, snap_dir, timestamp, dest_dir, tmp_dir):
+        versions = self.list_versions(snap_dir)
+        version = self.__find_version(versions, timestamp)
+
+        os.makedirs(dest_dir)
+        dest_path = os.path.join(dest_dir, DATAFILE)
+        with self.metrics.timer('restore.patch'):
+            self.restore_file(snap_dir, versions, version, dest_path)
+
+    def open_version(self, snap_dir, timestamp):
+        versions = self.list_versions(snap_dir)
+        version = self.__find_version(versions, timestamp)
+        full_path, chain = self.__chain(snap_dir, versions, version)
+
+        # every file is opened up front, so later snapshots and pruning
+        # can't take them away while the version is read
+        version_file = open_path(full_path)
+        try:
+            for delta_path in reversed(chain):
+                version_file = delta.PatchedFile(version_file,
+                                                 open_path(delta_path))
+        except Exception:
+            version_file.close()
+            raise
+        return version_file
+
+    def restore_file(self, snap_dir, versions, version, dest_path):
+        """Rebuilds a version by applying reverse deltas to the nearest
+           newer full copy.
+        """
+        full_path, chain = self.__chain(snap_dir, versions, version)
+        if not chain:
+            with open_path(full_path) as full_file, \
+                    open(dest_path, 'wb') as dest_file:
+                shutil.copyfileobj(full_file, dest_file, delta.READ_SIZE)
+            return
+
+        basis_path = full_path
+        temp_paths = [dest_path + '.a', dest_path + '.b']
+        for step, delta_path in enumerate(reversed(chain)):
+            out_path = temp_paths[step % 2]
+            with open_path(basis_path) as basis_file, \
+                    open_path(delta_path) as delta_file, \
+                    open(out_path, 'wb') as out_file:
+                delta.patch(basis_file, delta_file, out_file)
+            basis_path = out_path
+
+        os.rename(basis_path, dest_path)
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def remove_older_than(self, snap_dir, timestamp, tmp_dir):
+        versions = self.list_versions(snap_dir)
+        for version in versions[:-1]:
+            if int(version) < int(timestamp):
+                for extension in [FULL_EXTENSION, DELTA_EXTENSION]:
+                    path = self.__path(snap_dir, version, extension)
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def remove_versions(self, snap_dir, timestamps, tmp_dir):
+        versions = self.list_versions(snap_dir)
+        removed = set(str(t) for t in timestamps) & set(versions[:-1])
+        if not removed:
+            return
+
+        # a kept version whose delta was against a removed version gets a
+        # delta against the next kept one; every new delta is written
+        # before any file is removed
+        with self.metrics.timer('prune.rewrite'):
+            rewritten = self.__rewrite_deltas(snap_dir, versions, removed,
+                                              tmp_dir)
+        for path, replaced in rewritten:
+            os.rename(path + NEW_EXTENSION, path)
+            if replaced is not None:
+                os.remove(replaced)
+        for version in removed:
+            for extension in [FULL_EXTENSION, DELTA_EXTENSION]:
+                path = self.__path(snap_dir, version, extension)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def list_versions(self, snap_dir):
+        try:
+            names = os.listdir(snap_dir)
+        except OSError:
+            return []
+
+        versions = set()
+        for name in names:
+            version, extension = os.path.splitext(name)
+            if extension in (FULL_EXTENSION, DELTA_EXTENSION):
+                versions.add(version)
+        return sorted(versions, key=int)
+
+    def list_byte_sizes(self, snap_dir, newest=None):
+        versions = self.list_versions(snap_dir)
+        if newest is not None:
+            versions = versions[-newest:]
+        sizes = []
+        for version in versions:
+            size = 0
+            for extension in [FULL_EXTENSION, DELTA_EXTENSION]:
+                path = self.__path(snap_dir, version, extension)
+                if os.path.exists(path):
+                    size = os.path.getsize(path)
+            sizes.append((version, size))
+        return sizes
+
+    def list_codecs(self, snap_dir, newest=None):
+        versions = self.list_versions(snap_dir)
+        if newest is not None:
+            versions = versions[-newest:]
+        codecs = []
+        for version in versions:
+            path = self.__stored_path(snap_dir, version)
+            try:
+                with open(path, 'rb') as stored_file:
+                    codecs.append((version, read_header(stored_file)))
+            except IOError:
+                pass  # removed meanwhile
+        return codecs
+
+    def recompress(self, snap_dir, codec, tmp_dir):
+        recompressed = []
+        for version, name in self.list_codecs(snap_dir):
+            if name == codec.name:
+                continue
+            path = self.__stored_path(snap_dir, version)
+            temp_path = path + RECOMPRESS_EXTENSION
+            try:
+                with open_path(path) as stored_file, \
+                        open(temp_path, 'wb') as temp_file:
+                    shutil.copyfileobj(stored_file, temp_file,
+                                       delta.READ_SIZE)
+            except IOError:
+                # a snapshot or a prune replaced the file meanwhile
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                continue
+            encode_in_place(temp_path, codec)
+            os.rename(temp_path, path)
+            if path.endswith(FULL_EXTENSION) and os.path.exists(
+                    self.__path(snap_dir, version, DELTA_EXTENSION)):
+                # a snapshot made the version a delta meanwhile, the full
+                # copy put back is not needed
+                os.remove(path)
+                continue
+            recompressed.append(version)
+        return recompressed
+
+    def list_chain(self, snap_dir):
+        chain = []
+        for version in self.list_versions(snap_dir):
+            full_path = self.__path(snap_dir, version, FULL_EXTENSION)
+            full = os.path.exists(full_path)
+            path = full_path if full else \
+                self.__path(snap_dir, version, DELTA_EXTENSION)
+            try:
+                chain.append((version, full, os.path.getsize(path)))
+            except OSError:
+                pass  # removed meanwhile
+        return chain
+
+    def add_checkpoints(self, snap_dir, policy, tmp_dir):
+        chain = self.list_chain(snap_dir)
+        checkpoints = set(policy.plan(chain))
+        if not checkpoints:
+            return []
+
+        # versions are rebuilt from the newest down, one patch each, as far
+        # as the oldest version to store in full; a full copy is written
+        # before the delta it replaces is removed
+        versions = [version for version, _, _ in chain]
+        work_dir = tempfile.mkdtemp(dir=tmp_dir)
+        added = []
+        try:
+            current = None  # the content of the version rebuilt last
+            for version in reversed(versions):
+                content = self.__path(snap_dir, version, FULL_EXTENSION)
+                if not os.path.exists(content):
+                    delta_path = self.__path(snap_dir, version,
+                                             DELTA_EXTENSION)
+                    out_path = os.path.join(work_dir, version)
+                    with open_path(current) as basis_file, \
+                            open_path(delta_path) as delta_file, \
+                            open(out_path, 'wb') as out_file:
+                        delta.patch(basis_file, delta_file, out_file)
+                    if current is not None and current.startswith(work_dir):
+                        os.remove(current)
+                    content = out_path
+
+                    if version in checkpoints:
+                        temp_full_path = content + FULL_EXTENSION
+                        shutil.copyfile(content, temp_full_path)
+                        encode_in_place(temp_full_path, self.codec)
+                        os.rename(temp_full_path, self.__path(
+                            snap_dir, version, FULL_EXTENSION))
+                        os.remove(delta_path)
+                        added.append(version)
+                        if len(added) == len(checkpoints):
+                            break
+                current = content
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        added.reverse()
+        return added
+
+    def __needs_checkpoint(self, snap_dir, versions):
+        """Returns if the newest version must stay in full when a newer one
+           is stored, given the deltas chained through it.
+        """
+        if self.checkpoints is None:
+            return False
+        deltas = delta_bytes = 0
+        for version in reversed(versions[:-1]):
+            delta_path = self.__path(snap_dir, version, DELTA_EXTENSION)
+            if os.path.exists(self.__path(snap_dir, version,
+                                          FULL_EXTENSION)) or \
+                    not os.path.exists(delta_path):
+                break
+            deltas += 1
+            delta_bytes += os.path.getsize(delta_path)
+            if self.checkpoints.needs_checkpoint(deltas, delta_bytes):
+                return True
+        return self.checkpoints.needs_checkpoint(deltas, delta_bytes)
+
+    def __stored_path(self, snap_dir, version):
+        """Returns the file a version is stored in."""
+        full_path = self.__path(snap_dir, version, FULL_EXTENSION)
+        if os.path.exists(full_path):
+            return full_path
+        return self.__path(snap_dir, version, DELTA_EXTENSION)
+
+    def __find_version(self, versions, timestamp):
+        """Returns the newest version not newer than a timestamp."""
+        older = [v for v in versions if int(v) <= int(timestamp)]
+        if not older:
+            raise VersionError("Invalid version.")
+        return older[-1]
+
+    def __chain(self, snap_dir, versions, version):
+        """Returns the nearest full copy newer than a version, and the
+           deltas to apply to it from the newest to the oldest.
+        """
+        index = versions.index(version)
+        chain = []
+        for newer in versions[index:]:
+            full_path = self.__path(snap_dir, newer, FULL_EXTENSION)
+            if os.path.exists(full_path):
+                break
+            chain.append(self.__path(snap_dir, newer, DELTA_EXTENSION))
+        return full_path, chain
+
+    def __rewrite_deltas(self, snap_dir, versions, removed, tmp_dir):
+        """Writes the new files of a prune next to the old ones and returns
+           (path, replaced path) pairs: where each goes and the file it
+           replaces, if any. The new files are the deltas of kept versions
+           whose delta was against a removed version, and the full copies of
+           kept versions the checkpoint policy now keeps in full.
+
+        Versions are rebuilt from the newest down, one patch each, as far as
+        the oldest version that needs a new delta. With a checkpoint policy,
+        the deltas chained through each kept version are counted as they
+        will be once the prune is done, and the rebuild goes on until the
+        chain reaches a full copy.
+        """
+        first_removed = min(versions.index(v) for v in removed)
+        work_dir = tempfile.mkdtemp(dir=tmp_dir)
+        rewritten = []
+        deltas = delta_bytes = 0  # chained since the newer full copy
+        try:
+            current = None  # the content of the version rebuilt last
+            newer_kept = None  # the index and content of a kept version
+            for index in reversed(range(len(versions))):
+                version = versions[index]
+                content = self.__path(snap_dir, version, FULL_EXTENSION)
+                full = os.path.exists(content)
+                if not full:
+                    delta_path = self.__path(snap_dir, version,
+                                             DELTA_EXTENSION)
+                    out_path = os.path.join(work_dir, version)
+                    with open_path(current) as basis_file, \
+                            open_path(delta_path) as delta_file, \
+                            open(out_path, 'wb') as out_file:
+                        delta.patch(basis_file, delta_file, out_file)
+                    content = out_path
+
+                if version not in removed:
+                    if not full and self.checkpoints is not None and \
+                            self.checkpoints.needs_checkpoint(deltas,
+                                                              delta_bytes):
+                        full_path = self.__path(snap_dir, version,
+                                                FULL_EXTENSION)
+                        rewritten.append((full_path, delta_path))
+                        shutil.copyfile(content, full_path + NEW_EXTENSION)
+                        encode_in_place(full_path + NEW_EXTENSION,
+                                        self.codec)
+                        full = True
+                    elif not full and newer_kept is not None and \
+                            newer_kept[0] != index + 1:
+                        rewritten.append((delta_path, None))
+                        write_delta(newer_kept[1], content,
+                                    delta_path + NEW_EXTENSION, self.codec)
+                        deltas += 1
+                        delta_bytes += os.path.getsize(delta_path +
+                                                       NEW_EXTENSION)
+                    elif not full:
+                        deltas += 1
+                        delta_bytes += os.path.getsize(delta_path)
+                    if full:
+                        deltas = delta_bytes = 0
+
+                    newer_kept = (index, content)
+                    if index < first_removed and \
+                            (self.checkpoints is None or full):
+                        break
+                for name in os.listdir(work_dir):
+                    path = os.path.join(work_dir, name)
+                    if path not in (content, newer_kept and newer_kept[1]):
+                        os.remove(path)
+                current = content
+        except Exception:
+            for path, _ in rewritten:
+                if os.path.exists(path + NEW_EXTENSION):
+                    os.remove(path + NEW_EXTENSION)
+            raise
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return rewritten
+
+    def __path(self, snap_dir, version, extension):
+        return os.path.join(snap_dir, '%s%s' % (version, extension))
+
+
+def write_delta(basis_path, target_path, delta_path, codec=NO_CODEC):
+    """Writes the delta that rebuilds a target file from a basis file, both
+       stored files, compressed with a codec.
+    """
+    temp_delta_path = delta_path + TEMP_EXTENSION
+    with open_path(basis_path) as basis_file:
+        basis_file.seek(0, os.SEEK_END)
+        size = basis_file.tell()
+        basis_file.seek(0)
+        sig = delta.signature(basis_file, size=size)
+    with open_path(target_path) as target_file, \
+            open(temp_delta_path, 'wb') as delta_file:
+        delta.delta(sig, target_file, delta_file)
+    encode_in_place(temp_delta_path, codec)
+    os.rename(temp_delta_path, delta_path)
@@ -0,0 +1,817 @@
+""" Snapshot backend that packs the versions of every file into a few large
+    pack files, found through an index.
+"""
+from collections import namedtuple
+from contextlib import closing, contextmanager
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from versioning_fs.backends.base import DATAFILE, SnapshotBackend, \
+    SnapshotResult
+from versioning_fs import delta
+from versioning_fs.compression import encode_file, encode_in_place, \
+    open_stored, read_header
+from versioning_fs.database import connect, create_database
+from versioning_fs.errors import VersionError
+from versioning_fs.staging import BUFFER_SIZE, copy_file_object, stage_file
+
+
+STORE_DIR = '.packs'  # inside the backup directory
+INDEX_NAME = 'index.sqlite'
+LOCK_NAME = 'lock'
+PACK_EXTENSION = '.pack'
+PACK_SIZE = 256 * 1024 * 1024  # bytes written to a pack before a new one
+
+FULL = 'full'
+DELTA = 'delta'
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalog (
+    key TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    info TEXT NOT NULL,
+    PRIMARY KEY (key, timestamp)
+);
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    key TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (key, timestamp)
+);
+CREATE INDEX IF NOT EXISTS versions_pack ON versions (pack);
+""" + CATALOG_SCHEMA
+
+Location = namedtuple('Location', ['pack', 'offset', 'length'])
+
+Row = namedtuple('Row', ['timestamp', 'kind', 'pack', 'offset', 'length'])
+
+
+class PackSlice(object):
+    """A read-only file object over a byte range of a pack file."""
+    def __init__(self, pack_path, offset, length):
+        self.__file = open(pack_path, 'rb')
+        self.__offset = offset
+        self.__length = length
+        self.__position = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        remaining = self.__length - self.__position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+        self.__file.seek(self.__offset + self.__position)
+        data = self.__file.read(size)
+        self.__position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.__position
+        elif whence == 2:
+            offset += self.__length
+        if offset < 0:
+            raise IOError("Invalid offset: %s" % offset)
+        self.__position = offset
+
+    def tell(self):
+        return self.__position
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.__file.close()
+
+
+class _Staged(object):
+    """A version being stored: the file staged for it and its temporary
+       files.
+    """
+    def __init__(self, key, timestamp, staged_path, delta_path):
+        self.key = key
+        self.timestamp = timestamp
+        self.staged_path = staged_path
+        self.stored_path = staged_path  # until encoded
+        self.delta_path = delta_path
+
+    def remove(self):
+        for path in set([self.staged_path, self.stored_path,
+                         self.delta_path]):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class PackedBackend(SnapshotBackend):
+    """Stores the versions of every file of a backup directory in shared
+       pack files instead of a directory per file.
+
+    Like the native backend, the newest version of a file is stored in full
+    and older versions as reverse deltas, or in full where the checkpoint
+    policy asks for it, all compressed with the backend's codec. Each is
+    appended to the current pack file in '.packs' inside the backup
+    directory, and an SQLite index maps the snapshot directory name of a
+    file to the pack, offset and length of each of its versions. The index
+    also keeps the version catalogs, see catalog_index(). Snapshot
+    directories are never created on disk. Space taken by removed
+    versions is reclaimed by compact().
+    """
+    name = 'packed'
+    streaming = True
+    selective_prune = True
+    compressible = True
+    chained = True
+
+    def __init__(self, pack_size=PACK_SIZE):
+        """
+        Parameters
+          pack_size (int): Bytes written to a pack file before starting a
+                new one.
+        """
+        self.pack_size = pack_size
+        self.__lock = threading.Lock()
+        self.__upgraded = set()  # stores known to have the catalog table
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_PackedBackend__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def snapshot(self, source_file, snap_dir, timestamp, tmp_dir,
+                 source_path=None):
+        store_dir, key = self.__store(snap_dir)
+        self.__create_store(store_dir)
+        staged = _Staged(key, timestamp, self.__temp_path(tmp_dir),
+                         self.__temp_path(tmp_dir))
+        try:
+            strategy = self.__stage(source_file, source_path, staged)
+            timestamp, = self.__add_versions(store_dir, [staged])
+        finally:
+            staged.remove()
+        return SnapshotResult(timestamp, strategy)
+
+    def snapshot_many(self, requests, tmp_dir):
+        """Stages and encodes every file of a batch, then adds the versions
+           of the files of each store under one hold of its lock and in one
+           transaction.
+        """
+        outcomes = [None] * len(requests)
+        stores = {}  # store directory -> [(request index, strategy, staged)]
+        try:
+            for index, request in enumerate(requests):
+                try:
+                    store_dir, key = self.__store(request.snap_dir)
+                    self.__create_store(store_dir)
+                    staged = _Staged(key, request.timestamp,
+                                     self.__temp_path(tmp_dir),
+                                     self.__temp_path(tmp_dir))
+                    stores.setdefault(store_dir, []).append(
+                        (index, None, staged))
+                    with request.open() as source_file:
+                        strategy = self.__stage(source_file,
+                                                request.source_path, staged)
+                    stores[store_dir][-1] = (index, strategy, staged)
+                except Exception as error:
+                    outcomes[index] = error
+
+            for store_dir, entries in stores.items():
+                entries = [entry for entry in entries
+                           if outcomes[entry[0]] is None]
+                try:
+                    timestamps = self.__add_versions(
+                        store_dir, [item for _, _, item in entries])
+                except Exception as error:
+                    for index, _, _ in entries:
+                        outcomes[index] = error
+                    continue
+                for (index, strategy, _), timestamp in zip(entries,
+                                                           timestamps):
+                    outcomes[index] = SnapshotResult(timestamp, strategy)
+        finally:
+            for entries in stores.values():
+                for _, _, staged in entries:
+                    staged.remove()
+        return outcomes
+
+    def restore(self, snap_dir, timestamp, dest_dir, tmp_dir):
+        version_file = self.open_version(snap_dir, timestamp)
+        os.makedirs(dest_dir)
+        with self.metrics.timer('restore.patch'):
+            with version_file, \
+                    open(os.path.join(dest_dir, DATAFILE), 'wb') as dest_file:
+                shutil.copyfileobj(version_file, dest_file, BUFFER_SIZE)
+
+    def open_version(self, snap_dir, timestamp):
+        store_dir, key = self.__store(snap_dir)
+        rows = self.__load_rows(store_dir, key)
+        older = [i for i, row in enumerate(rows)
+                 if row.timestamp <= int(timestamp)]
+        if not older:
+            raise VersionError("Invalid version.")
+
+        # the version and the newer deltas up to the nearest full version
+        chain = []
+        for row in rows[older[-1]:]:
+            chain.append(row)
+            if row.kind == FULL:
+                break
+
+        version_file = open_stored(self.__open_slice(store_dir, chain.pop()))
+        try:
+            for row in reversed(chain):
+                version_file = delta.PatchedFile(
+                    version_file,
+                    open_stored(self.__open_slice(store_dir, row)))
+        except Exception:
+            version_file.close()
+            raise
+        return version_file
+
+    def remove_older_than(self, snap_dir, timestamp, tmp_dir):
+        store_dir, key = self.__store(snap_dir)
+        if not self.__exists(store_dir):
+            return
+        with self.__write_lock(store_dir):
+            with closing(self.__connect(store_dir)) as db:
+                rows = self.__rows(db, key)
+                if not rows:
+                    return
+                with db:
+                    db.execute("DELETE FROM versions WHERE key = ? AND "
+                               "timestamp < ? AND timestamp < ?",
+                               (key, int(timestamp), rows[-1].timestamp))
+
+    def remove_versions(self, snap_dir, timestamps, tmp_dir):
+        store_dir, key = self.__store(snap_dir)
+        while True:
+            rows = self.__load_rows(store_dir, key)
+            removed = set(int(t) for t in timestamps) & \
+                set(row.timestamp for row in rows[:-1])
+            if not removed:
+                return
+
+            # like snapshot(), the new deltas are written without the lock,
+            # and written again if the versions changed meanwhile
+            with self.metrics.timer('prune.rewrite'):
+                rewrites = self.__rewrite_deltas(store_dir, rows, removed,
+                                                 tmp_dir)
+            try:
+                with self.__write_lock(store_dir):
+                    with closing(self.__connect(store_dir)) as db:
+                        if self.__rows(db, key) != rows:
+                            continue
+                        with db:
+                            for row, kind, path in rewrites:
+                                location = self.__append(store_dir, path)
+                                db.execute(
+                                    "UPDATE versions SET kind = ?, pack = ?, "
+                                    "offset = ?, length = ? WHERE key = ? "
+                                    "AND timestamp = ?",
+                                    (kind,) + location +
+                                    (key, row.timestamp))
+                            db.executemany(
+                                "DELETE FROM versions WHERE key = ? AND "
+                                "timestamp = ?",
+                                [(key, timestamp) for timestamp in removed])
+                return
+            finally:
+                for _, _, path in rewrites:
+                    os.remove(path)
+
+    def list_versions(self, snap_dir):
+        store_dir, key = self.__store(snap_dir)
+        return [str(row.timestamp)
+                for row in self.__load_rows(store_dir, key)]
+
+    def list_byte_sizes(self, snap_dir, newest=None):
+        store_dir, key = self.__store(snap_dir)
+        rows = self.__load_rows(store_dir, key)
+        if newest is not None:
+            rows = rows[-newest:]
+        return [(str(row.timestamp), row.length) for row in rows]
+
+    def list_codecs(self, snap_dir, newest=None):
+        store_dir, key = self.__store(snap_dir)
+        rows = self.__load_rows(store_dir, key)
+        if newest is not None:
+            rows = rows[-newest:]
+        codecs = []
+        for row in rows:
+            with self.__open_slice(store_dir, row) as stored_file:
+                codecs.append((str(row.timestamp), read_header(stored_file)))
+        return codecs
+
+    def recompress(self, snap_dir, codec, tmp_dir):
+        store_dir, key = self.__store(snap_dir)
+        while True:
+            rows = self.__load_rows(store_dir, key)
+            rewrites = []
+            try:
+                for row in rows:
+                    with self.__open_slice(store_dir, row) as stored_file:
+                        if read_header(stored_file) == codec.name:
+                            continue
+                    path = self.__temp_path(tmp_dir)
+                    rewrites.append((row, path))
+                    with open_stored(self.__open_slice(store_dir, row)) as \
+                            stored_file, open(path, 'wb') as temp_file:
+                        shutil.copyfileobj(stored_file, temp_file,
+                                           BUFFER_SIZE)
+                    encode_in_place(path, codec)
+                if not rewrites:
+                    return []
+
+                with self.__write_lock(store_dir):
+                    with closing(self.__connect(store_dir)) as db:
+                        if self.__rows(db, key) != rows:
+                            continue
+                        with db:
+                            for row, path in rewrites:
+                                location = self.__append(store_dir, path)
+                                db.execute(
+                                    "UPDATE versions SET pack = ?, "
+                                    "offset = ?, length = ? WHERE key = ? "
+                                    "AND timestamp = ?",
+                                    location + (key, row.timestamp))
+                return [str(row.timestamp) for row, _ in rewrites]
+            finally:
+                for _, path in rewrites:
+                    os.remove(path)
+
+    def list_chain(self, snap_dir):
+        store_dir, key = self.__store(snap_dir)
+        return [(str(row.timestamp), row.kind == FULL, row.length)
+                for row in self.__load_rows(store_dir, key)]
+
+    def add_checkpoints(self, snap_dir, policy, tmp_dir):
+        store_dir, key = self.__store(snap_dir)
+        while True:
+            rows = self.__load_rows(store_dir, key)
+            checkpoints = set(int(timestamp) for timestamp in policy.plan(
+                [(row.timestamp, row.kind == FULL, row.length)
+                 for row in rows]))
+            if not checkpoints:
+                return []
+
+            # like snapshot(), the full copies are written without the lock,
+            # and written again if the versions changed meanwhile
+            rewrites = self.__rebuild_versions(store_dir, rows, checkpoints,
+                                               tmp_dir)
+            try:
+                with self.__write_lock(store_dir):
+                    with closing(self.__connect(store_dir)) as db:
+                        if self.__rows(db, key) != rows:
+                            continue
+                        with db:
+                            for row, path in rewrites:
+                                location = self.__append(store_dir, path)
+                                db.execute(
+                                    "UPDATE versions SET kind = ?, pack = ?, "
+                                    "offset = ?, length = ? WHERE key = ? "
+                                    "AND timestamp = ?",
+                                    (FULL,) + location +
+                                    (key, row.timestamp))
+                return sorted(str(row.timestamp) for row, _ in rewrites)
+            finally:
+                for _, path in rewrites:
+                    os.remove(path)
+
+    def has_versions(self, snap_dir):
+        store_dir, key = self.__store(snap_dir)
+        return bool(self.__load_rows(store_dir, key))
+
+    def move(self, src_dir, dst_dir):
+        store_dir, src_key = self.__store(src_dir)
+        dst_store_dir, dst_key = self.__store(dst_dir)
+        if store_dir != dst_store_dir:
+            raise ValueError("Can't move versions to another store: %s" %
+                             dst_dir)
+        if not self.__exists(store_dir):
+            return
+        with self.__write_lock(store_dir):
+            with closing(self.__connect(store_dir)) as db:
+                with db:
+                    db.execute("DELETE FROM versions WHERE key = ?",
+                               (dst_key,))
+                    db.execute("UPDATE versions SET key = ? WHERE key = ?",
+                               (dst_key, src_key))
+
+    def remove(self, snap_dir):
+        store_dir, key = self.__store(snap_dir)
+        if not self.__exists(store_dir):
+            return
+        with self.__write_lock(store_dir):
+            with closing(self.__connect(store_dir)) as db:
+                with db:
+                    db.execute("DELETE FROM versions WHERE key = ?", (key,))
+
+    def catalog_index(self, snap_dir):
+        """Keeps the catalog in the index, so the backup directory holds no
+           file per versioned file.
+        """
+        store_dir, key = self.__store(snap_dir)
+        self.__upgrade_store(store_dir)
+        return os.path.join(store_dir, INDEX_NAME), key
+
+    def list_snap_dirs(self, backup_dir):
+        store_dir = os.path.join(backup_dir, STORE_DIR)
+        if not self.__exists(store_dir):
+            return []
+        with closing(self.__connect(store_dir)) as db:
+            keys = [key for key, in
+                    db.execute("SELECT DISTINCT key FROM versions")]
+        return [os.path.join(backup_dir, key) for key in keys
+                if not key.startswith('.')]
+
+    def compact(self, backup_dir, min_garbage=0.5):
+        """Rewrites the pack files in which at least a min_garbage fraction
+           of the bytes belong to removed versions. Returns the number of
+           bytes reclaimed.
+        """
+        store_dir = os.path.join(backup_dir, STORE_DIR)
+        if not self.__exists(store_dir):
+            return 0
+
+        with self.__write_lock(store_dir):
+            with closing(self.__connect(store_dir)) as db:
+                live = dict(db.execute("SELECT pack, SUM(length) FROM "
+                                       "versions GROUP BY pack"))
+                packs = self.__pack_ids(store_dir)
+                candidates = []
+                for pack in packs:
+                    size = os.path.getsize(self.__pack_path(store_dir, pack))
+                    garbage = size - live.get(pack, 0)
+                    if size and float(garbage) / size >= min_garbage:
+                        candidates.append((pack, garbage))
+                if not candidates:
+                    return 0
+
+                # live versions are copied into a new pack
+                open(self.__pack_path(store_dir, packs[-1] + 1), 'ab').close()
+                with db:
+                    for pack, _ in candidates:
+                        rows = db.execute("SELECT rowid, offset, length FROM "
+                                          "versions WHERE pack = ?",
+                                          (pack,)).fetchall()
+                        for rowid, offset, length in rows:
+                            row = Row(None, None, pack, offset, length)
+                            with self.__open_slice(store_dir, row) as src:
+                                location = self.__append(store_dir, src)
+                            db.execute("UPDATE versions SET pack = ?, "
+                                       "offset = ?, length = ? WHERE "
+                                       "rowid = ?", location + (rowid,))
+
+            # open readers keep the removed packs until they are done
+            for pack, _ in candidates:
+                os.remove(self.__pack_path(store_dir, pack))
+        return sum(garbage for _, garbage in candidates)
+
+    def __store(self, snap_dir):
+        """Returns the store directory and the index key of a snapshot
+           directory.
+        """
+        snap_dir = snap_dir.rstrip(os.sep)
+        backup_dir, key = os.path.split(snap_dir)
+        return os.path.join(backup_dir, STORE_DIR), key
+
+    def __create_store(self, store_dir):
+        if not os.path.isdir(store_dir):
+            try:
+                os.makedirs(store_dir)
+            except OSError:
+                if not os.path.isdir(store_dir):
+                    raise
+        create_database(os.path.join(store_dir, INDEX_NAME), SCHEMA)
+        self.__upgrade_store(store_dir)
+
+    def __upgrade_store(self, store_dir):
+        """Adds the catalog table to an index created before the index kept
+           the catalogs, once per store.
+        """
+        if store_dir in self.__upgraded or not self.__exists(store_dir):
+            return
+        with closing(self.__connect(store_dir)) as db:
+            found = db.execute("SELECT 1 FROM sqlite_master WHERE type = "
+                               "'table' AND name = 'catalog'").fetchone()
+            if found is None:
+                db.executescript(CATALOG_SCHEMA)
+        self.__upgraded.add(store_dir)
+
+    def __connect(self, store_dir):
+        return connect(os.path.join(store_dir, INDEX_NAME))
+
+    def __exists(self, store_dir):
+        return os.path.exists(os.path.join(store_dir, INDEX_NAME))
+
+    def __rows(self, db, key):
+        rows = db.execute("SELECT timestamp, kind, pack, offset, length FROM "
+                          "versions WHERE key = ? ORDER BY timestamp", (key,))
+        return [Row(*row) for row in rows]
+
+    def __load_rows(self, store_dir, key):
+        """Returns the index rows of a key, without creating the store."""
+        if not self.__exists(store_dir):
+            return []
+        with closing(self.__connect(store_dir)) as db:
+            return self.__rows(db, key)
+
+    def __needs_checkpoint(self, rows):
+        """Returns if the newest version must stay in full when a newer one
+           is stored, given the deltas chained through it.
+        """
+        if self.checkpoints is None:
+            return False
+        deltas = delta_bytes = 0
+        for row in reversed(rows[:-1]):
+            if row.kind == FULL:
+                break
+            deltas += 1
+            delta_bytes += row.length
+        return self.checkpoints.needs_checkpoint(deltas, delta_bytes)
+
+    @contextmanager
+    def __write_lock(self, store_dir):
+        """Serializes writes to a store between threads and processes."""
+        with self.__lock:
+            if fcntl is None:
+                yield
+                return
+            if not os.path.isdir(store_dir):
+                os.makedirs(store_dir)
+            with open(os.path.join(store_dir, LOCK_NAME), 'ab') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def __pack_ids(self, store_dir):
+        pack_ids = []
+        for name in os.listdir(store_dir):
+            pack_id, extension = os.path.splitext(name)
+            if extension == PACK_EXTENSION:
+                pack_ids.append(int(pack_id))
+        return sorted(pack_ids)
+
+    def __pack_path(self, store_dir, pack):
+        return os.path.join(store_dir, '%08d%s' % (pack, PACK_EXTENSION))
+
+    def __append(self, store_dir, src):
+        """Appends a file, given as a path or a file object, to the current
+           pack. Must be called with the write lock held.
+        """
+        pack_ids = self.__pack_ids(store_dir) or [1]
+        pack = pack_ids[-1]
+        pack_path = self.__pack_path(store_dir, pack)
+        if os.path.exists(pack_path) and \
+                os.path.getsize(pack_path) >= self.pack_size:
+            pack += 1
+            pack_path = self.__pack_path(store_dir, pack)
+
+        with open(pack_path, 'ab') as pack_file:
+            pack_file.seek(0, os.SEEK_END)
+            offset = pack_file.tell()
+            if isinstance(src, basestring):
+                with open(src, 'rb') as src_file:
+                    shutil.copyfileobj(src_file, pack_file, BUFFER_SIZE)
+            else:
+                shutil.copyfileobj(src, pack_file, BUFFER_SIZE)
+            length = pack_file.tell() - offset
+        return Location(pack, offset, length)
+
+    def __open_slice(self, store_dir, row):
+        return PackSlice(self.__pack_path(store_dir, row.pack), row.offset,
+                         row.length)
+
+    def __stage(self, source_file, source_path, staged):
+        """Copies a file to the staged path and encodes it with the codec.
+           Returns the strategy used to stage it.
+        """
+        with self.metrics.timer('snapshot.stage'):
+            if source_path is not None:
+                strategy = stage_file(source_path, staged.staged_path,
+                                      allow_hardlink=False)
+            else:
+                with open(staged.staged_path, 'wb') as staged_file:
+                    strategy = copy_file_object(source_file, staged_file)
+        self.metrics.observe('snapshot.bytes',
+                             os.path.getsize(staged.staged_path))
+        with self.metrics.timer('snapshot.encode'):
+            staged.stored_path = encode_file(staged.staged_path, self.codec)
+        return strategy
+
+    def __add_versions(self, store_dir, staged):
+        """Adds the staged versions of files of a store under one hold of
+           its lock and in one transaction. Returns the timestamps they were
+           stored under.
+        """
+        timestamps = [None] * len(staged)
+        pending = range(len(staged))
+        while pending:
+            # the deltas are written without holding the store lock, and
+            # written again for files another snapshot got to first
+            with closing(self.__connect(store_dir)) as db:
+                loaded = [(i, self.__rows(db, staged[i].key))
+                          for i in pending]
+            prepared = []
+            for i, rows in loaded:
+                previous = rows[-1] if rows else None
+                checkpoint = self.__needs_checkpoint(rows)
+                if previous is not None and not checkpoint:
+                    with self.metrics.timer('snapshot.delta'):
+                        self.__write_delta(store_dir, previous,
+                                           staged[i].staged_path,
+                                           staged[i].delta_path)
+                    self.metrics.observe(
+                        'snapshot.delta_bytes',
+                        os.path.getsize(staged[i].delta_path))
+                prepared.append((i, rows, checkpoint))
+
+            pending = []
+            with self.__write_lock(store_dir):
+                with closing(self.__connect(store_dir)) as db:
+                    with db:
+                        for i, rows, checkpoint in prepared:
+                            key = staged[i].key
+                            if self.__rows(db, key) != rows:
+                                pending.append(i)
+                                continue
+                            previous = rows[-1] if rows else None
+                            timestamp = staged[i].timestamp
+                            if previous and timestamp <= previous.timestamp:
+                                # versions are named by their time, keep order
+                                timestamp = previous.timestamp + 1
+
+                            if previous is not None and not checkpoint:
+                                location = self.__append(
+                                    store_dir, staged[i].delta_path)
+                                db.execute(
+                                    "UPDATE versions SET kind = ?, pack = ?, "
+                                    "offset = ?, length = ? WHERE key = ? "
+                                    "AND timestamp = ?",
+                                    (DELTA,) + location +
+                                    (key, previous.timestamp))
+                            location = self.__append(store_dir,
+                                                     staged[i].stored_path)
+                            db.execute(
+                                "INSERT INTO versions VALUES (?, ?, ?, ?, ?, "
+                                "?)", (key, timestamp, FULL) + location)
+                            timestamps[i] = timestamp
+        return timestamps
+
+    def __write_delta(self, store_dir, previous, staged_path, delta_path):
+        """Writes the delta that rebuilds the previous version from the new
+           one.
+        """
+        size = os.path.getsize(staged_path)
+        with open(staged_path, 'rb') as staged_file:
+            sig = delta.signature(staged_file, size=size)
+        with open_stored(self.__open_slice(store_dir, previous)) as \
+                previous_file, open(delta_path, 'wb') as delta_file:
+            delta.delta(sig, previous_file, delta_file)
+        encode_in_place(delta_path, self.codec)
+
+    def __rewrite_deltas(self, store_dir, rows, removed, tmp_dir):
+        """Returns (row, kind, path) for every kept version whose delta was
+           against a removed version, with a new delta against the next kept
+           version, and for every kept version the checkpoint policy now
+           keeps in full, with its full copy.
+
+        Versions are rebuilt from the newest down, one patch each, as far as
+        the oldest version that needs a new delta. With a checkpoint policy,
+        the deltas chained through each kept version are counted as they
+        will be once the prune is done, and the rebuild goes on until the
+        chain reaches a full copy.
+        """
+        first_removed = min(i for i, row in enumerate(rows)
+                            if row.timestamp in removed)
+        work_dir = tempfile.mkdtemp(dir=tmp_dir)
+        rewrites = []
+        deltas = delta_bytes = 0  # chained since the newer full copy
+        try:
+            current = None  # the content of the version rebuilt last
+            newer_kept = None  # the index and content of a kept version
+            for index in reversed(range(len(rows))):
+                row = rows[index]
+                content = os.path.join(work_dir, str(row.timestamp))
+                with open_stored(self.__open_slice(store_dir, row)) as \
+                        data_file, open(content, 'wb') as out_file:
+                    if row.kind == FULL:
+                        shutil.copyfileobj(data_file, out_file, BUFFER_SIZE)
+                    else:
+                        with open(current, 'rb') as basis_file:
+                            delta.patch(basis_file, data_file, out_file)
+
+                if row.timestamp not in removed:
+                    kind = row.kind
+                    if kind == DELTA and self.checkpoints is not None and \
+                            self.checkpoints.needs_checkpoint(deltas,
+                                                              delta_bytes):
+                        full_path = self.__temp_path(tmp_dir)
+                        rewrites.append((row, FULL, full_path))
+                        shutil.copyfile(content, full_path)
+                        encode_in_place(full_path, self.codec)
+                        kind = FULL
+                    elif kind == DELTA and newer_kept is not None and \
+                            newer_kept[0] != index + 1:
+                        delta_path = self.__temp_path(tmp_dir)
+                        rewrites.append((row, DELTA, delta_path))
+                        size = os.path.getsize(newer_kept[1])
+                        with open(newer_kept[1], 'rb') as basis_file:
+                            sig = delta.signature(basis_file, size=size)
+                        with open(content, 'rb') as target_file, \
+                                open(delta_path, 'wb') as delta_file:
+                            delta.delta(sig, target_file, delta_file)
+                        encode_in_place(delta_path, self.codec)
+                        deltas += 1
+                        delta_bytes += os.path.getsize(delta_path)
+                    elif kind == DELTA:
+                        deltas += 1
+                        delta_bytes += row.length
+                    if kind == FULL:
+                        deltas = delta_bytes = 0
+
+                    newer_kept = (index, content)
+                    if index < first_removed and \
+                            (self.checkpoints is None or kind == FULL):
+                        break
+                for name in os.listdir(work_dir):
+                    path = os.path.join(work_dir, name)
+                    if path not in (content, newer_kept and newer_kept[1]):
+                        os.remove(path)
+                current = content
+        except Exception:
+            for _, _, path in rewrites:
+                os.remove(path)
+            raise
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return rewrites
+
+    def __rebuild_versions(self, store_dir, rows, timestamps, tmp_dir):
+        """Returns (row, path) for every version with one of the given
+           timestamps, with its content stored in full with the backend's
+           codec.
+
+        Versions are rebuilt from the newest down, one patch each, as far as
+        the oldest of them.
+        """
+        work_dir = tempfile.mkdtemp(dir=tmp_dir)
+        rebuilt = []
+        try:
+            current = None  # the content of the version rebuilt last
+            for row in reversed(rows):
+                content = os.path.join(work_dir, str(row.timestamp))
+                with open_stored(self.__open_slice(store_dir, row)) as \
+                        data_file, open(content, 'wb') as out_file:
+                    if row.kind == FULL:
+                        shutil.copyfileobj(data_file, out_file, BUFFER_SIZE)
+                    else:
+                        with open(current, 'rb') as basis_file:
+                            delta.patch(basis_file, data_file, out_file)
+                if current is not None:
+                    os.remove(current)
+                current = content
+
+                if row.timestamp in timestamps:
+                    path = self.__temp_path(tmp_dir)
+                    rebuilt.append((row, path))
+                    shutil.copyfile(content, path)
+                    encode_in_place(path, self.codec)
+                    if len(rebuilt) == len(timestamps):
+                        break
+        except Exception:
+            for _, path in rebuilt:
+                os.remove(path)
+            raise
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return rebuilt
+
+    def __temp_path(self, tmp_dir):
+        handle, path = tempfile.mkstemp(dir=tmp_dir, suffix='.pack-tmp')
+        os.close(handle)
+        return path
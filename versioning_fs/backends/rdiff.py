@@ -0,0 +1,160 @@
+""" Snapshot backend that runs the rdiff-backup command line tool.
+"""
+import calendar
+import os
+import re
+from StringIO import StringIO
+from subprocess import Popen, PIPE
+import time
+
+from fs.errors import OperationFailedError
+from fs.tempfs import TempFS
+
+from versioning_fs.backends.base import DATAFILE, SnapshotBackend, \
+    SnapshotResult
+from versioning_fs.errors import SnapshotError
+from versioning_fs.staging import copy_file_object, stage_file
+
+
+DATA_DIR = 'rdiff-backup-data'  # inside each snapshot directory
+MIRROR_MARKER = 'current_mirror'  # names the time of the current version
+
+# the time in the names of rdiff-backup's files, e.g. 2014-06-05T10:22:31Z
+# or 2014-06-05T10-22-31-05-00 with compatible timestamps
+RDIFF_TIME = re.compile(r'^(\d{4}-\d\d-\d\d)T(\d\d)[:-](\d\d)[:-](\d\d)'
+                        r'(Z|([-+])(\d\d)[:-](\d\d))$')
+
+
+def parse_rdiff_time(name, prefix):
+    """Returns the Unix time in the name of an rdiff-backup file that starts
+       with a prefix, or None.
+    """
+    if not name.startswith(prefix + '.'):
+        return None
+    match = RDIFF_TIME.match(name[len(prefix) + 1:].split('.')[0])
+    if match is None:
+        return None
+    date, hours, minutes, seconds, zone, sign, zone_hours, zone_minutes = \
+        match.groups()
+    timestamp = calendar.timegm(time.strptime(
+        '%sT%s:%s:%s' % (date, hours, minutes, seconds), '%Y-%m-%dT%H:%M:%S'))
+    if zone != 'Z':
+        offset = int(zone_hours) * 3600 + int(zone_minutes) * 60
+        timestamp += -offset if sign == '+' else offset
+    return timestamp
+
+
+class RdiffBackupBackend(SnapshotBackend):
+    """Keeps an rdiff-backup repository in every snapshot directory."""
+    name = 'rdiff-backup'
+    min_interval = 1  # rdiff-backup must wait 1 second between versions
+
+    def snapshot(self, source_file, snap_dir, timestamp, tmp_dir,
+                 source_path=None):
+        # Create a temp file system to be snapshotted
+        temp_snapshot_fs = TempFS(temp_dir=tmp_dir)
+        src_path = temp_snapshot_fs.getsyspath('/')
+
+        staged_path = os.path.join(src_path, DATAFILE)
+        with self.metrics.timer('snapshot.stage'):
+            if source_path is not None:
+                # the staged file only lives until rdiff-backup is done
+                strategy = stage_file(source_path, staged_path)
+            else:
+                with temp_snapshot_fs.open(DATAFILE, 'wb') as temp_file:
+                    strategy = copy_file_object(source_file, temp_file)
+        self.metrics.observe('snapshot.bytes', os.path.getsize(staged_path))
+
+        command = ['rdiff-backup',
+                   '--parsable-output',
+                   '--no-eas',
+                   '--no-file-statistics',
+                   '--no-acls',
+                   '--current-time', str(timestamp),
+                   '--tempdir', tmp_dir,
+                   src_path, snap_dir]
+
+        with self.metrics.timer('snapshot.subprocess'):
+            process = Popen(command, stdout=PIPE, stderr=PIPE)
+            stderr = process.communicate()[1]
+
+        # close the temp snapshot filesystem
+        temp_snapshot_fs.close()
+
+        ignore = [lambda x: x.startswith("Warning: could not determine case")]
+
+        with self.metrics.timer('snapshot.parse'):
+            if len(stderr) != 0:
+                for rule in ignore:
+                    if not rule(stderr):
+                        raise SnapshotError(stderr)
+
+        return SnapshotResult(timestamp, strategy)
+
+    def restore(self, snap_dir, timestamp, dest_dir, tmp_dir):
+        command = ['rdiff-backup',
+                   '--restore-as-of', str(timestamp),
+                   snap_dir, dest_dir]
+        with self.metrics.timer('restore.subprocess'):
+            process = Popen(command, stdout=PIPE, stderr=PIPE)
+            process.communicate()
+
+    def remove_older_than(self, snap_dir, timestamp, tmp_dir):
+        date_to_delete = time.strftime('%Y-%m-%dT%H:%M:%S',
+                                       time.localtime(timestamp))
+        command = ['rdiff-backup',
+                   '--parsable-output',
+                   '--force',
+                   '--remove-older-than', date_to_delete,
+                   '--tempdir', tmp_dir,
+                   snap_dir]
+        with self.metrics.timer('prune.subprocess'):
+            process = Popen(command, stdout=PIPE, stderr=PIPE)
+            stderr = process.communicate()[1]
+
+        if len(stderr) > 0:
+            raise OperationFailedError(snap_dir)
+
+    def list_versions(self, snap_dir):
+        command = ['rdiff-backup',
+                   '--parsable-output',
+                   '-l', snap_dir]
+        with self.metrics.timer('list_versions.subprocess'):
+            process = Popen(command, stdout=PIPE, stderr=PIPE)
+            stdout = process.communicate()[0]
+
+        with self.metrics.timer('list_versions.parse'):
+            versions = []
+            listing_file = StringIO(stdout)
+            for line in listing_file:
+                version_number, _ = line.split()
+                versions.append(version_number)
+
+        return sorted(versions)
+
+    def list_byte_sizes(self, snap_dir, newest=None):
+        # read from the repository files, rdiff-backup only prints rounded
+        # sizes and takes a subprocess to do it
+        data_dir = os.path.join(snap_dir, DATA_DIR)
+        increments_dir = os.path.join(data_dir, 'increments')
+        if not os.path.isdir(data_dir):
+            return []
+
+        sizes = []
+        if os.path.isdir(increments_dir):
+            for name in os.listdir(increments_dir):
+                timestamp = parse_rdiff_time(name, DATAFILE)
+                if timestamp is not None:
+                    path = os.path.join(increments_dir, name)
+                    sizes.append((timestamp, os.path.getsize(path)))
+
+        mirror_path = os.path.join(snap_dir, DATAFILE)
+        for name in os.listdir(data_dir):
+            timestamp = parse_rdiff_time(name, MIRROR_MARKER)
+            if timestamp is not None and os.path.exists(mirror_path):
+                sizes.append((timestamp, os.path.getsize(mirror_path)))
+
+        sizes.sort()
+        if newest is not None:
+            sizes = sizes[-newest:]
+        return [(str(version), size) for version, size in sizes]
@@ -0,0 +1,226 @@
+""" Caches with least recently used eviction: restored versions on disk and
+    resolved snapshot paths in memory.
+"""
+from collections import OrderedDict
+import os
+import shutil
+import threading
+
+
+class RestoreCache(object):
+    """Keeps restored versions of files so they can be opened again without
+       rebuilding them.
+
+    Restored files are stored as '<key>/<timestamp>' inside the cache
+    directory, where the key identifies the snapshot directory of a file.
+    Once the cached files grow beyond max_size bytes, the least recently
+    used ones are deleted.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.__cache_dir = cache_dir
+        self.__max_size = max_size
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # (key, timestamp) -> size
+        self.__size = 0
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.__load()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_RestoreCache__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    @property
+    def size(self):
+        """Returns the number of bytes held by the cache."""
+        return self.__size
+
+    def get(self, key, timestamp):
+        """Returns the path of a cached version, or None."""
+        entry = (key, str(timestamp))
+        with self.__lock:
+            if entry not in self.__entries:
+                self.misses += 1
+                return None
+            # move the entry to the most recently used end
+            self.__entries[entry] = self.__entries.pop(entry)
+            self.hits += 1
+        return self.__path(*entry)
+
+    def put(self, key, timestamp, src_path):
+        """Moves a restored file into the cache and returns its new path."""
+        entry = (key, str(timestamp))
+        path = self.__path(*entry)
+        size = os.path.getsize(src_path)
+
+        with self.__lock:
+            key_dir = os.path.dirname(path)
+            if not os.path.isdir(key_dir):
+                os.makedirs(key_dir)
+            os.rename(src_path, path)
+
+            self.__size -= self.__entries.pop(entry, 0)
+            self.__entries[entry] = size
+            self.__size += size
+            self.__evict()
+        return path
+
+    def invalidate(self, key):
+        """Forgets every cached version of a key."""
+        with self.__lock:
+            for entry in [e for e in self.__entries if e[0] == key]:
+                self.__size -= self.__entries.pop(entry)
+            key_dir = os.path.join(self.__cache_dir, key)
+            if os.path.isdir(key_dir):
+                shutil.rmtree(key_dir, ignore_errors=True)
+
+    def clear(self):
+        """Forgets every cached version."""
+        with self.__lock:
+            for key in set(e[0] for e in self.__entries):
+                shutil.rmtree(os.path.join(self.__cache_dir, key),
+                              ignore_errors=True)
+            self.__entries.clear()
+            self.__size = 0
+
+    def __evict(self):
+        # the most recent entry stays, even when it is too big on its own
+        while self.__size > self.__max_size and len(self.__entries) > 1:
+            entry, size = self.__entries.popitem(last=False)
+            self.__size -= size
+            try:
+                # open readers keep their file until they close it
+                os.remove(self.__path(*entry))
+            except OSError:
+                pass
+
+    def __load(self):
+        """Picks up the versions cached by an earlier process, oldest access
+           first.
+        """
+        found = []
+        for key in os.listdir(self.__cache_dir):
+            key_dir = os.path.join(self.__cache_dir, key)
+            if not os.path.isdir(key_dir):
+                continue
+            for timestamp in os.listdir(key_dir):
+                stat = os.stat(os.path.join(key_dir, timestamp))
+                found.append((stat.st_atime, key, timestamp, stat.st_size))
+
+        for _, key, timestamp, size in sorted(found):
+            self.__entries[(key, timestamp)] = size
+            self.__size += size
+        self.__evict()
+
+    def __path(self, key, timestamp):
+        return os.path.join(self.__cache_dir, key, timestamp)
+
+
+class PathCache(object):
+    """Remembers what user paths resolve to, such as their snapshot
+       directories, for up to max_entries paths.
+
+    Paths are relative to the root of the filesystem. Resolving a path is
+    cheap but repeated for every file of a tree wide operation, which is
+    what this cache saves.
+
+    Forgetting a tree doesn't look at the cached paths: it bumps a
+    generation and remembers it for the root of the tree. A cached path is
+    stale when one of its ancestors was forgotten at a later generation
+    than the path was cached, which get() checks in as many steps as the
+    path is deep.
+    """
+    def __init__(self, max_entries):
+        self.__max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # path -> (resolved value, generation)
+        self.__generation = 0
+        self.__trees = {}  # root of a forgotten tree -> its generation
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_PathCache__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def hit_rate(self):
+        """Returns the fraction of lookups that were found in the cache."""
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def get(self, path):
+        """Returns the cached value of a path, or None."""
+        with self.__lock:
+            entry = self.__entries.pop(path, None)
+            if entry is None or self.__is_stale(path, entry[1]):
+                self.misses += 1
+                return None
+            self.__entries[path] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, path, value):
+        """Caches the value of a path."""
+        with self.__lock:
+            self.__entries.pop(path, None)
+            self.__entries[path] = (value, self.__generation)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, path):
+        """Forgets a path."""
+        with self.__lock:
+            self.__entries.pop(path, None)
+
+    def invalidate_tree(self, path):
+        """Forgets a path and every path under it."""
+        path = path.strip('/')
+        if not path:
+            self.clear()
+            return
+        with self.__lock:
+            if len(self.__trees) >= self.__max_entries:
+                # every cached path is older than the trees, start over
+                self.__entries.clear()
+                self.__trees.clear()
+            self.__generation += 1
+            self.__trees[path] = self.__generation
+            self.__entries.pop(path, None)
+
+    def clear(self):
+        """Forgets every path."""
+        with self.__lock:
+            self.__entries.clear()
+            self.__trees.clear()
+
+    def __is_stale(self, path, generation):
+        """Returns if an ancestor of a path cached at a generation was
+           forgotten since.
+        """
+        if not self.__trees:
+            return False
+        ancestor = ''
+        for name in path.strip('/').split('/'):
+            ancestor = ancestor + '/' + name if ancestor else name
+            if self.__trees.get(ancestor, 0) > generation:
+                return True
+        return False
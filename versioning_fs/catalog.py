@@ -0,0 +1,268 @@
+""" Persistent catalog of the versions stored for each snapshot directory.
+"""
+from contextlib import closing
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from versioning_fs.backends import BACKENDS, get_backend
+from versioning_fs.database import connect
+from versioning_fs.errors import VersionError
+
+
+CATALOG_EXTENSION = '.versions'
+
+
+def catalog_path(snap_dir):
+    """Returns the catalog file path that belongs to a snapshot directory."""
+    return snap_dir.rstrip(os.sep) + CATALOG_EXTENSION
+
+
+class VersionCatalog(object):
+    """Catalog of the versions of a single snapshot directory.
+
+    The catalog is a small JSON file stored next to the snapshot directory,
+    so version queries can be answered without asking the backend.
+    """
+    def __init__(self, snap_dir):
+        self.__snap_dir = snap_dir
+        self.__path = catalog_path(snap_dir)
+
+    @property
+    def path(self):
+        """Returns the path of the catalog file."""
+        return self.__path
+
+    def exists(self):
+        """Returns if the catalog file exists."""
+        return os.path.exists(self.__path)
+
+    def load(self):
+        """Returns the list of version entries, oldest first."""
+        try:
+            with open(self.__path, 'rb') as catalog_file:
+                data = json.load(catalog_file)
+        except (IOError, ValueError):
+            return []
+        return data.get('versions', [])
+
+    def save(self, entries):
+        """Atomically replaces the version entries of the catalog."""
+        entries = sorted(entries, key=lambda entry: int(entry['timestamp']))
+        handle, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.__path), suffix='.tmp')
+        with os.fdopen(handle, 'wb') as catalog_file:
+            json.dump({'versions': entries}, catalog_file)
+        os.rename(temp_path, self.__path)
+
+    def timestamps(self):
+        """Returns the sorted version timestamps."""
+        return [entry['timestamp'] for entry in self.load()]
+
+    def add(self, timestamp, **info):
+        """Records a new version in the catalog."""
+        entry = dict(info, timestamp=str(timestamp))
+        entries = [e for e in self.load() if e['timestamp'] != str(timestamp)]
+        entries.append(entry)
+        self.save(entries)
+
+    def update(self, timestamp, **info):
+        """Adds information to a recorded version."""
+        entries = self.load()
+        for entry in entries:
+            if entry['timestamp'] == str(timestamp):
+                entry.update(info)
+        self.save(entries)
+
+    def remove_before(self, timestamp):
+        """Forgets every version older than a timestamp. The most recent
+           version is always kept.
+        """
+        entries = self.load()
+        kept = [e for e in entries[:-1] if int(e['timestamp']) >= timestamp]
+        self.save(kept + entries[-1:])
+
+    def remove_versions(self, timestamps):
+        """Forgets the versions with the given timestamps. The most recent
+           version is always kept.
+        """
+        timestamps = set(str(t) for t in timestamps)
+        entries = self.load()
+        kept = [e for e in entries[:-1] if e['timestamp'] not in timestamps]
+        self.save(kept + entries[-1:])
+
+    def record_sizes(self, sizes):
+        """Records the bytes stored for versions, given as (timestamp,
+           bytes) pairs.
+        """
+        sizes = dict(sizes)
+        entries = self.load()
+        for entry in entries:
+            if entry['timestamp'] in sizes:
+                entry['stored'] = sizes[entry['timestamp']]
+        self.save(entries)
+
+    def record_codecs(self, codecs):
+        """Records the codec versions are stored with, given as (timestamp,
+           codec name) pairs.
+        """
+        codecs = dict(codecs)
+        entries = self.load()
+        for entry in entries:
+            if entry['timestamp'] in codecs:
+                entry['codec'] = codecs[entry['timestamp']]
+        self.save(entries)
+
+    def rebuild(self, backend):
+        """Rebuilds the catalog from the data stored by a backend."""
+        versions = backend.list_versions(self.__snap_dir)
+        sizes = dict(backend.list_byte_sizes(self.__snap_dir))
+        codecs = {}
+        if backend.compressible:
+            codecs = dict(backend.list_codecs(self.__snap_dir))
+        entries = []
+        for version in versions:
+            entry = {'timestamp': version}
+            if version in sizes:
+                entry['stored'] = sizes[version]
+            if version in codecs:
+                entry['codec'] = codecs[version]
+            entries.append(entry)
+        self.save(entries)
+
+    def move(self, snap_dir):
+        """Moves the catalog next to another snapshot directory."""
+        if self.exists():
+            os.rename(self.__path, catalog_path(snap_dir))
+        elif os.path.exists(catalog_path(snap_dir)):
+            # never leave a stale catalog behind at the destination
+            os.remove(catalog_path(snap_dir))
+        self.__snap_dir = snap_dir
+        self.__path = catalog_path(snap_dir)
+
+    def remove(self):
+        """Deletes the catalog file."""
+        if self.exists():
+            os.remove(self.__path)
+
+
+class IndexedCatalog(VersionCatalog):
+    """Catalog of the versions of a single snapshot directory, kept as rows
+       of a table in an SQLite database of the backend instead of a file,
+       for backends that store many files without a directory each.
+
+    Each version is a row under the key of the snapshot directory, with
+    the information of its entry as JSON. The backend creates the catalog
+    table along with the database.
+    """
+    def __init__(self, snap_dir, db_path, key):
+        super(IndexedCatalog, self).__init__(snap_dir)
+        self.__db_path = db_path
+        self.__key = key
+
+    @property
+    def path(self):
+        """Returns the path of the database."""
+        return self.__db_path
+
+    def exists(self):
+        """Returns if the database holds any version of the catalog."""
+        if not os.path.exists(self.__db_path):
+            return False
+        with closing(connect(self.__db_path)) as db:
+            return db.execute("SELECT 1 FROM catalog WHERE key = ? LIMIT 1",
+                              (self.__key,)).fetchone() is not None
+
+    def load(self):
+        """Returns the list of version entries, oldest first."""
+        if not os.path.exists(self.__db_path):
+            return []
+        with closing(connect(self.__db_path)) as db:
+            rows = db.execute("SELECT timestamp, info FROM catalog WHERE "
+                              "key = ? ORDER BY timestamp", (self.__key,))
+            return [dict(json.loads(info), timestamp=str(timestamp))
+                    for timestamp, info in rows]
+
+    def save(self, entries):
+        """Replaces the version entries of the catalog in one transaction.
+        """
+        if not os.path.exists(self.__db_path):
+            if not entries:
+                return
+            raise VersionError("No versions are stored for %s." %
+                               self.__key)
+        rows = []
+        for entry in entries:
+            info = dict(entry)
+            timestamp = int(info.pop('timestamp'))
+            rows.append((self.__key, timestamp, json.dumps(info)))
+        with closing(connect(self.__db_path)) as db:
+            with db:
+                db.execute("DELETE FROM catalog WHERE key = ?", (self.__key,))
+                db.executemany("INSERT INTO catalog VALUES (?, ?, ?)", rows)
+
+    def move(self, snap_dir):
+        """Moves the catalog to another snapshot directory of the same
+           database.
+        """
+        key = os.path.basename(snap_dir.rstrip(os.sep))
+        if os.path.exists(self.__db_path):
+            with closing(connect(self.__db_path)) as db:
+                with db:
+                    # never leave a stale catalog behind at the destination
+                    db.execute("DELETE FROM catalog WHERE key = ?", (key,))
+                    db.execute("UPDATE catalog SET key = ? WHERE key = ?",
+                               (key, self.__key))
+        # the catalog now belongs to the other snapshot directory
+        super(IndexedCatalog, self).__init__(snap_dir)
+        self.__key = key
+
+    def remove(self):
+        """Deletes the rows of the catalog."""
+        if os.path.exists(self.__db_path):
+            with closing(connect(self.__db_path)) as db:
+                with db:
+                    db.execute("DELETE FROM catalog WHERE key = ?",
+                               (self.__key,))
+
+
+def open_catalog(snap_dir, backend):
+    """Returns the catalog of a snapshot directory: an IndexedCatalog in
+       the database the backend names with catalog_index(), or else a
+       VersionCatalog next to the directory.
+    """
+    index = backend.catalog_index(snap_dir)
+    if index is None:
+        return VersionCatalog(snap_dir)
+    return IndexedCatalog(snap_dir, *index)
+
+
+def rebuild_catalogs(backup_dir, backend):
+    """Rebuilds the catalog of every snapshot directory in a backup tree.
+       Returns the number of catalogs that were written.
+    """
+    count = 0
+    for snap_dir in backend.list_snap_dirs(backup_dir):
+        open_catalog(snap_dir, backend).rebuild(backend)
+        count += 1
+    return count
+
+
+def main(argv=None):
+    """Command line entry point: rebuild the catalogs of a backup tree."""
+    parser = argparse.ArgumentParser(
+        description="Rebuild the version catalogs of a backup tree.")
+    parser.add_argument('backup_dir')
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        default='rdiff-backup')
+    args = parser.parse_args(argv)
+
+    count = rebuild_catalogs(args.backup_dir, get_backend(args.backend))
+    sys.stdout.write("rebuilt %d catalogs\n" % count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
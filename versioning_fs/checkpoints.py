@@ -0,0 +1,192 @@
+""" Full copies kept among the deltas of a file, so restoring any version
+    applies a bounded number of deltas.
+"""
+import argparse
+from collections import namedtuple
+import os
+import shutil
+import sys
+import tempfile
+
+from versioning_fs.backends import BACKENDS, get_backend
+from versioning_fs.catalog import open_catalog
+from versioning_fs import nodes
+from versioning_fs import version_index
+
+
+# what restoring a version takes: the deltas applied and the bytes read
+RestoreCost = namedtuple('RestoreCost', ['deltas', 'bytes'])
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+class CheckpointPolicy(object):
+    """Decides which versions are kept in full instead of as a delta.
+
+    A version is kept in full when the deltas that would have to be applied
+    through it, from the next older full copy or the oldest version, number
+    `every` or add up to max_delta_bytes. Restoring a version then applies
+    at most `every` deltas, and reads about max_delta_bytes of them.
+    """
+    def __init__(self, every=None, max_delta_bytes=None):
+        """
+        Parameters
+          every (int) (optional): The most deltas applied by a restore.
+          max_delta_bytes (int) (optional): The bytes of deltas after which
+                a full copy is kept.
+        """
+        self.every = every
+        self.max_delta_bytes = max_delta_bytes
+
+    def needs_checkpoint(self, deltas, delta_bytes):
+        """Returns if a version must be kept in full, given the number and
+           the bytes of the deltas chained through it.
+        """
+        if self.every is not None and deltas >= self.every:
+            return True
+        if self.max_delta_bytes is not None and \
+                delta_bytes >= self.max_delta_bytes:
+            return True
+        return False
+
+    def plan(self, chain):
+        """Returns the timestamps of the deltas to turn into full copies.
+
+        Parameters
+          chain (list): (timestamp, is full, bytes stored) of every version,
+                oldest first, as listed by a backend's list_chain().
+        """
+        checkpoints = []
+        deltas = delta_bytes = 0
+        for timestamp, full, size in reversed(chain):
+            if not full and self.needs_checkpoint(deltas, delta_bytes):
+                checkpoints.append(timestamp)
+                full = True
+            if full:
+                deltas = delta_bytes = 0
+            else:
+                deltas += 1
+                delta_bytes += size
+        checkpoints.reverse()
+        return checkpoints
+
+
+def restore_cost(chain):
+    """Returns the RestoreCost of the version that is the most expensive to
+       restore in a chain listed by a backend's list_chain().
+    """
+    worst = RestoreCost(0, 0)
+    deltas = delta_bytes = full_bytes = 0
+    for _, full, size in reversed(chain):
+        if full:
+            deltas = delta_bytes = 0
+            full_bytes = size
+        else:
+            deltas += 1
+            delta_bytes += size
+        worst = max(worst, RestoreCost(deltas, delta_bytes + full_bytes))
+    return worst
+
+
+def open_version_index(backup_dir):
+    """Returns the version index of a backup tree, or None if it has
+       none.
+    """
+    index_path = os.path.join(backup_dir, version_index.INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    return version_index.VersionIndex(
+        index_path, os.path.join(backup_dir, nodes.INDEX_NAME))
+
+
+def add_checkpoints(backup_dir, backend, policy, tmp_dir, progress=None):
+    """Turns the deltas of every snapshot directory of a backup tree into
+       full copies where a policy asks for one, and records the new sizes.
+       Returns the number of versions turned into full copies.
+
+    Parameters
+      progress (callable) (optional): Called as progress(done, total) after
+            each snapshot directory.
+    """
+    versions = open_version_index(backup_dir)
+    count = 0
+    snap_dirs = backend.list_snap_dirs(backup_dir)
+    for done, snap_dir in enumerate(snap_dirs, 1):
+        added = backend.add_checkpoints(snap_dir, policy, tmp_dir)
+        if added:
+            count += len(added)
+            sizes = backend.list_byte_sizes(snap_dir)
+            catalog = open_catalog(snap_dir, backend)
+            if catalog.exists():
+                catalog.record_sizes(sizes)
+            if versions is not None:
+                versions.record_sizes(os.path.basename(snap_dir), sizes)
+        if progress is not None:
+            progress(done, len(snap_dirs))
+    return count
+
+
+def restore_costs(backup_dir, backend):
+    """Returns (snapshot directory, RestoreCost) of the most expensive
+       version to restore of every snapshot directory, the most expensive
+       first.
+    """
+    costs = [(snap_dir, restore_cost(backend.list_chain(snap_dir)))
+             for snap_dir in backend.list_snap_dirs(backup_dir)]
+    costs.sort(key=lambda item: item[1], reverse=True)
+    return costs
+
+
+def parse_size(size):
+    """Parses a size such as '64M' into bytes."""
+    size = size.strip().upper()
+    if size[-1:] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def main(argv=None):
+    """Command line entry point: report the restore cost of every file of a
+       backup tree, and add checkpoints to bound it.
+    """
+    parser = argparse.ArgumentParser(
+        description="Report the worst restore cost of every file of a backup "
+                    "tree, and add full copies to long delta chains.")
+    parser.add_argument('backup_dir')
+    parser.add_argument('--backend', choices=sorted(
+        name for name, backend in BACKENDS.items() if backend.chained),
+        default='native')
+    parser.add_argument('--every', type=int,
+                        help="the most deltas a restore applies")
+    parser.add_argument('--max-delta-bytes', type=parse_size,
+                        help="the bytes of deltas after which a full copy is "
+                             "kept, e.g. 64M")
+    parser.add_argument('--top', type=int, default=20,
+                        help="the number of files reported")
+    parser.add_argument('--tmp-dir', help="scratch space for rebuilds")
+    args = parser.parse_args(argv)
+    backend = get_backend(args.backend)
+
+    if args.every is not None or args.max_delta_bytes is not None:
+        policy = CheckpointPolicy(args.every, args.max_delta_bytes)
+        tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+        try:
+            count = add_checkpoints(args.backup_dir, backend, policy,
+                                    tmp_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        sys.stdout.write("stored %d versions in full\n" % count)
+
+    paths = {}
+    versions = open_version_index(args.backup_dir)
+    if versions is not None:
+        paths = dict(versions.iter_paths())
+    for snap_dir, cost in restore_costs(args.backup_dir, backend)[:args.top]:
+        name = os.path.basename(snap_dir)
+        sys.stdout.write("%6d deltas %12d bytes  %s\n" %
+                         (cost.deltas, cost.bytes, paths.get(name, name)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+""" Content-defined chunking in the style of FastCDC: a gear hash rolled over
+    the content picks chunk boundaries, so an edit only changes the chunks
+    around it and identical data cuts into identical chunks in any file.
+"""
+import hashlib
+import struct
+
+
+MIN_SIZE = 4 * 1024
+AVG_SIZE = 16 * 1024
+MAX_SIZE = 64 * 1024
+
+READ_SIZE = 1024 * 1024  # bytes of the content to buffer at a time
+
+# a random 32 bit value for each byte value, derived so it never changes:
+# boundaries, and with them deduplication, depend on it
+GEAR = [struct.unpack('>I', hashlib.sha256(chr(i)).digest()[:4])[0]
+        for i in range(256)]
+
+chunk_hasher = hashlib.sha256  # names chunks by their content
+
+
+def masks_for(avg_size):
+    """Returns the boundary masks used before and after the average size.
+
+    The first mask has more bits set, so cuts are rarer before the average
+    size and more likely after it, which keeps sizes close to the average.
+    The bits are the high ones, which depend on the most recent bytes.
+    """
+    bits = max(1, avg_size.bit_length() - 1)
+    strict = ((1 << (bits + 2)) - 1) << (32 - bits - 2)
+    loose = ((1 << (bits - 2)) - 1) << (32 - bits + 2)
+    return strict, loose
+
+
+def cut_point(data, start, end, min_size=MIN_SIZE, avg_size=AVG_SIZE,
+              max_size=MAX_SIZE, masks=None):
+    """Returns the end of the chunk starting at `start` in a bytearray,
+       given that the content ends at `end` or goes on past max_size.
+    """
+    if end - start <= min_size:
+        return end
+    strict, loose = masks or masks_for(avg_size)
+    limit = min(end, start + max_size)
+    normal = min(limit, start + avg_size)
+    gear = GEAR
+    h = 0
+    i = start + min_size
+    while i < normal:
+        h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        if not h & strict:
+            return i + 1
+        i += 1
+    while i < limit:
+        h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        if not h & loose:
+            return i + 1
+        i += 1
+    return limit
+
+
+def iter_chunks(file_object, min_size=MIN_SIZE, avg_size=AVG_SIZE,
+                max_size=MAX_SIZE):
+    """Yields the content of a file object cut into chunks."""
+    masks = masks_for(avg_size)
+    buf = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < max_size:
+            # drop what was consumed before buffering more
+            del buf[:pos]
+            pos = 0
+            data = file_object.read(READ_SIZE)
+            if data:
+                buf.extend(data)
+                continue
+            eof = True
+        if pos == len(buf):
+            return
+        end = cut_point(buf, pos, len(buf), min_size, avg_size, max_size,
+                        masks)
+        yield bytes(buf[pos:end])
+        pos = end
+
+
+def chunk_id(data):
+    """Returns the ID of a chunk, the hex digest of its content."""
+    return chunk_hasher(data).hexdigest()
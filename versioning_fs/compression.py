@@ -0,0 +1,351 @@
+""" Codecs that compress the full copies and deltas kept by the backends.
+
+    A compressed file starts with a header naming its codec, so every stored
+    file says how to read it back, whatever codec is configured now. Files
+    without a header are stored as they are.
+
+    The content is compressed in blocks of BLOCK_SIZE bytes, each on its
+    own, followed by the offset of every block and a trailer. Reading part
+    of a file only decompresses the blocks it covers.
+"""
+import os
+import struct
+import zlib
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+BLOCK_MAGIC = 'VFSZ\x02'  # followed by the length and the name of the codec
+ENCODED_EXTENSION = '.z'  # a file being compressed
+BLOCK_SIZE = 256 * 1024  # bytes of content compressed on their own
+
+BLOCK_OFFSET = struct.Struct('>Q')
+# at the end of the file: the offset of the block offsets, the size of the
+# content and the block size
+TRAILER = struct.Struct('>QQI')
+
+
+class Passthrough(object):
+    """A compressor and decompressor that leaves data as it is."""
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+
+class Lz4Compressor(object):
+    """Gives an LZ4 frame compressor the interface of zlib's."""
+    def __init__(self, level):
+        self.__compressor = lz4_frame.LZ4FrameCompressor(
+            compression_level=level)
+        self.__header = None
+
+    def compress(self, data):
+        return self.__begin() + self.__compressor.compress(data)
+
+    def flush(self):
+        return self.__begin() + self.__compressor.flush()
+
+    def __begin(self):
+        if self.__header is None:
+            self.__header = self.__compressor.begin()
+            return self.__header
+        return ''
+
+
+class Codec(object):
+    """Compresses data as a stream, at a level."""
+    name = None
+    default_level = None
+    available = True  # if the module it needs is installed
+
+    def __init__(self, level=None):
+        """
+        Parameters
+          level (int) (optional): The compression level, the codec's default
+                if not given.
+        """
+        if not self.available:
+            raise ValueError("The %s codec needs a module that is not "
+                             "installed." % self.name)
+        if level is None:
+            level = self.default_level
+        self.level = level
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.spec)
+
+    @property
+    def spec(self):
+        """Returns the codec as get_codec() takes it, such as 'zstd:3'."""
+        if self.level is None:
+            return self.name
+        return '%s:%d' % (self.name, self.level)
+
+    def compressor(self):
+        """Returns an object with compress(data) and flush() methods."""
+        raise NotImplementedError
+
+    def decompressor(self):
+        """Returns an object with a decompress(data) method."""
+        raise NotImplementedError
+
+
+class NoCodec(Codec):
+    """Stores data uncompressed."""
+    name = 'none'
+
+    def compressor(self):
+        return Passthrough()
+
+    def decompressor(self):
+        return Passthrough()
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    default_level = 6
+
+    def compressor(self):
+        return zlib.compressobj(self.level)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+    default_level = 0
+    available = lz4_frame is not None
+
+    def compressor(self):
+        return Lz4Compressor(self.level)
+
+    def decompressor(self):
+        return lz4_frame.LZ4FrameDecompressor()
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    default_level = 3
+    available = zstandard is not None
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+CODECS = {
+    NoCodec.name: NoCodec,
+    ZlibCodec.name: ZlibCodec,
+    Lz4Codec.name: Lz4Codec,
+    ZstdCodec.name: ZstdCodec,
+}
+
+NO_CODEC = NoCodec()
+
+
+def get_codec(spec):
+    """Returns a codec from its name and optional level, such as 'zstd' or
+       'zstd:9'. A Codec is returned as is, and None means no compression.
+    """
+    if spec is None:
+        return NO_CODEC
+    if isinstance(spec, Codec):
+        return spec
+    name, _, level = spec.partition(':')
+    try:
+        codec_class = CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown codec: %s" % name)
+    try:
+        level = int(level) if level else None
+    except ValueError:
+        raise ValueError("Invalid codec level: %s" % spec)
+    return codec_class(level)
+
+
+def read_header(stored_file):
+    """Returns the name of the codec of a stored file object, which is left
+       at the start of its data. Files stored as they are give 'none'.
+    """
+    return _read_header(stored_file) or NoCodec.name
+
+
+def _read_header(stored_file):
+    """Returns the name of the codec of a stored file object, or None for a
+       file stored as it is, without a header.
+    """
+    if stored_file.read(len(BLOCK_MAGIC)) != BLOCK_MAGIC:
+        stored_file.seek(0)
+        return None
+    length = ord(stored_file.read(1))
+    return stored_file.read(length)
+
+
+def read_fully(src_file, size):
+    """Reads size bytes from a file object, fewer only at its end."""
+    chunks = []
+    while size > 0:
+        data = src_file.read(size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def encode(src_file, dst_file, codec, block_size=BLOCK_SIZE):
+    """Writes the content of a file object to another, compressed with a
+       codec in blocks after a header that names it.
+    """
+    header = BLOCK_MAGIC + chr(len(codec.name)) + codec.name
+    dst_file.write(header)
+    position = len(header)
+    offsets = []
+    size = 0
+    for data in iter(lambda: read_fully(src_file, block_size), ''):
+        compressor = codec.compressor()
+        block = compressor.compress(data) + compressor.flush()
+        dst_file.write(block)
+        offsets.append(position)
+        position += len(block)
+        size += len(data)
+    dst_file.write(''.join(BLOCK_OFFSET.pack(offset) for offset in offsets))
+    dst_file.write(TRAILER.pack(position, size, block_size))
+
+
+def encode_file(path, codec):
+    """Returns the path of a file as it is stored with a codec: the file
+       itself when it is stored as it is, or a new file next to it.
+    """
+    if codec.name == NoCodec.name:
+        with open(path, 'rb') as src_file:
+            # only a file that could be taken for a header needs one
+            if src_file.read(len(BLOCK_MAGIC)) != BLOCK_MAGIC:
+                return path
+    encoded_path = path + ENCODED_EXTENSION
+    with open(path, 'rb') as src_file, \
+            open(encoded_path, 'wb') as dst_file:
+        encode(src_file, dst_file, codec)
+    return encoded_path
+
+
+def encode_in_place(path, codec):
+    """Replaces a file with its content as stored with a codec."""
+    encoded_path = encode_file(path, codec)
+    if encoded_path != path:
+        os.rename(encoded_path, path)
+
+
+def open_stored(stored_file):
+    """Returns a seekable file object with the content of a stored file
+       object, decompressed as it is read. A file stored as it is is
+       returned itself. Closing the returned file closes the stored one.
+    """
+    try:
+        name = _read_header(stored_file)
+        if name is None:
+            return stored_file
+        return BlockFile(stored_file, get_codec(name))
+    except Exception:
+        stored_file.close()
+        raise
+
+
+class BlockFile(object):
+    """A read-only file object over content compressed in blocks, which
+       only decompresses the blocks that are read. The last block read is
+       kept, so small reads don't decompress it again.
+    """
+    def __init__(self, stored_file, codec):
+        self.__file = stored_file
+        self.__codec = codec
+        stored_file.seek(-TRAILER.size, 2)
+        trailer_offset = stored_file.tell()
+        index_offset, self.__size, self.__block_size = TRAILER.unpack(
+            read_fully(stored_file, TRAILER.size))
+        stored_file.seek(index_offset)
+        index = read_fully(stored_file, trailer_offset - index_offset)
+        # where each block starts, and where the last one ends
+        self.__offsets = [BLOCK_OFFSET.unpack_from(index, start)[0]
+                          for start in range(0, len(index),
+                                             BLOCK_OFFSET.size)]
+        self.__offsets.append(index_offset)
+        self.__block = (None, '')
+        self.__position = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self):
+        """Returns the size of the content."""
+        return self.__size
+
+    def read(self, size=-1):
+        end = self.__size
+        if size is not None and size >= 0:
+            end = min(end, self.__position + size)
+        chunks = []
+        while self.__position < end:
+            number, skip = divmod(self.__position, self.__block_size)
+            data = self.__load(number)[skip:skip + end - self.__position]
+            if not data:
+                raise ValueError("Unexpected end of file.")
+            chunks.append(data)
+            self.__position += len(data)
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.__position
+        elif whence == 2:
+            offset += self.__size
+        if offset < 0:
+            raise IOError("Invalid offset: %s" % offset)
+        self.__position = offset
+
+    def tell(self):
+        return self.__position
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.__file.close()
+
+    def __load(self, number):
+        """Returns the decompressed content of a block."""
+        if self.__block[0] != number:
+            start, end = self.__offsets[number], self.__offsets[number + 1]
+            self.__file.seek(start)
+            decompressor = self.__codec.decompressor()
+            data = decompressor.decompress(read_fully(self.__file,
+                                                      end - start))
+            if hasattr(decompressor, 'flush'):
+                data += decompressor.flush()
+            self.__block = (number, data)
+        return self.__block[1]
+
+
+def open_path(path):
+    """Returns a seekable file object with the content of a stored file."""
+    return open_stored(open(path, 'rb'))
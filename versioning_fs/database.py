@@ -0,0 +1,42 @@
+""" SQLite databases kept next to the versions, such as indexes.
+"""
+import os
+import sqlite3
+import tempfile
+
+
+TIMEOUT = 60  # seconds to wait for another writer
+
+
+def connect(path):
+    """Returns a connection to a database."""
+    db = sqlite3.connect(path, timeout=TIMEOUT)
+    db.text_factory = str  # paths may be byte strings
+    return db
+
+
+def create_database(path, schema):
+    """Creates a database with a schema unless it exists.
+
+    The database is created under another name and linked into place, so
+    nobody ever opens it before the schema is there.
+    """
+    if os.path.exists(path):
+        return
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         suffix='.tmp')
+    os.close(handle)
+    try:
+        db = connect(temp_path)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(schema)
+        finally:
+            db.close()
+        try:
+            os.link(temp_path, path)
+        except OSError:
+            if not os.path.exists(path):
+                raise
+    finally:
+        os.remove(temp_path)
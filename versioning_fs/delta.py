@@ -0,0 +1,309 @@
+""" rsync style binary deltas: a rolling weak checksum to find candidate
+    blocks and a strong hash to confirm them.
+"""
+import bisect
+import hashlib
+import math
+import struct
+
+
+MAGIC = 'VFSD\x01'
+
+COPY = 'C'
+LITERAL = 'L'
+
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 64 * 1024
+
+READ_SIZE = 1024 * 1024  # bytes of the target file to buffer at a time
+
+strong_hasher = hashlib.sha256  # confirms weak checksum matches
+
+
+def block_size_for(size):
+    """Returns a block size suited to a basis file of a given size."""
+    block_size = int(math.sqrt(size)) & ~7
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def weak_checksum(data):
+    """Returns the two halves of the rolling checksum of a bytearray."""
+    length = len(data)
+    a = sum(data) & 0xffff
+    b = sum((length - i) * x for i, x in enumerate(data)) & 0xffff
+    return a, b
+
+
+class Signature(object):
+    """Block checksums of a basis file."""
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.blocks = {}
+
+    def add(self, offset, data):
+        """Adds the checksums of a block that starts at an offset."""
+        a, b = weak_checksum(bytearray(data))
+        strong = strong_hasher(data).digest()
+        key = a | (b << 16)
+        self.blocks.setdefault(key, []).append((strong, offset, len(data)))
+
+    def find(self, key, data):
+        """Returns the (offset, length) of a basis block matching some data,
+           or None.
+        """
+        candidates = self.blocks.get(key)
+        if not candidates:
+            return None
+        strong = strong_hasher(bytes(data)).digest()
+        for block_strong, offset, length in candidates:
+            if length == len(data) and block_strong == strong:
+                return offset, length
+        return None
+
+
+def signature(basis_file, block_size=None, size=None):
+    """Returns the signature of a basis file object."""
+    if block_size is None:
+        block_size = block_size_for(size or 0)
+    sig = Signature(block_size)
+    offset = 0
+    while True:
+        data = basis_file.read(block_size)
+        if not data:
+            break
+        sig.add(offset, data)
+        offset += len(data)
+    return sig
+
+
+class DeltaWriter(object):
+    """Serializes delta operations, merging adjacent ones."""
+    def __init__(self, delta_file):
+        self.__file = delta_file
+        self.__copy = None
+        self.__file.write(MAGIC)
+
+    def copy(self, offset, length):
+        """Adds an operation copying a range of the basis file."""
+        if self.__copy is not None:
+            copy_offset, copy_length = self.__copy
+            if copy_offset + copy_length == offset:
+                self.__copy = (copy_offset, copy_length + length)
+                return
+            self.__flush_copy()
+        self.__copy = (offset, length)
+
+    def literal(self, data):
+        """Adds an operation inserting literal bytes."""
+        if not data:
+            return
+        self.__flush_copy()
+        self.__file.write(LITERAL + struct.pack('>Q', len(data)))
+        self.__file.write(bytes(data))
+
+    def close(self):
+        """Writes any pending operation."""
+        self.__flush_copy()
+
+    def __flush_copy(self):
+        if self.__copy is not None:
+            self.__file.write(COPY + struct.pack('>QQ', *self.__copy))
+            self.__copy = None
+
+
+def delta(sig, target_file, delta_file):
+    """Writes the delta that turns the basis of a signature into the content
+       of a target file object.
+    """
+    writer = DeltaWriter(delta_file)
+    block_size = sig.block_size
+
+    buf = bytearray()
+    pos = 0  # start of the rolling window in buf
+    literal_start = 0  # first byte in buf not yet written to the delta
+    eof = False
+    a = b = None
+
+    while True:
+        if not eof and len(buf) - pos <= block_size:
+            # flush pending literal bytes and drop what was consumed
+            writer.literal(buf[literal_start:pos])
+            del buf[:pos]
+            pos = literal_start = 0
+            data = target_file.read(max(READ_SIZE, block_size * 2))
+            if data:
+                buf.extend(data)
+            else:
+                eof = True
+
+        remaining = len(buf) - pos
+        if remaining < block_size:
+            # the tail can only match the short last block of the basis
+            if remaining:
+                window = buf[pos:]
+                a, b = weak_checksum(window)
+                match = sig.find(a | (b << 16), window)
+                if match is None:
+                    writer.literal(buf[literal_start:])
+                else:
+                    writer.literal(buf[literal_start:pos])
+                    writer.copy(*match)
+            else:
+                writer.literal(buf[literal_start:])
+            break
+
+        if a is None:
+            a, b = weak_checksum(buf[pos:pos + block_size])
+
+        match = sig.find(a | (b << 16), buf[pos:pos + block_size])
+        if match is not None:
+            writer.literal(buf[literal_start:pos])
+            writer.copy(*match)
+            pos += block_size
+            literal_start = pos
+            a = b = None
+            continue
+
+        # roll the window forward by a single byte
+        if pos + block_size < len(buf):
+            out_byte = buf[pos]
+            in_byte = buf[pos + block_size]
+            a = (a - out_byte + in_byte) & 0xffff
+            b = (b - block_size * out_byte + a) & 0xffff
+        else:
+            a = b = None
+        pos += 1
+
+    writer.close()
+
+
+def iter_delta(delta_file):
+    """Yields the operations of a delta file object as (op, offset, length)
+       tuples. The offset of a COPY is in the basis file; the offset of a
+       LITERAL is in the delta file itself.
+    """
+    if delta_file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a delta file.")
+    position = len(MAGIC)
+    while True:
+        op = delta_file.read(1)
+        if not op:
+            break
+        if op == COPY:
+            offset, length = struct.unpack('>QQ', delta_file.read(16))
+            position += 17
+            yield COPY, offset, length
+        elif op == LITERAL:
+            length, = struct.unpack('>Q', delta_file.read(8))
+            position += 9
+            yield LITERAL, position, length
+            position += length
+            delta_file.seek(position)
+        else:
+            raise ValueError("Corrupt delta file.")
+
+
+def copy_range(src, dst, offset, length, buffer_size=READ_SIZE):
+    """Copies a byte range of one file object into another."""
+    src.seek(offset)
+    while length > 0:
+        data = src.read(min(buffer_size, length))
+        if not data:
+            raise ValueError("Unexpected end of file.")
+        dst.write(data)
+        length -= len(data)
+
+
+def patch(basis_file, delta_file, out_file):
+    """Applies a delta to a basis file object, writing the result to another
+       file object.
+    """
+    for op, offset, length in list(iter_delta(delta_file)):
+        if op == COPY:
+            copy_range(basis_file, out_file, offset, length)
+        else:
+            copy_range(delta_file, out_file, offset, length)
+
+
+class PatchedFile(object):
+    """A read-only file object with the content of a basis file patched by a
+       delta, rebuilt as it is read instead of written out first.
+
+    The operations of the delta are indexed by the offset they start at in
+    the patched file, so seeking only looks up a checkpoint and reading a
+    range only touches the operations that cover it. The basis can be any
+    seekable file object, including another PatchedFile, so a chain of
+    deltas can be stacked on top of a full copy. Closing the file closes
+    the delta and the basis.
+    """
+    def __init__(self, basis_file, delta_file):
+        self.__basis_file = basis_file
+        self.__delta_file = delta_file
+        self.__starts = []  # offset in the patched file of each operation
+        self.__ops = []
+        self.__size = 0
+        for op in iter_delta(delta_file):
+            if op[2]:
+                self.__starts.append(self.__size)
+                self.__ops.append(op)
+                self.__size += op[2]
+        self.__position = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self):
+        """Returns the size of the patched file."""
+        return self.__size
+
+    def read_range(self, offset, length):
+        """Returns up to length bytes of the patched file from an offset."""
+        end = min(offset + length, self.__size)
+        chunks = []
+        index = bisect.bisect_right(self.__starts, offset) - 1
+        while offset < end:
+            op, op_offset, op_length = self.__ops[index]
+            skip = offset - self.__starts[index]
+            count = min(op_length - skip, end - offset)
+            if op == COPY:
+                source = self.__basis_file
+            else:
+                source = self.__delta_file
+            source.seek(op_offset + skip)
+            data = source.read(count)
+            if len(data) != count:
+                raise ValueError("Unexpected end of file.")
+            chunks.append(data)
+            offset += count
+            index += 1
+        return ''.join(chunks)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.__size - self.__position
+        data = self.read_range(self.__position, size)
+        self.__position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.__position
+        elif whence == 2:
+            offset += self.__size
+        if offset < 0:
+            raise IOError("Invalid offset: %s" % offset)
+        self.__position = offset
+
+    def tell(self):
+        return self.__position
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.__delta_file.close()
+            self.__basis_file.close()
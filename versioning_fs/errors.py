@@ -23,3 +23,9 @@ class VersionError(BaseError):
     """Raised when an invalid file version is requested."""
     def __init__(self, *args, **kwargs):
         super(VersionError, self).__init__(*args, **kwargs)
+
+
+class QueueFullError(BaseError):
+    """Raised when the snapshot queue has no room for another path."""
+    def __init__(self, *args, **kwargs):
+        super(QueueFullError, self).__init__(*args, **kwargs)
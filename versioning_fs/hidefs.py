@@ -1,12 +1,82 @@
 """ Filesystem that can hide a specific directory.
 """
+import datetime
+import os
 import re
+import stat
 
-from fs.errors import FSError
-from fs.path import abspath, basename, normpath, pathcombine, pathjoin
+from fs.errors import FSError, ResourceNotFoundError
+from fs.path import abspath, normpath, pathcombine, pathjoin, relpath
 from fs.wrapfs import WrapFS
 import fnmatch
 
+try:
+    scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+HIDDEN = None  # marks the trie node of a hidden path
+
+
+def scan_dir(sys_path):
+    """Yields the name and stat result of each entry of a directory. The
+       stat result is None for entries that disappear while scanning.
+    """
+    if scandir is not None:
+        for entry in scandir(sys_path):
+            try:
+                yield entry.name, entry.stat()
+            except OSError:
+                yield entry.name, None
+    else:
+        for name in os.listdir(sys_path):
+            try:
+                yield name, os.stat(os.path.join(sys_path, name))
+            except OSError:
+                yield name, None
+
+
+def stat_info(stats):
+    """Returns the info dict that OSFS.getinfo() builds from a stat result.
+    """
+    info = dict((k, getattr(stats, k)) for k in dir(stats)
+                if k.startswith('st_'))
+    info['size'] = info['st_size']
+    fromtimestamp = datetime.datetime.fromtimestamp
+    info['created_time'] = fromtimestamp(info['st_ctime'])
+    info['accessed_time'] = fromtimestamp(info['st_atime'])
+    info['modified_time'] = fromtimestamp(info['st_mtime'])
+    return info
+
+
+def compile_wildcard(wildcard):
+    """Returns a function that matches file names to a wildcard."""
+    wildcard_re = re.compile(fnmatch.translate(wildcard))
+
+    def match(name):
+        return bool(wildcard_re.match(name))
+    return match
+
+
+def build_trie(paths):
+    """Returns a trie of the components of a list of paths, as nested
+       dictionaries.
+    """
+    trie = {}
+    for path in paths:
+        components = [c for c in path.split('/') if c]
+        if not components:
+            continue
+        node = trie
+        for component in components:
+            node = node.setdefault(component, {})
+        node[HIDDEN] = True
+    return trie
+
 
 class HideFS(WrapFS):
     """FS wrapper class that hides resources in directory listings.
@@ -18,18 +88,49 @@ class HideFS(WrapFS):
 
     def __init__(self, wrapped_fs, hidden_dirs=None):
         super(HideFS, self).__init__(wrapped_fs)
-        self.__hidden_dirs = hidden_dirs
+        self.__hidden_dirs = list(hidden_dirs or [])
+        self.__hidden_trie = build_trie(self.__hidden_dirs)
 
-    def is_hidden(self, path):
-        """Check whether the given path should be hidden."""
+    @property
+    def hidden_dirs(self):
+        """Returns the hidden paths."""
+        return list(self.__hidden_dirs)
 
-        if path.startswith("/"):
-            path = path[1:]
+    def add_hidden(self, path):
+        """Hides a path and everything under it."""
+        path = relpath(normpath(path))
+        with self._lock:
+            if path not in self.__hidden_dirs:
+                hidden_dirs = self.__hidden_dirs + [path]
+                # readers keep using the old trie until this one is ready
+                self.__hidden_trie = build_trie(hidden_dirs)
+                self.__hidden_dirs = hidden_dirs
 
-        for hidden in self.__hidden_dirs:
-            if path.startswith(hidden):
-                return True
+    def remove_hidden(self, path):
+        """Stops hiding a path."""
+        path = relpath(normpath(path))
+        with self._lock:
+            if path in self.__hidden_dirs:
+                hidden_dirs = [p for p in self.__hidden_dirs if p != path]
+                self.__hidden_trie = build_trie(hidden_dirs)
+                self.__hidden_dirs = hidden_dirs
 
+    def is_hidden(self, path):
+        """Check whether the given path should be hidden.
+
+        A path is hidden when its leading components are those of a hidden
+        path, so the cost depends on the depth of the path and not on the
+        number of hidden paths.
+        """
+        node = self.__hidden_trie
+        for component in path.split('/'):
+            if not component:
+                continue
+            node = node.get(component)
+            if node is None:
+                return False
+            if HIDDEN in node:
+                return True
         return False
 
     def _encode(self, path):
@@ -47,7 +148,8 @@ class HideFS(WrapFS):
                     files_only=files_only)
         entries = self.wrapped_fs.listdir(path, **kwds)
         if not hidden:
-            entries = [e for e in entries if not self.is_hidden(e)]
+            entries = [e for e in entries
+                       if not self.__is_hidden_entry(path, e, full, absolute)]
         return entries
 
     def ilistdir(self, path="/", wildcard=None, full=False, absolute=False,
@@ -58,9 +160,15 @@ class HideFS(WrapFS):
                     dirs_only=dirs_only,
                     files_only=files_only)
         for e in self.wrapped_fs.ilistdir(path, **kwds):
-            if hidden or not self.is_hidden(e):
+            if hidden or not self.__is_hidden_entry(path, e, full, absolute):
                 yield e
 
+    def __is_hidden_entry(self, path, entry, full, absolute):
+        """Check whether an entry listed in a directory should be hidden."""
+        if full or absolute:
+            return self.is_hidden(entry)
+        return self.is_hidden(pathjoin(path, entry))
+
     def walk(self, path="/", wildcard=None, dir_wildcard=None,
              search="breadth", ignore_errors=False):
         if dir_wildcard is not None:
@@ -70,23 +178,11 @@ class HideFS(WrapFS):
             for item in super(HideFS, self).walk(path, wildcard, dir_wildcard,
                                                  search, ignore_errors):
                 yield item
-        #  Otherwise, the wrapped FS may provide a more efficient impl
-        #  which we can use directly.
+        #  Otherwise, walk the wrapped FS without descending into hidden
+        #  directories.
         else:
-            if wildcard is not None and not callable(wildcard):
-                wildcard_re = re.compile(fnmatch.translate(wildcard))
-                wildcard = lambda fn: bool(wildcard_re.match(fn))
-            walk = self.wrapped_fs.walk(self._encode(path), search=search,
-                                        ignore_errors=ignore_errors)
-            for (dirpath, filepaths) in walk:
-                if self.is_hidden(dirpath):
-                    continue
-                filepaths = [basename(self._decode(pathcombine(dirpath, p)))
-                             for p in filepaths]
-                dirpath = abspath(self._decode(dirpath))
-                if wildcard is not None:
-                    filepaths = [p for p in filepaths if wildcard(p)]
-                yield (dirpath, filepaths)
+            for item in self.__walk(path, wildcard, search, ignore_errors):
+                yield item
 
     def walkfiles(self, path="/", wildcard=None, dir_wildcard=None,
                   search="breadth", ignore_errors=False):
@@ -98,23 +194,11 @@ class HideFS(WrapFS):
                                                       dir_wildcard, search,
                                                       ignore_errors):
                 yield item
-        #  Otherwise, the wrapped FS may provide a more efficient impl
-        #  which we can use directly.
         else:
-            if wildcard is not None and not callable(wildcard):
-                wildcard_re = re.compile(fnmatch.translate(wildcard))
-                wildcard = lambda fn: bool(wildcard_re.match(fn))
-            walk = self.wrapped_fs.walkfiles(self._encode(path),
-                                             search=search,
-                                             ignore_errors=ignore_errors)
-            for filepath in walk:
-                filepath = abspath(self._decode(filepath))
-                if wildcard is not None:
-                    if not wildcard(basename(filepath)):
-                        continue
-                if self.is_hidden(filepath):
-                    continue
-                yield filepath
+            for dirpath, filenames in self.__walk(path, wildcard, search,
+                                                  ignore_errors):
+                for filename in filenames:
+                    yield pathcombine(dirpath, filename)
 
     def walkdirs(self, path="/", wildcard=None, search="breadth",
                  ignore_errors=False):
@@ -125,15 +209,68 @@ class HideFS(WrapFS):
             for item in super(HideFS, self).walkdirs(path, wildcard, search,
                                                      ignore_errors):
                 yield item
-        #  Otherwise, the wrapped FS may provide a more efficient impl
-        #  which we can use directly.
         else:
-            walk = self.wrapped_fs.walkdirs(self._encode(path), search=search,
-                                            ignore_errors=ignore_errors)
-            for dirpath in walk:
-                if self.is_hidden(dirpath):
-                    continue
-                yield abspath(self._decode(dirpath))
+            for dirpath, _ in self.__walk(path, None, search, ignore_errors,
+                                          list_files=False):
+                yield dirpath
+
+    def __walk(self, path, wildcard, search, ignore_errors, list_files=True):
+        """Walks the wrapped FS like FS.walk(), but never lists the contents
+           of a hidden directory, so the cost of a walk doesn't depend on
+           what is hidden.
+        """
+        if search not in ("breadth", "depth"):
+            raise ValueError("Search should be 'breadth' or 'depth'")
+        path = abspath(normpath(path))
+        if not self.wrapped_fs.exists(self._encode(path)):
+            raise ResourceNotFoundError(path)
+        if self.is_hidden(path):
+            return
+
+        if wildcard is not None and not callable(wildcard):
+            wildcard = compile_wildcard(wildcard)
+
+        def listdir(dirpath, **kwargs):
+            try:
+                return self.wrapped_fs.listdir(self._encode(dirpath),
+                                               **kwargs)
+            except ResourceNotFoundError:
+                # deleted by another thread or process during the walk
+                return []
+            except FSError:
+                if ignore_errors:
+                    return []
+                raise
+
+        def contents(dirpath):
+            subdirs = [pathcombine(dirpath, self._decode(name))
+                       for name in listdir(dirpath, dirs_only=True)]
+            subdirs = [d for d in subdirs if not self.is_hidden(d)]
+            filenames = []
+            if list_files:
+                filenames = [self._decode(name)
+                             for name in listdir(dirpath, files_only=True)]
+                if wildcard is not None:
+                    filenames = [f for f in filenames if wildcard(f)]
+            return subdirs, filenames
+
+        if search == "breadth":
+            dirs = [path]
+            while dirs:
+                dirpath = dirs.pop()
+                subdirs, filenames = contents(dirpath)
+                dirs.extend(subdirs)
+                yield (dirpath, filenames)
+        else:
+            def recurse(dirpath):
+                subdirs, filenames = contents(dirpath)
+                for subdir in subdirs:
+                    for item in recurse(subdir):
+                        yield item
+                yield (dirpath, filenames)
+
+            for item in recurse(path):
+                yield item
 
     def listdirinfo(self, path="/", wildcard=None, full=False,
                     absolute=False, dirs_only=False, files_only=False):
@@ -159,9 +296,17 @@ class HideFS(WrapFS):
         :raises `fs.errors.ResourceInvalidError`: If the path exists, but
         is not a directory
 
+        When the wrapped FS has system paths, names and info are read in a
+        single pass over the directory instead of one getinfo() per entry.
         """
         path = normpath(path)
 
+        sys_path = self.wrapped_fs.getsyspath(self._encode(path),
+                                              allow_none=True)
+        if sys_path is not None and os.path.isdir(sys_path):
+            return self.__scan_dir_info(path, sys_path, wildcard, full,
+                                        absolute, dirs_only, files_only)
+
         def getinfo(p):
             try:
                 if full or absolute:
@@ -179,6 +324,38 @@ class HideFS(WrapFS):
                                       dirs_only=dirs_only,
                                       files_only=files_only)]
 
+    def __scan_dir_info(self, path, sys_path, wildcard, full, absolute,
+                        dirs_only, files_only):
+        """Lists a directory with its info through the system path."""
+        if dirs_only and files_only:
+            raise ValueError("dirs_only and files_only can not both be True")
+        if wildcard is not None and not callable(wildcard):
+            wildcard = compile_wildcard(wildcard)
+
+        entries = []
+        for name, stats in scan_dir(sys_path):
+            name = self._decode(name)
+            entry_path = pathjoin(path, name)
+            if self.is_hidden(entry_path):
+                continue
+            if wildcard is not None and not wildcard(name):
+                continue
+            if dirs_only or files_only:
+                if stats is None:
+                    continue
+                if dirs_only and not stat.S_ISDIR(stats.st_mode):
+                    continue
+                if files_only and not stat.S_ISREG(stats.st_mode):
+                    continue
+
+            if full:
+                name = pathcombine(path, name)
+            elif absolute:
+                name = pathcombine(abspath(path), name)
+            info = {} if stats is None else stat_info(stats)
+            entries.append((name, info))
+        return entries
+
     def isdirempty(self, path):
         path = normpath(path)
         iter_dir = iter(self.listdir(path, hidden=True))
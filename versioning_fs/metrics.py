@@ -0,0 +1,122 @@
+""" Counters and timings of the work done by a versioning filesystem.
+
+    Measurements are named after the operation and, for the time spent in
+    one step of it, the phase:
+
+      snapshot, snapshot.stage, snapshot.encode, snapshot.delta,
+      snapshot.chunk, snapshot.subprocess, snapshot.parse, snapshot.bytes,
+      snapshot.delta_bytes, snapshot.chunks_written, snapshot.chunks_shared,
+      snapshot.count, snapshot.errors, snapshot.retries, snapshot.unchanged,
+      snapshot.coalesced
+      restore, restore.patch, restore.subprocess, restore.stream,
+      restore.range, restore.cache_hits, restore.cache_misses
+      list_versions, list_versions.subprocess, list_versions.parse
+      list_sizes
+      prune, prune.rewrite, prune.subprocess
+      retention
+      checkpoints
+
+    Timings are in seconds and sizes in bytes.
+"""
+from collections import defaultdict
+import threading
+import time
+
+
+class Metrics(object):
+    """Receives the counters and histograms of a versioning filesystem.
+
+    Subclasses forward them to a monitoring system by overriding increment
+    and observe. This class drops them.
+    """
+    def increment(self, name, value=1):
+        """Adds to a counter."""
+
+    def observe(self, name, value):
+        """Records a value in a histogram."""
+
+    def timer(self, name):
+        """Returns a context manager that records the seconds spent inside
+           it in a histogram.
+        """
+        return _Timer(self, name)
+
+
+class NullMetrics(Metrics):
+    """Metrics that cost as little as possible to record."""
+    def timer(self, name):
+        return _NULL_TIMER
+
+
+class MemoryMetrics(Metrics):
+    """Metrics kept in memory, mostly for tests and benchmarks."""
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(list)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_MemoryMetrics__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self.__lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.__lock:
+            self.histograms[name].append(value)
+
+    def replay(self, metrics):
+        """Records every counter and histogram value into other metrics,
+           such as those of the process that started this one.
+        """
+        with self.__lock:
+            for name, value in self.counters.items():
+                metrics.increment(name, value)
+            for name, values in self.histograms.items():
+                for value in values:
+                    metrics.observe(name, value)
+
+    def summary(self):
+        """Returns the counters, and the count, total, min and max of each
+           histogram.
+        """
+        with self.__lock:
+            summary = dict(self.counters)
+            for name, values in self.histograms.items():
+                summary[name] = {'count': len(values), 'total': sum(values),
+                                 'min': min(values), 'max': max(values)}
+        return summary
+
+
+class _Timer(object):
+    def __init__(self, metrics, name):
+        self.__metrics = metrics
+        self.__name = name
+        self.__start = None
+
+    def __enter__(self):
+        self.__start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.__metrics.observe(self.__name, time.time() - self.__start)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+NULL_METRICS = NullMetrics()  # the default, records nothing
@@ -0,0 +1,103 @@
+""" Moving the versions of a backup tree from one snapshot backend to another.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+from versioning_fs.backends import BACKENDS, DATAFILE, get_backend
+from versioning_fs.catalog import open_catalog
+
+
+STAGING_PREFIX = '.migrate-'
+
+
+def migrate_snap_dir(snap_dir, source, target, tmp_dir):
+    """Copies every version of a snapshot directory, oldest first, from the
+       source backend to the target backend and removes the source copy.
+       Returns the number of versions copied.
+    """
+    backup_dir, name = os.path.split(snap_dir.rstrip(os.sep))
+    staging_dir = os.path.join(backup_dir, STAGING_PREFIX + name)
+    target.remove(staging_dir)
+
+    versions = source.list_versions(snap_dir)
+    try:
+        for version in versions:
+            restore_dir = tempfile.mkdtemp(dir=tmp_dir)
+            try:
+                # restore() expects to create the directory itself
+                os.rmdir(restore_dir)
+                source.restore(snap_dir, version, restore_dir, tmp_dir)
+                data_path = os.path.join(restore_dir, DATAFILE)
+                with open(data_path, 'rb') as data_file:
+                    target.snapshot(data_file, staging_dir, int(version),
+                                    tmp_dir, source_path=data_path)
+            finally:
+                shutil.rmtree(restore_dir, ignore_errors=True)
+    except Exception:
+        target.remove(staging_dir)
+        raise
+
+    # the source copy is only removed once the target copy is complete
+    source.remove(snap_dir)
+    target.move(staging_dir, snap_dir)
+    source_catalog = open_catalog(snap_dir, source)
+    catalog = open_catalog(snap_dir, target)
+    if source_catalog.path != catalog.path:
+        # the backends keep catalogs in different places, move it along
+        catalog.save(source_catalog.load())
+        source_catalog.remove()
+    if catalog.timestamps() != target.list_versions(snap_dir):
+        catalog.rebuild(target)
+    return len(versions)
+
+
+def migrate(backup_dir, source, target, tmp_dir, progress=None):
+    """Migrates every snapshot directory of a backup tree. Returns the
+       number of snapshot directories migrated.
+
+    Parameters
+      progress (callable) (optional): Called as progress(done, total) after
+            each snapshot directory.
+    """
+    snap_dirs = source.list_snap_dirs(backup_dir)
+    for done, snap_dir in enumerate(snap_dirs, 1):
+        migrate_snap_dir(snap_dir, source, target, tmp_dir)
+        if progress is not None:
+            progress(done, len(snap_dirs))
+    return len(snap_dirs)
+
+
+def main(argv=None):
+    """Command line entry point: migrate a backup tree to another
+       backend.
+    """
+    parser = argparse.ArgumentParser(
+        description="Migrate the versions of a backup tree to another "
+                    "snapshot backend.")
+    parser.add_argument('backup_dir')
+    parser.add_argument('--from', dest='source', choices=sorted(BACKENDS),
+                        default='rdiff-backup',
+                        help="the backend the tree was written with, "
+                             "rdiff-backup by default like VersioningFS")
+    parser.add_argument('--to', dest='target', choices=sorted(BACKENDS),
+                        default='packed')
+    parser.add_argument('--tmp-dir', help="scratch space for restores")
+    args = parser.parse_args(argv)
+    if args.source == args.target:
+        parser.error("--from and --to must be different backends")
+
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        count = migrate(args.backup_dir, get_backend(args.source),
+                        get_backend(args.target), tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    sys.stdout.write("migrated %d snapshot directories\n" % count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+""" Index of the user tree that gives every versioned file an identity that
+    does not change when the file, or a directory above it, is renamed.
+"""
+from collections import namedtuple
+from contextlib import closing, contextmanager
+import threading
+import uuid
+
+from fs.path import basename, dirname, iteratepath, normpath, relpath
+
+from versioning_fs.database import connect, create_database
+
+
+INDEX_NAME = '.nodes.sqlite'  # inside the backup directory
+
+ROOT = 0  # the node of the root directory, it has no row
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    file_id TEXT UNIQUE,
+    UNIQUE (parent, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+SUBTREE = """
+WITH RECURSIVE subtree(id) AS (
+    SELECT ?
+    UNION ALL
+    SELECT nodes.id FROM nodes JOIN subtree ON nodes.parent = subtree.id
+)
+SELECT id, parent, name, file_id FROM nodes WHERE id IN subtree
+"""
+
+Node = namedtuple('Node', ['id', 'parent', 'name', 'file_id'])
+
+
+def new_file_id():
+    """Returns a file ID that no path can hash to."""
+    return 'f' + uuid.uuid4().hex
+
+
+class NodeIndex(object):
+    """Maps the paths of versioned files to the file IDs their snapshots are
+       stored under.
+
+    Every directory and file is a node that points to its parent node, so
+    renaming a path, however much is under it, updates a single row. Files
+    have a file ID, directories don't. A path without a node resolves to a
+    default ID, the hash of the path, which is where snapshots were stored
+    before the index existed.
+    """
+    def __init__(self, index_path):
+        """
+        Parameters
+          index_path (str): The SQLite database file of the index.
+        """
+        self.__index_path = index_path
+        self.__lock = threading.Lock()
+        self.__complete = False  # once complete, an index stays complete
+        create_database(index_path, SCHEMA)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_NodeIndex__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    @property
+    def complete(self):
+        """Returns if every versioned file is known to have a node."""
+        if not self.__complete:
+            with self.__connect() as db:
+                row = db.execute("SELECT value FROM meta WHERE key = "
+                                 "'complete'")
+                self.__complete = row.fetchone() is not None
+        return self.__complete
+
+    def mark_complete(self):
+        """Records that every versioned file has a node."""
+        with self.__write() as db:
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('complete', '1')")
+
+    def resolve(self, path, default):
+        """Returns the file ID of a path. A path without one gets the
+           default ID, or None if another path holds it.
+        """
+        with self.__connect() as db:
+            node = self.__find(db, path)
+            if node is not None and node.file_id is not None:
+                return node.file_id
+            if self.__is_assigned(db, default):
+                return None
+            return default
+
+    def list_files(self, path):
+        """Returns a dictionary of the file IDs of the files directly inside
+           a directory, by name. Files without a node are left out.
+        """
+        with self.__connect() as db:
+            node = self.__find(db, path)
+            if node is None:
+                return {}
+            rows = db.execute("SELECT name, file_id FROM nodes WHERE "
+                              "parent = ? AND file_id IS NOT NULL",
+                              (node.id,))
+            return dict((name.decode('utf-8'), file_id)
+                        for name, file_id in rows)
+
+    def assign(self, path, default):
+        """Returns the file ID of a path, giving it one if it has none: the
+           default ID if no other path holds it, or a new one.
+        """
+        return self.assign_many([(path, default)])[0]
+
+    def assign_many(self, paths):
+        """Assigns file IDs, as assign() does, to a list of (path, default ID)
+           pairs in one transaction. Returns their file IDs.
+        """
+        with self.__write() as db:
+            return [self.__assign(db, path, default)
+                    for path, default in paths]
+
+    def __assign(self, db, path, default):
+        """Returns the file ID of a path, giving it one if it has none."""
+        node = self.__find(db, path)
+        if node is not None and node.file_id is not None:
+            return node.file_id
+
+        file_id = default
+        if self.__is_assigned(db, file_id):
+            file_id = new_file_id()
+        if node is None:
+            parent = self.__make_dirs(db, dirname(relpath(path)))
+            db.execute("INSERT INTO nodes (parent, name, file_id) "
+                       "VALUES (?, ?, ?)",
+                       (parent, basename(relpath(path)), file_id))
+        else:
+            db.execute("UPDATE nodes SET file_id = ? WHERE id = ?",
+                       (file_id, node.id))
+        return file_id
+
+    def move(self, src, dst):
+        """Moves a path and everything under it. Returns the nodes that were
+           replaced at the destination, or None if src has no node.
+        """
+        src = relpath(normpath(src))
+        dst = relpath(normpath(dst))
+        if dst == src or dst.startswith(src + '/'):
+            raise ValueError("Can't move a path under itself: %s" % dst)
+
+        with self.__write() as db:
+            node = self.__find(db, src)
+            if node is None or node.id == ROOT:
+                return None
+            replaced = []
+            dst_node = self.__find(db, dst)
+            if dst_node is not None:
+                replaced = self.__delete_subtree(db, dst_node.id)
+            parent = self.__make_dirs(db, dirname(dst))
+            db.execute("UPDATE nodes SET parent = ?, name = ? WHERE id = ?",
+                       (parent, basename(dst), node.id))
+            return replaced
+
+    def remove(self, path):
+        """Removes a path and everything under it. Returns the removed
+           nodes.
+        """
+        with self.__write() as db:
+            node = self.__find(db, path)
+            if node is None:
+                return []
+            if node.id == ROOT:
+                removed = [Node(*row) for row in db.execute(
+                    "SELECT id, parent, name, file_id FROM nodes")]
+                db.execute("DELETE FROM nodes")
+                return removed
+            return self.__delete_subtree(db, node.id)
+
+    def restore(self, nodes):
+        """Puts back nodes returned by move() or remove()."""
+        if not nodes:
+            return
+        with self.__write() as db:
+            db.executemany("INSERT INTO nodes (id, parent, name, file_id) "
+                           "VALUES (?, ?, ?, ?)", nodes)
+
+    @contextmanager
+    def __connect(self):
+        with closing(connect(self.__index_path)) as db:
+            yield db
+
+    @contextmanager
+    def __write(self):
+        """A write transaction, serialized between threads and processes."""
+        with self.__lock:
+            with self.__connect() as db:
+                db.isolation_level = None
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    yield db
+                except Exception:
+                    db.execute("ROLLBACK")
+                    raise
+                db.execute("COMMIT")
+
+    def __find(self, db, path):
+        """Returns the node of a path, or None."""
+        node = Node(ROOT, None, '', None)
+        for name in iteratepath(relpath(normpath(path))):
+            row = db.execute("SELECT id, parent, name, file_id FROM nodes "
+                             "WHERE parent = ? AND name = ?",
+                             (node.id, name)).fetchone()
+            if row is None:
+                return None
+            node = Node(*row)
+        return node
+
+    def __is_assigned(self, db, file_id):
+        row = db.execute("SELECT 1 FROM nodes WHERE file_id = ?", (file_id,))
+        return row.fetchone() is not None
+
+    def __make_dirs(self, db, path):
+        """Returns the node ID of a directory, adding the missing nodes."""
+        node_id = ROOT
+        for name in iteratepath(relpath(normpath(path))):
+            row = db.execute("SELECT id FROM nodes WHERE parent = ? AND "
+                             "name = ?", (node_id, name)).fetchone()
+            if row is None:
+                cursor = db.execute("INSERT INTO nodes (parent, name) VALUES "
+                                    "(?, ?)", (node_id, name))
+                node_id = cursor.lastrowid
+            else:
+                node_id = row[0]
+        return node_id
+
+    def __delete_subtree(self, db, node_id):
+        nodes = [Node(*row) for row in db.execute(SUBTREE, (node_id,))]
+        db.executemany("DELETE FROM nodes WHERE id = ?",
+                       [(node.id,) for node in nodes])
+        return nodes
@@ -0,0 +1,111 @@
+""" Storing the versions of a backup tree again with another codec, in the
+    background while the tree is in use.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+from versioning_fs.backends import BACKENDS, get_backend
+from versioning_fs.catalog import open_catalog
+from versioning_fs.compression import CODECS, get_codec, ZstdCodec
+from versioning_fs import nodes
+from versioning_fs.retention import RateLimiter
+from versioning_fs import version_index
+
+
+def recompress_snap_dir(snap_dir, backend, codec, tmp_dir, versions=None):
+    """Stores the versions of a snapshot directory again with a codec and
+       updates the sizes and codecs its catalog records. Returns the number
+       of versions stored again.
+
+    Parameters
+      versions (VersionIndex) (optional): The version index to record the
+            new sizes in.
+    """
+    recompressed = backend.recompress(snap_dir, codec, tmp_dir)
+    if not recompressed:
+        return 0
+    sizes = backend.list_byte_sizes(snap_dir)
+    catalog = open_catalog(snap_dir, backend)
+    if catalog.exists():
+        catalog.record_sizes(sizes)
+        catalog.record_codecs(backend.list_codecs(snap_dir))
+    if versions is not None:
+        versions.record_sizes(os.path.basename(snap_dir), sizes)
+    return len(recompressed)
+
+
+def recompress(backup_dir, backend, codec, tmp_dir, bytes_per_second=None,
+               progress=None):
+    """Recompresses every snapshot directory of a backup tree. Returns the
+       number of versions stored again.
+
+    Parameters
+      bytes_per_second (float) (optional): The most bytes of snapshot
+            directories recompressed per second, so recompressing doesn't
+            take the disk away from the users.
+      progress (callable) (optional): Called as progress(done, total) after
+            each snapshot directory.
+    """
+    codec = get_codec(codec)
+    limiter = None
+    if bytes_per_second:
+        limiter = RateLimiter(bytes_per_second)
+    versions = None
+    index_path = os.path.join(backup_dir, version_index.INDEX_NAME)
+    if os.path.exists(index_path):
+        versions = version_index.VersionIndex(
+            index_path, os.path.join(backup_dir, nodes.INDEX_NAME))
+
+    count = 0
+    snap_dirs = backend.list_snap_dirs(backup_dir)
+    for done, snap_dir in enumerate(snap_dirs, 1):
+        recompressed = recompress_snap_dir(snap_dir, backend, codec,
+                                           tmp_dir, versions)
+        if recompressed and limiter is not None:
+            limiter.wait(sum(size for _, size in
+                             backend.list_byte_sizes(snap_dir)))
+        count += recompressed
+        if progress is not None:
+            progress(done, len(snap_dirs))
+    return count
+
+
+def main(argv=None):
+    """Command line entry point: recompress the versions of a backup
+       tree.
+    """
+    parser = argparse.ArgumentParser(
+        description="Store the versions of a backup tree again with another "
+                    "codec.")
+    parser.add_argument('backup_dir')
+    parser.add_argument('--backend', choices=sorted(
+        name for name, backend in BACKENDS.items() if backend.compressible),
+        default='native')
+    parser.add_argument('--codec',
+                        default='zstd' if ZstdCodec.available else 'zlib',
+                        help="one of %s, optionally with a level such as "
+                             "zstd:9" % ', '.join(sorted(CODECS)))
+    parser.add_argument('--bytes-per-second', type=float,
+                        help="throttle the bytes recompressed")
+    parser.add_argument('--tmp-dir', help="scratch space for rewrites")
+    args = parser.parse_args(argv)
+    try:
+        codec = get_codec(args.codec)
+    except ValueError as error:
+        parser.error(str(error))
+
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        count = recompress(args.backup_dir, get_backend(args.backend), codec,
+                           tmp_dir, bytes_per_second=args.bytes_per_second)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    sys.stdout.write("recompressed %d versions\n" % count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
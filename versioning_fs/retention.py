@@ -0,0 +1,221 @@
+""" Retention policies, and applying them to every file of a tree.
+"""
+import Queue
+import threading
+import time
+
+from fs.path import isprefix
+
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+class RetentionPolicy(object):
+    """Decides which versions of a file to keep.
+
+    Each tier is a (period, span) pair: among the versions younger than
+    span seconds, the newest version of every period of time is kept, so
+    [(HOUR, DAY), (DAY, 30 * DAY)] keeps hourly versions for a day and daily
+    versions for a month. Versions older than every tier are removed. The
+    versions kept are then limited to the newest max_versions, and to the
+    newest that take up no more than max_bytes in the backup store. The most
+    recent version is always kept.
+    """
+    def __init__(self, tiers=None, max_versions=None, max_bytes=None):
+        """
+        Parameters
+          tiers (list) (optional): (period, span) pairs, in seconds. Without
+                tiers every version is kept, up to the other limits.
+          max_versions (int) (optional): The most versions kept per file.
+          max_bytes (int) (optional): The most bytes stored per file.
+        """
+        self.tiers = list(tiers or [])
+        self.max_versions = max_versions
+        self.max_bytes = max_bytes
+
+    def select(self, versions, now):
+        """Returns the timestamps of the versions to remove, oldest first.
+
+        Parameters
+          versions (list): (timestamp, bytes stored) of every version of a
+                file, oldest first.
+          now (int): The time the ages of the versions are measured from.
+        """
+        if not versions:
+            return []
+        timestamps = [int(timestamp) for timestamp, _ in versions]
+
+        keep = set(timestamps)
+        if self.tiers:
+            keep = set()
+            for period, span in self.tiers:
+                periods = set()
+                for timestamp in reversed(timestamps):
+                    if now - timestamp >= span:
+                        break
+                    if timestamp // period not in periods:
+                        periods.add(timestamp // period)
+                        keep.add(timestamp)
+        keep.add(timestamps[-1])
+        kept = [timestamp for timestamp in timestamps if timestamp in keep]
+
+        if self.max_versions is not None:
+            kept = kept[-max(1, self.max_versions):]
+        if self.max_bytes is not None:
+            stored = dict((int(timestamp), size or 0)
+                          for timestamp, size in versions)
+            total = 0
+            within = []
+            for timestamp in reversed(kept):
+                total += stored[timestamp]
+                if within and total > self.max_bytes:
+                    break
+                within.append(timestamp)
+            kept = within
+
+        kept = set(kept)
+        return [timestamp for timestamp in timestamps if timestamp not in kept]
+
+
+class RateLimiter(object):
+    """Spaces out work, across threads, to a number of units per second."""
+    def __init__(self, rate):
+        """
+        Parameters
+          rate (float): The units of work allowed per second.
+        """
+        self.__interval = 1.0 / rate
+        self.__lock = threading.Lock()
+        self.__next = time.time()
+
+    def wait(self, amount=1):
+        """Blocks until `amount` units of work can be done."""
+        with self.__lock:
+            now = time.time()
+            start = max(now, self.__next)
+            self.__next = start + amount * self.__interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class RetentionReport(object):
+    """What applying a retention policy did, or would do in a dry run."""
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.files = 0  # files examined
+        self.files_pruned = 0
+        self.versions_removed = 0
+        self.bytes_reclaimed = 0  # estimated from the index in a dry run
+        self.errors = {}  # path: error
+
+    def __repr__(self):
+        return ("<RetentionReport files=%d files_pruned=%d "
+                "versions_removed=%d bytes_reclaimed=%d errors=%d%s>" %
+                (self.files, self.files_pruned, self.versions_removed,
+                 self.bytes_reclaimed, len(self.errors),
+                 " dry_run" if self.dry_run else ""))
+
+
+def oldest_only(timestamps, versions):
+    """Returns the part of the timestamps to remove that is made of the
+       oldest versions, for backends without selective_prune.
+    """
+    removable = []
+    remove = set(timestamps)
+    for timestamp, _ in versions:
+        if int(timestamp) not in remove:
+            break
+        removable.append(int(timestamp))
+    return removable
+
+
+def apply_policy(fs, policy, files, workers=1, dry_run=False,
+                 files_per_second=None, bytes_per_second=None, now=None,
+                 path='/'):
+    """Applies a retention policy to files on a pool of worker threads.
+       Returns a RetentionReport. A file that fails is recorded in the
+       report and doesn't stop the others.
+
+    Parameters
+      fs (VersioningFS): The filesystem the files belong to.
+      policy (RetentionPolicy): The versions to keep.
+      files (iterable): (path, [(timestamp, bytes stored), ...]) for every
+            file, with its versions oldest first.
+      workers (int): The number of files pruned at the same time.
+      dry_run (bool): Only report what would be removed.
+      files_per_second (float) (optional): The most files pruned per
+            second.
+      bytes_per_second (float) (optional): The most bytes of versions
+            pruned per second, counting every version of a pruned file.
+      now (int) (optional): The time ages are measured from, the current
+            time by default.
+      path (str): Only files under this path are pruned.
+    """
+    if now is None:
+        now = int(time.time())
+    limiters = []
+    if files_per_second:
+        limiters.append((RateLimiter(files_per_second), lambda v: 1))
+    if bytes_per_second:
+        limiters.append((RateLimiter(bytes_per_second),
+                         lambda v: sum(stored or 0 for _, stored in v)))
+
+    report = RetentionReport(dry_run)
+    workers = max(1, workers)
+    # the files are read in this thread, as the index they come from may
+    # not be shared between threads
+    pending = Queue.Queue(maxsize=workers * 4)
+    lock = threading.Lock()
+
+    def prune(file_path, versions):
+        remove = policy.select(versions, now)
+        if not fs.backend.selective_prune:
+            remove = oldest_only(remove, versions)
+        if not remove:
+            return 0, 0
+
+        stored = dict((int(timestamp), size or 0)
+                      for timestamp, size in versions)
+        if dry_run:
+            return len(remove), sum(stored[t] for t in remove)
+        for limiter, amount in limiters:
+            limiter.wait(amount(versions))
+        fs.remove_versions(file_path, remove)
+        after = sum(size.size for size in
+                    fs.list_byte_sizes(file_path).values())
+        return len(remove), sum(stored.values()) - after
+
+    def work():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            file_path, versions = item
+            try:
+                removed, reclaimed = prune(file_path, versions)
+            except Exception as error:
+                with lock:
+                    report.files += 1
+                    report.errors[file_path] = error
+                continue
+            with lock:
+                report.files += 1
+                if removed:
+                    report.files_pruned += 1
+                    report.versions_removed += removed
+                    report.bytes_reclaimed += reclaimed
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for file_path, versions in files:
+            if isprefix(path, file_path):
+                pending.put((file_path, versions))
+    finally:
+        for thread in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+    return report
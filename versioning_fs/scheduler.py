@@ -0,0 +1,310 @@
+""" Background snapshots: a bounded queue of paths drained by a worker pool.
+"""
+import heapq
+import itertools
+import multiprocessing
+import threading
+import time
+
+from versioning_fs.errors import QueueFullError, SnapshotError
+from versioning_fs.metrics import NULL_METRICS
+
+
+THREAD_POOL = 'thread'
+PROCESS_POOL = 'process'
+
+_process_context = None  # the context of a process pool worker
+
+
+def _init_process_worker(context):
+    """Remembers the context inside a process pool worker."""
+    global _process_context
+    _process_context = context
+
+
+def _run_in_process(function, args):
+    """Calls a function with the context inside a process pool worker.
+       Returns (failure, result); errors are returned as strings, since they
+       can't always be pickled.
+    """
+    try:
+        return None, function(_process_context, *args)
+    except SnapshotError as error:
+        return (SnapshotError, error.message), None
+    except Exception as error:
+        return (Exception, "%s: %s" % (type(error).__name__, error)), None
+
+
+class SnapshotQueue(object):
+    """Takes snapshots in the background.
+
+    Queued paths are drained by a pool of worker threads, which call the
+    snapshot callable. With a process pool, the callable can hand the work
+    that needs no state of the caller over to a worker process with run(),
+    so everything else, such as caches and counters, stays in one process.
+
+    Paths are keyed so that repeated puts of the same file coalesce: a put
+    for a key that is still waiting only updates the path and the keyword
+    arguments, and the single snapshot that follows captures the latest
+    content. A key is never
+    snapshotted by two workers at once, snapshots of the same key are kept
+    at least min_interval seconds apart, and failed snapshots are scheduled
+    again rather than slept on. Putting a path while max_size keys are
+    waiting blocks the caller until there is room again.
+    """
+    def __init__(self, snapshot, workers=2, max_size=1000, pool=THREAD_POOL,
+                 put_timeout=None, retries=3, retry_delay=1, window=0,
+                 min_interval=0, key=None, metrics=NULL_METRICS,
+                 context=None):
+        """
+        Parameters
+          snapshot (callable): Takes a snapshot of a single path, called
+                with the keyword arguments of the latest put of the path.
+          workers (int): The number of snapshots taken at the same time.
+          max_size (int): The number of paths waiting for a snapshot before
+                putting a path blocks.
+          pool (str): Either 'thread' or 'process'.
+          put_timeout (float) (optional): Seconds to wait for room on a full
+                queue before raising QueueFullError. Waits forever if None.
+          retries (int): How many times a failing snapshot is tried.
+          retry_delay (float): Seconds between tries of the same snapshot.
+          window (float): Seconds to wait after the first put of a key, so
+                that puts within the window coalesce into one snapshot.
+          min_interval (float): Minimum seconds between two snapshots of the
+                same key.
+          key (callable) (optional): Maps a path to the key used to coalesce
+                snapshots. Defaults to the path itself.
+          metrics (Metrics): Counts retried and coalesced snapshots.
+          context (object) (optional): Passed first to the functions given
+                to run(). A process pool forks it into each worker process
+                when the pool starts.
+        """
+        if pool not in (THREAD_POOL, PROCESS_POOL):
+            raise ValueError("Unknown pool: %s" % pool)
+
+        self.__snapshot = snapshot
+        self.__max_size = max_size
+        self.__put_timeout = put_timeout
+        self.__retries = retries
+        self.__retry_delay = retry_delay
+        self.__window = window
+        self.__min_interval = min_interval
+        self.__key = key or (lambda path: path)
+        self.__metrics = metrics
+        self.__context = context
+
+        self.__condition = threading.Condition()
+        self.__entries = {}  # key -> _Entry waiting for a snapshot
+        self.__due = []  # heap of (due time, sequence, key)
+        self.__sequence = itertools.count()
+        self.__deferred = set()  # keys that came due while in flight
+        self.__in_flight = set()
+        self.__last_done = {}  # key -> time its last snapshot finished
+        self.__errors = []
+        self.__coalesced = 0
+        self.__closed = False
+
+        self.__process_pool = None
+        if pool == PROCESS_POOL:
+            self.__process_pool = multiprocessing.Pool(
+                workers, initializer=_init_process_worker,
+                initargs=(context,))
+
+        self.__workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self.__work)
+            worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+
+    @property
+    def pending(self):
+        """Returns the number of snapshots that have not finished yet."""
+        with self.__condition:
+            return len(self.__entries) + len(self.__in_flight)
+
+    @property
+    def uses_processes(self):
+        """Returns if run() calls functions in worker processes."""
+        return self.__process_pool is not None
+
+    @property
+    def coalesced(self):
+        """Returns the number of puts merged into an already queued one."""
+        return self.__coalesced
+
+    def is_pending(self, path):
+        """Returns if a snapshot of a path is waiting or being taken."""
+        key = self.__key(path)
+        with self.__condition:
+            return key in self.__entries or key in self.__in_flight
+
+    def put(self, path, not_before=None, **kwargs):
+        """Queues a path to be snapshotted. The keyword arguments are passed
+           to the snapshot callable. With not_before, a time, the snapshot is
+           not taken before then, such as for a path snapshotted elsewhere.
+        """
+        key = self.__key(path)
+        deadline = None
+        if self.__put_timeout is not None:
+            deadline = time.time() + self.__put_timeout
+
+        with self.__condition:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                entry.path = path
+                entry.kwargs = kwargs
+                self.__coalesced += 1
+                self.__metrics.increment('snapshot.coalesced')
+                return
+
+            while len(self.__entries) >= self.__max_size:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise QueueFullError("Snapshot queue is full: %s" %
+                                             path)
+                self.__condition.wait(remaining)
+
+            due = max(time.time() + self.__window, not_before or 0)
+            if key in self.__last_done:
+                due = max(due, self.__last_done[key] + self.__min_interval)
+            self.__entries[key] = _Entry(path, kwargs)
+            self.__schedule(key, due)
+
+    def run(self, function, *args):
+        """Calls function(context, *args) and returns its result. With a
+           process pool it is called in a worker process, so the function
+           and the arguments must be picklable.
+        """
+        if self.__process_pool is None:
+            return function(self.__context, *args)
+        failure, result = self.__process_pool.apply(_run_in_process,
+                                                    (function, args))
+        if failure is not None:
+            error_class, message = failure
+            raise error_class(message)
+        return result
+
+    def wait(self, timeout=None):
+        """Blocks until every queued snapshot has finished. Returns a list of
+           (path, error) tuples for the snapshots that failed since the last
+           wait.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.__condition:
+            while self.__entries or self.__in_flight:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                self.__condition.wait(remaining)
+            errors, self.__errors = self.__errors, []
+        return errors
+
+    def close(self):
+        """Waits for the queued snapshots and stops the workers."""
+        self.wait()
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        for worker in self.__workers:
+            worker.join()
+        if self.__process_pool is not None:
+            self.__process_pool.close()
+            self.__process_pool.join()
+
+    def __schedule(self, key, due):
+        entry = self.__entries[key]
+        entry.due = due
+        heapq.heappush(self.__due, (due, next(self.__sequence), key))
+        self.__condition.notify_all()
+
+    def __next_entry(self):
+        """Waits for an entry to come due. Returns (key, entry), or None
+           once the queue is closed.
+        """
+        while True:
+            if self.__closed:
+                return None
+            if not self.__due:
+                self.__condition.wait()
+                continue
+
+            due, _, key = self.__due[0]
+            now = time.time()
+            if due > now:
+                self.__condition.wait(due - now)
+                continue
+
+            heapq.heappop(self.__due)
+            entry = self.__entries.get(key)
+            if entry is None or entry.due != due:
+                continue  # rescheduled since
+            if key in self.__in_flight:
+                # scheduled again when the running snapshot finishes
+                self.__deferred.add(key)
+                continue
+
+            del self.__entries[key]
+            self.__in_flight.add(key)
+            self.__condition.notify_all()
+            return key, entry
+
+    def __work(self):
+        while True:
+            with self.__condition:
+                item = self.__next_entry()
+            if item is None:
+                break
+
+            key, entry = item
+            error = None
+            try:
+                self.__snapshot(entry.path, **entry.kwargs)
+            except Exception as e:
+                error = e
+
+            with self.__condition:
+                self.__finish(key, entry, error)
+
+    def __finish(self, key, entry, error):
+        now = time.time()
+        self.__in_flight.discard(key)
+        self.__last_done[key] = now
+        if len(self.__last_done) > self.__max_size:
+            oldest = now - self.__min_interval
+            self.__last_done = dict((k, t) for k, t in
+                                    self.__last_done.iteritems()
+                                    if t > oldest)
+
+        if isinstance(error, SnapshotError) and \
+                entry.attempt + 1 < self.__retries and \
+                key not in self.__entries:
+            # rdiff-backup must wait 1 second between the same file.
+            entry.attempt += 1
+            self.__entries[key] = entry
+            self.__metrics.increment('snapshot.retries')
+            self.__schedule(key, now + self.__retry_delay)
+        elif error is not None:
+            self.__errors.append((entry.path, error))
+
+        if key in self.__deferred:
+            self.__deferred.discard(key)
+            if key in self.__entries:
+                due = max(self.__entries[key].due,
+                          now + self.__min_interval)
+                self.__schedule(key, due)
+
+        self.__condition.notify_all()
+
+
+class _Entry(object):
+    """A path waiting for a snapshot."""
+    def __init__(self, path, kwargs):
+        self.path = path
+        self.kwargs = kwargs
+        self.due = None
+        self.attempt = 0
@@ -0,0 +1,94 @@
+""" Getting the content of a file into place for a snapshot with as little
+    copying as possible.
+"""
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY = 'copy'
+
+FICLONE = 0x40049409  # ioctl that shares the extents of two files
+BUFFER_SIZE = 1024 * 1024  # bytes per read when the data has to be copied
+
+
+def copy_file_object(src, dst):
+    """Copies one file object into another using large buffers."""
+    shutil.copyfileobj(src, dst, BUFFER_SIZE)
+    return COPY
+
+
+def reflink(src, dst):
+    """Makes an open file share the data of another open file without
+       copying it. Returns False if the filesystem can't do that.
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def stage_file(src_path, dst_path, allow_hardlink=True):
+    """Puts the content of a file at a new path and returns the strategy
+       that was used.
+
+    A hard link is tried first, which only works on the same device and
+    makes the new path change along with the original, so it is only
+    allowed for short lived copies. Otherwise the data is reflinked or, at
+    last, copied with large buffers.
+    """
+    if allow_hardlink:
+        try:
+            os.link(src_path, dst_path)
+            return HARDLINK
+        except OSError:
+            pass
+
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        if reflink(src, dst):
+            return REFLINK
+        return copy_file_object(src, dst)
+
+
+class HashingReader(object):
+    """Reads a file object and keeps a digest of the bytes read, so the
+       content a backend stages is known exactly. Reading it again from the
+       start starts the digest over; any other seek leaves it unknown.
+    """
+    def __init__(self, file_object, hasher):
+        self.__file_object = file_object
+        self.__hasher = hasher
+        self.__digest = hasher()
+
+    def read(self, *args):
+        data = self.__file_object.read(*args)
+        if self.__digest is not None:
+            self.__digest.update(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.__file_object.seek(offset, whence)
+        if offset == 0 and whence == os.SEEK_SET:
+            self.__digest = self.__hasher()
+        else:
+            self.__digest = None
+
+    def tell(self):
+        return self.__file_object.tell()
+
+    def hexdigest(self):
+        """Returns the hex digest of the bytes read, or None if they were
+           not read in order.
+        """
+        if self.__digest is None:
+            return None
+        return self.__digest.hexdigest()
@@ -0,0 +1,204 @@
+""" Applying many independent filesystem operations on a pool of worker
+    threads, all or nothing.
+"""
+import os
+import random
+import threading
+
+from versioning_fs.catalog import open_catalog
+
+
+class Transaction(object):
+    """A batch of operations that either all take effect or none do.
+
+    Each operation is an object with apply(), revert() and commit()
+    methods. apply() runs the operations on a pool of worker threads; when
+    one fails, the operations that have not started are skipped, the
+    applied ones are reverted and the first error is raised. Once every
+    operation is applied, more work can still be done before either
+    commit() makes the operations final or rollback() reverts them.
+    """
+    def __init__(self, workers=1, progress=None):
+        """
+        Parameters
+          workers (int): The number of operations run at the same time.
+          progress (callable) (optional): Called as progress(done, total)
+                after each operation is applied.
+        """
+        self.__workers = max(1, workers)
+        self.__progress = progress
+        self.__operations = []
+        self.__applied = []
+
+    def __len__(self):
+        return len(self.__operations)
+
+    def add(self, operation):
+        """Adds an operation to the transaction."""
+        self.__operations.append(operation)
+
+    def apply(self):
+        """Applies every operation, or none of them."""
+        self.__applied = []
+        errors = []
+        self.__run(lambda operation: operation.apply(), self.__operations,
+                   errors, self.__applied)
+        if errors:
+            self.rollback()
+            raise errors[0]
+
+    def rollback(self):
+        """Reverts the applied operations. Raises the first error once
+           every operation has been tried.
+        """
+        applied, self.__applied = self.__applied, []
+        errors = []
+        self.__run(lambda operation: operation.revert(), applied, errors,
+                   stop_on_error=False)
+        if errors:
+            raise errors[0]
+
+    def commit(self):
+        """Makes the applied operations final."""
+        applied, self.__applied = self.__applied, []
+        errors = []
+        self.__run(lambda operation: operation.commit(), applied, errors,
+                   stop_on_error=False)
+        if errors:
+            raise errors[0]
+
+    def __run(self, run, operations, errors, done=None, stop_on_error=True):
+        """Runs a method of each operation on the worker threads."""
+        total = len(operations)
+        remaining = iter(operations)
+        lock = threading.Lock()
+        state = {'done': 0}
+
+        def work():
+            while True:
+                with lock:
+                    if errors and stop_on_error:
+                        return
+                    operation = next(remaining, None)
+                if operation is None:
+                    return
+                try:
+                    run(operation)
+                except Exception as error:
+                    with lock:
+                        errors.append(error)
+                    continue
+
+                with lock:
+                    if done is not None:
+                        done.append(operation)
+                        state['done'] += 1
+                        if self.__progress is not None:
+                            self.__progress(state['done'], total)
+
+        workers = min(self.__workers, total)
+        if workers <= 1:
+            work()
+            return
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def move_snapshot_dir(backend, src_dir, dst_dir):
+    """Moves the versions of a snapshot directory and its catalog."""
+    backend.move(src_dir, dst_dir)
+    open_catalog(src_dir, backend).move(dst_dir)
+
+
+def new_trash_path(backup_dir):
+    """Returns a new snapshot directory for removed versions that are
+       waiting to be deleted.
+    """
+    return os.path.join(backup_dir,
+                        '.trash-%020x' % random.randrange(16**30))
+
+
+def empty_trash_path(backend, trash_path):
+    """Deletes removed versions and their catalog."""
+    try:
+        backend.remove(trash_path)
+        open_catalog(trash_path, backend).remove()
+    except OSError:
+        pass  # the operation is done, leftovers are only wasted space
+
+
+class DeleteSnapshot(object):
+    """Deletes the versions of a snapshot directory and its catalog. They
+       are moved into the trash until the deletion is committed, when they
+       are also removed from the version index, if one is given.
+    """
+    def __init__(self, backend, snap_dir, backup_dir, versions=None):
+        self.__backend = backend
+        self.__snap_dir = snap_dir
+        self.__trash_path = new_trash_path(backup_dir)
+        self.__versions = versions
+
+    def apply(self):
+        move_snapshot_dir(self.__backend, self.__snap_dir, self.__trash_path)
+
+    def revert(self):
+        move_snapshot_dir(self.__backend, self.__trash_path, self.__snap_dir)
+
+    def commit(self):
+        empty_trash_path(self.__backend, self.__trash_path)
+        if self.__versions is not None:
+            self.__versions.remove(os.path.basename(self.__snap_dir))
+
+
+class MoveNode(object):
+    """Moves a path and everything under it in the node index, which moves
+       the snapshots of its files along. The snapshots of the files it
+       replaces are deleted when the move is committed, and removed from the
+       version index, if one is given.
+    """
+    def __init__(self, nodes, backend, src, dst, backup_dir, versions=None):
+        self.__nodes = nodes
+        self.__backend = backend
+        self.__src = src
+        self.__dst = dst
+        self.__backup_dir = backup_dir
+        self.__versions = versions
+        self.__replaced = None
+
+    def apply(self):
+        self.__replaced = self.__nodes.move(self.__src, self.__dst)
+
+    def revert(self):
+        if self.__replaced is not None:
+            self.__nodes.move(self.__dst, self.__src)
+            self.__nodes.restore(self.__replaced)
+            self.__replaced = None
+
+    def commit(self):
+        for node in self.__replaced or []:
+            if node.file_id is not None:
+                snap_dir = os.path.join(self.__backup_dir, node.file_id)
+                empty_trash_path(self.__backend, snap_dir)
+                if self.__versions is not None:
+                    self.__versions.remove(node.file_id)
+
+
+class RemoveNode(object):
+    """Removes a path and everything under it from the node index."""
+    def __init__(self, nodes, path):
+        self.__nodes = nodes
+        self.__path = path
+        self.__removed = []
+
+    def apply(self):
+        self.__removed = self.__nodes.remove(self.__path)
+
+    def revert(self):
+        self.__nodes.restore(self.__removed)
+        self.__removed = []
+
+    def commit(self):
+        pass
@@ -0,0 +1,256 @@
+""" Index of the versions of every file, for queries across the whole tree.
+"""
+from collections import namedtuple
+from contextlib import closing, contextmanager
+import sqlite3
+
+from versioning_fs.database import connect, create_database
+
+
+INDEX_NAME = '.versions.sqlite'  # inside the backup directory
+QUERY_BATCH = 500  # file IDs per query, below SQLite's limit of parameters
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    file_id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    size INTEGER,
+    stored INTEGER,
+    PRIMARY KEY (file_id, timestamp)
+);
+CREATE INDEX IF NOT EXISTS versions_timestamp ON versions (timestamp);
+"""
+
+# the path of each file in `files`, built up from the node index; the rows
+# with parent 0 hold complete paths
+PATHS = """
+up(file_id, parent, path) AS (
+    SELECT nodes.file_id, nodes.parent, nodes.name
+    FROM tree.nodes AS nodes
+    WHERE nodes.file_id IN (SELECT file_id FROM files)
+    UNION ALL
+    SELECT up.file_id, nodes.parent, nodes.name || '/' || up.path
+    FROM up JOIN tree.nodes AS nodes ON nodes.id = up.parent
+)
+"""
+
+VersionRecord = namedtuple('VersionRecord',
+                           ['path', 'version', 'timestamp', 'size', 'stored'])
+
+
+class VersionIndex(object):
+    """Records the timestamp, the size and the bytes stored of every
+       version of every file.
+
+    Versions are recorded by file ID, which doesn't change when a file is
+    renamed, and are matched to paths through the node index. Files that
+    have no node, because they were snapshotted before the node index
+    existed and were never renamed since, are left out of query results.
+    """
+    def __init__(self, index_path, node_index_path):
+        """
+        Parameters
+          index_path (str): The SQLite database file of the index.
+          node_index_path (str): The database file of the node index.
+        """
+        self.__index_path = index_path
+        self.__node_index_path = node_index_path
+        create_database(index_path, SCHEMA)
+        with self.__write() as db:
+            columns = [row[1] for row in
+                       db.execute("PRAGMA table_info(versions)")]
+            if 'stored' not in columns:
+                try:
+                    db.execute("ALTER TABLE versions ADD COLUMN stored "
+                               "INTEGER")
+                except sqlite3.OperationalError:
+                    pass  # added by another process meanwhile
+
+    def add(self, file_id, timestamp, size=None):
+        """Records a version."""
+        with self.__write() as db:
+            db.execute("INSERT OR REPLACE INTO versions (file_id, timestamp, "
+                       "size) VALUES (?, ?, ?)",
+                       (file_id, int(timestamp), size))
+
+    def record_sizes(self, file_id, sizes):
+        """Records the bytes stored for versions of a file, given as
+           (timestamp, bytes) pairs.
+        """
+        with self.__write() as db:
+            db.executemany("UPDATE versions SET stored = ? WHERE file_id = ? "
+                           "AND timestamp = ?",
+                           [(stored, file_id, int(timestamp))
+                            for timestamp, stored in sizes])
+
+    def add_many(self, versions):
+        """Records versions, and the bytes stored for versions of their
+           files, in one transaction. The versions are given as (file ID,
+           timestamp, size, sizes) tuples, sizes being (timestamp, bytes)
+           pairs as for record_sizes().
+        """
+        with self.__write() as db:
+            for file_id, timestamp, size, sizes in versions:
+                db.execute("INSERT OR REPLACE INTO versions (file_id, "
+                           "timestamp, size) VALUES (?, ?, ?)",
+                           (file_id, int(timestamp), size))
+                db.executemany("UPDATE versions SET stored = ? WHERE "
+                               "file_id = ? AND timestamp = ?",
+                               [(stored, file_id, int(stamp))
+                                for stamp, stored in sizes])
+
+    def replace(self, file_id, versions):
+        """Replaces the versions of a file with (timestamp, size, stored)
+           tuples.
+        """
+        with self.__write() as db:
+            db.execute("DELETE FROM versions WHERE file_id = ?", (file_id,))
+            db.executemany("INSERT INTO versions VALUES (?, ?, ?, ?)",
+                           [(file_id, int(timestamp), size, stored)
+                            for timestamp, size, stored in versions])
+
+    def remove(self, file_id):
+        """Forgets every version of a file."""
+        with self.__write() as db:
+            db.execute("DELETE FROM versions WHERE file_id = ?", (file_id,))
+
+    def remove_before(self, file_id, timestamp):
+        """Forgets the versions of a file older than a timestamp. The most
+           recent version is always kept.
+        """
+        with self.__write() as db:
+            db.execute("DELETE FROM versions WHERE file_id = ? AND "
+                       "timestamp < ? AND timestamp < (SELECT MAX(timestamp) "
+                       "FROM versions WHERE file_id = ?)",
+                       (file_id, int(timestamp), file_id))
+
+    def remove_versions(self, file_id, timestamps):
+        """Forgets the versions of a file with the given timestamps. The most
+           recent version is always kept.
+        """
+        with self.__write() as db:
+            db.executemany("DELETE FROM versions WHERE file_id = ? AND "
+                           "timestamp = ? AND timestamp < (SELECT "
+                           "MAX(timestamp) FROM versions WHERE file_id = ?)",
+                           [(file_id, int(timestamp), file_id)
+                            for timestamp in timestamps])
+
+    def count_versions(self, file_ids):
+        """Returns a dictionary of the number of versions of each of a list
+           of files, by file ID. Files without versions are left out.
+        """
+        file_ids = list(file_ids)
+        counts = {}
+        with self.__connect() as db:
+            for start in range(0, len(file_ids), QUERY_BATCH):
+                batch = file_ids[start:start + QUERY_BATCH]
+                counts.update(db.execute(
+                    "SELECT file_id, COUNT(*) FROM versions WHERE file_id "
+                    "IN (%s) GROUP BY file_id" % ', '.join('?' * len(batch)),
+                    batch))
+        return counts
+
+    def iter_files(self):
+        """Yields (path, [(timestamp, bytes stored), ...]) for every file,
+           with its versions oldest first.
+        """
+        query = ("WITH RECURSIVE files(file_id) AS ("
+                 "SELECT DISTINCT file_id FROM versions), " +
+                 PATHS +
+                 "SELECT '/' || up.path, versions.timestamp, versions.stored "
+                 "FROM up JOIN versions USING (file_id) WHERE up.parent = 0 "
+                 "ORDER BY up.path, versions.timestamp")
+        with self.__connect() as db:
+            path = None
+            versions = []
+            for row_path, timestamp, stored in db.execute(query):
+                if row_path != path:
+                    if versions:
+                        yield path, versions
+                    path = row_path
+                    versions = []
+                versions.append((timestamp, stored))
+            if versions:
+                yield path, versions
+
+    def iter_paths(self):
+        """Yields (file ID, path) for every file with versions."""
+        query = ("WITH RECURSIVE files(file_id) AS ("
+                 "SELECT DISTINCT file_id FROM versions), " +
+                 PATHS +
+                 "SELECT file_id, '/' || path FROM up WHERE parent = 0")
+        with self.__connect() as db:
+            for row in db.execute(query):
+                yield row
+
+    def changed_since(self, timestamp):
+        """Returns (path, timestamp) of the files with a version taken at or
+           after a timestamp, with the timestamp of their latest version,
+           oldest first.
+        """
+        query = ("WITH RECURSIVE files(file_id, latest) AS ("
+                 "SELECT file_id, MAX(timestamp) FROM versions "
+                 "WHERE timestamp >= ? GROUP BY file_id), " +
+                 PATHS +
+                 "SELECT '/' || up.path, files.latest FROM up "
+                 "JOIN files USING (file_id) WHERE up.parent = 0 "
+                 "ORDER BY files.latest, up.path")
+        with self.__connect() as db:
+            return db.execute(query, (int(timestamp),)).fetchall()
+
+    def top_by_size(self, count=10):
+        """Returns (path, bytes) of the files whose versions take up the
+           most bytes in the store, largest first.
+        """
+        query = ("WITH RECURSIVE files(file_id, total) AS ("
+                 "SELECT versions.file_id, SUM(versions.stored) "
+                 "FROM versions "
+                 "JOIN tree.nodes AS nodes USING (file_id) "
+                 "GROUP BY versions.file_id ORDER BY 2 DESC LIMIT ?), " +
+                 PATHS +
+                 "SELECT '/' || up.path, files.total FROM up "
+                 "JOIN files USING (file_id) WHERE up.parent = 0 "
+                 "ORDER BY files.total DESC, up.path")
+        with self.__connect() as db:
+            return db.execute(query, (count,)).fetchall()
+
+    def iter_versions(self, since=None, until=None):
+        """Yields a VersionRecord for every version taken between two
+           timestamps, both included, oldest first.
+        """
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(int(since))
+        if until is not None:
+            conditions.append("timestamp <= ?")
+            params.append(int(until))
+        where = ''
+        if conditions:
+            where = "WHERE " + " AND ".join(conditions)
+
+        query = ("WITH RECURSIVE files(file_id, timestamp, size, stored) AS ("
+                 "SELECT file_id, timestamp, size, stored FROM versions " +
+                 where +
+                 "), " + PATHS +
+                 "SELECT '/' || up.path, (SELECT COUNT(*) FROM versions "
+                 "WHERE versions.file_id = files.file_id AND "
+                 "versions.timestamp <= files.timestamp), files.timestamp, "
+                 "files.size, files.stored FROM up JOIN files USING (file_id) "
+                 "WHERE up.parent = 0 ORDER BY files.timestamp, up.path")
+        with self.__connect() as db:
+            for row in db.execute(query, params):
+                yield VersionRecord(*row)
+
+    @contextmanager
+    def __connect(self):
+        with closing(connect(self.__index_path)) as db:
+            db.execute("ATTACH DATABASE ? AS tree", (self.__node_index_path,))
+            yield db
+
+    @contextmanager
+    def __write(self):
+        with closing(connect(self.__index_path)) as db:
+            with db:
+                yield db